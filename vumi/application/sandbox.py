@@ -7,8 +7,10 @@ import resource
 import os
 import signal
 import json
+import hashlib
 import pkg_resources
 from uuid import uuid4
+from collections import OrderedDict
 
 from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
@@ -19,10 +21,16 @@ from twisted.internet.error import ProcessDone
 from twisted.python.failure import Failure
 
 import vumi
-from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigList, ConfigDict, ConfigBool)
 from vumi.application.base import ApplicationWorker
+from vumi.application.sandbox_framing import (
+    LineBuffer, SandboxFramingError, frame, switch_framing, LINES,
+    LENGTH_PREFIXED)
 from vumi.message import Message
 from vumi.errors import ConfigError
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, Count, AVG, MAX)
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.utils import load_class_by_string, http_request_full
 from vumi import log
@@ -143,7 +151,68 @@ class SandboxRlimiter(object):
                              **kwargs)
 
 
-class SandboxProtocol(ProcessProtocol):
+class SandboxRequestsMixin(object):
+    """Timeout and pending request handling shared by
+    :class:`SandboxProtocol` and :class:`SandboxSession`.
+    """
+
+    timeout_task = None
+
+    def cancel_timeout(self):
+        if self.timeout_task is not None:
+            if self.timeout_task.active():
+                self.timeout_task.cancel()
+            self.timeout_task = None
+
+    def _done_after_requests(self, pending_requests, result):
+        """Fire `self._done` with `result` once `pending_requests` have
+        finished, logging any that failed.
+        """
+        requests_done = DeferredList(pending_requests)
+        requests_done.addCallback(self._process_request_results)
+        requests_done.addCallback(lambda _r: self._done.callback(result))
+
+    def _process_request_results(self, results):
+        for success, result in results:
+            if not success:
+                log.error(result)
+
+
+class SandboxSession(SandboxRequestsMixin):
+    """A single message being handled by a persistent sandbox process.
+
+    Commands the sandbox sends while handling the message carry the id of
+    the session in their `session_id` field and are dispatched via the
+    session's own :class:`SandboxApi`. The sandbox ends the session by
+    sending a `done` command.
+    """
+
+    def __init__(self, session_id, api):
+        self.session_id = session_id
+        self.api = api
+        self.recv_bytes = 0
+        self.pending_requests = []
+        self.cpu_start = None
+        self.cpu_task = None
+        self._done = MultiDeferred()
+
+    def done(self):
+        """Returns a deferred that will be called when the session ends."""
+        return self._done.get()
+
+    def cancel_cpu_check(self):
+        if self.cpu_task is not None:
+            if self.cpu_task.active():
+                self.cpu_task.cancel()
+            self.cpu_task = None
+
+    def end(self, result):
+        self.cancel_timeout()
+        self.cancel_cpu_check()
+        self._done_after_requests(self.pending_requests, result)
+
+
+class SandboxProtocol(ProcessProtocol, SandboxRequestsMixin):
     """A protocol for communicating over stdin and stdout with a sandboxed
     process.
 
@@ -157,12 +226,30 @@ class SandboxProtocol(ProcessProtocol):
     of newline separated JSON commands that are parsed and formatted by
     :class:`SandboxCommand`.
 
+    If `framing` is something other than :data:`LINES`, the process is
+    asked to switch to it as soon as it starts. The process must reply
+    (still using newline framing) with a `framing` command before
+    switching its own output. Commands sent to it are framed using
+    `framing` straight after the request.
+
     Incoming commands are dispatched to :class:`SandboxResource` instances
     via the supplied :class:`SandboxApi`.
+
+    A persistent sandbox process handles many messages, each in a
+    :class:`SandboxSession` started with :meth:`start_session`. The
+    `timeout` and `recv_limit` then apply to each session separately.
+    Output that doesn't belong to a session is counted against
+    `recv_limit` until the next session ends. If `session_cpu_limit` is
+    given, the process is also killed once it has used more than that many
+    seconds of CPU time while a session is running (checked every
+    `CPU_CHECK_INTERVAL` seconds).
     """
 
+    CPU_CHECK_INTERVAL = 1.0
+
     def __init__(self, sandbox_id, api, executable, spawn_kwargs,
-                 rlimits, timeout, recv_limit):
+                 rlimits, timeout, recv_limit, framing=LINES,
+                 session_cpu_limit=None):
         self.sandbox_id = sandbox_id
         self.api = api
         self.executable = executable
@@ -172,11 +259,17 @@ class SandboxProtocol(ProcessProtocol):
         self._done = MultiDeferred()
         self._pending_requests = []
         self.exit_reason = None
-        self.timeout_task = reactor.callLater(timeout, self.kill)
+        self.timeout = timeout
+        self.start_timeout()
         self.recv_limit = recv_limit
         self.recv_bytes = 0
-        self.chunk = ''
-        self.error_chunk = ''
+        self.session_cpu_limit = session_cpu_limit
+        self.framing = framing
+        self.send_framing = LINES
+        self._out_buffer = LineBuffer(recv_limit)
+        self._err_buffer = LineBuffer(recv_limit)
+        self._sessions = {}
+        self._session_count = 0
         api.set_sandbox(self)
 
     @staticmethod
@@ -195,6 +288,57 @@ class SandboxProtocol(ProcessProtocol):
         """Returns a deferred that will be called once the process starts."""
         return self._started.get()
 
+    def start_timeout(self):
+        """(Re)start the countdown to killing the process."""
+        self.cancel_timeout()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+
+    def start_session(self, api):
+        """Start a session for handling one message, using `api` for the
+        commands sent and received during it.
+
+        Returns the new :class:`SandboxSession`. The process is killed if
+        the session doesn't end within the timeout.
+        """
+        self._session_count += 1
+        session = SandboxSession(str(self._session_count), api)
+        api.set_sandbox(self, session.session_id)
+        session.timeout_task = reactor.callLater(self.timeout, self.kill)
+        self._sessions[session.session_id] = session
+        if self.session_cpu_limit is not None:
+            session.cpu_start = get_process_cpu_time(self.transport.pid)
+            self._schedule_cpu_check(session)
+        return session
+
+    def _schedule_cpu_check(self, session):
+        session.cpu_task = reactor.callLater(
+            self.CPU_CHECK_INTERVAL, self._check_session_cpu, session)
+
+    def _check_session_cpu(self, session):
+        """Kill the process if it has used more than `session_cpu_limit`
+        seconds of CPU time since `session` started.
+        """
+        session.cancel_cpu_check()
+        if self._sessions.get(session.session_id) is not session:
+            return
+        cpu_time = get_process_cpu_time(self.transport.pid)
+        if cpu_time is None or session.cpu_start is None:
+            return
+        if cpu_time - session.cpu_start > self.session_cpu_limit:
+            log.warning("Sandbox %r used more than %s CPU seconds in a"
+                        " session." % (self.sandbox_id,
+                                       self.session_cpu_limit))
+            self.kill()
+        else:
+            self._schedule_cpu_check(session)
+
+    def _end_session(self, session, result):
+        del self._sessions[session.session_id]
+        # Output outside sessions (stderr, logging, fetching code) is
+        # charged to the process, so each session starts it afresh too.
+        self.recv_bytes = 0
+        session.end(result)
+
     def kill(self):
         """Kills the underlying process."""
         if self.transport.pid is not None:
@@ -202,65 +346,88 @@ class SandboxProtocol(ProcessProtocol):
 
     def send(self, command):
         """Writes the command to the processes' stdin."""
-        self.transport.write(command.to_json())
-        self.transport.write("\n")
+        self.transport.write(frame(command.to_json(), self.send_framing))
 
-    def check_recv(self, nbytes):
-        self.recv_bytes += nbytes
-        if self.recv_bytes <= self.recv_limit:
+    def check_recv(self, nbytes, session=None):
+        counter = self if session is None else session
+        counter.recv_bytes += nbytes
+        if counter.recv_bytes <= self.recv_limit:
             return True
         else:
             self.kill()
             return False
 
     def connectionMade(self):
+        if self.framing != LINES:
+            self.send(SandboxCommand(cmd="framing", framing=self.framing))
+            self.send_framing = self.framing
         self._started.callback(self)
 
-    def _process_data(self, chunk, data):
-        if not self.check_recv(len(data)):
-            return [chunk]  # skip the data if it's too big
-        line_parts = data.split("\n")
-        line_parts[0] = chunk + line_parts[0]
-        return line_parts
-
     def _parse_command(self, line):
         try:
             return SandboxCommand.from_json(line)
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def _dispatch_frame(self, data):
+        """Dispatch a command, charging it to the session it belongs to (or
+        to the process as a whole). Returns `False` if the process has been
+        killed for going over its receive limit.
+        """
+        command = self._parse_command(data)
+        session = self._sessions.get(command.get('session_id'))
+        if not self.check_recv(len(data) + 1, session):
+            return False
+        if command['cmd'] == 'framing' and command['reply']:
+            # Everything after this is framed the way we asked for.
+            self._out_buffer = switch_framing(
+                self._out_buffer, command.get('framing'))
+        elif session is None:
+            self._pending_requests.append(self.api.dispatch_request(command))
+        elif command['cmd'] == 'done':
+            self._end_session(session, 0)
+        else:
+            session.pending_requests.append(
+                session.api.dispatch_request(command))
+        return True
+
     def outReceived(self, data):
-        lines = self._process_data(self.chunk, data)
-        for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
-        self.chunk = lines[-1]
+        self._out_buffer.feed(data)
+        try:
+            # Not iterating over the buffer, since dispatching a frame may
+            # replace it with one for another framing.
+            frame_data = self._out_buffer.pop()
+            while frame_data is not None:
+                if not self._dispatch_frame(frame_data):
+                    self._out_buffer.remainder()
+                    return
+                frame_data = self._out_buffer.pop()
+        except SandboxFramingError:
+            # No session could send a frame this long without going over
+            # its limit, and a broken length header can't be recovered
+            # from.
+            self._out_buffer.remainder()
+            self.kill()
 
     def outConnectionLost(self):
-        if self.chunk:
-            line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+        data = self._out_buffer.remainder()
+        if data and self._out_buffer.framing == LINES:
+            self._dispatch_frame(data)
 
     def errReceived(self, data):
-        lines = self._process_data(self.error_chunk, data)
-        for i in range(len(lines) - 1):
-            log.error(Failure(SandboxError(lines[i])))
-        self.error_chunk = lines[-1]
+        if not self.check_recv(len(data)):
+            return  # skip the data if it's too big
+        self._err_buffer.feed(data)
+        for line in self._err_buffer:
+            log.error(Failure(SandboxError(line)))
 
     def errConnectionLost(self):
-        if self.error_chunk:
-            log.error(Failure(SandboxError(self.error_chunk)))
-            self.error_chunk = ""
-
-    def _process_request_results(self, results):
-        for success, result in results:
-            if not success:
-                log.error(result)
+        data = self._err_buffer.remainder()
+        if data:
+            log.error(Failure(SandboxError(data)))
 
     def processEnded(self, reason):
-        if self.timeout_task.active():
-            self.timeout_task.cancel()
+        self.cancel_timeout()
         if isinstance(reason.value, ProcessDone):
             result = reason.value.status
         else:
@@ -268,9 +435,299 @@ class SandboxProtocol(ProcessProtocol):
         if not self._started.fired():
             self._started.callback(Failure(
                 SandboxError("Process failed to start.")))
-        requests_done = DeferredList(self._pending_requests)
-        requests_done.addCallback(self._process_request_results)
-        requests_done.addCallback(lambda _r: self._done.callback(result))
+        for session in self._sessions.values():
+            self._end_session(session, result)
+        self._done_after_requests(self._pending_requests, result)
+
+
+def get_process_rss(pid):
+    """Return the resident set size of process `pid` in bytes, or `None`
+    if it can't be determined.
+    """
+    try:
+        with open('/proc/%d/statm' % (pid,)) as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def get_process_cpu_time(pid):
+    """Return the user and system CPU time used by process `pid` in
+    seconds, or `None` if it can't be determined.
+    """
+    try:
+        with open('/proc/%d/stat' % (pid,)) as stat:
+            # The process name may contain spaces, so skip past it.
+            fields = stat.read().rpartition(')')[2].split()
+        ticks = int(fields[11]) + int(fields[12])
+        return float(ticks) / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError, TypeError):
+        return None
+
+
+class SandboxPool(object):
+    """Started and initialised sandbox processes, ready to handle messages.
+
+    Processes are grouped by a key identifying the app they run. Whenever a
+    process is taken for a key, replacements are started in the background
+    so that `warm_size` idle processes are kept ready for the next
+    messages. If a message arrives while a process for its key is still
+    starting, it waits for that process rather than starting another one.
+
+    Processes that are still running after handling a message may be given
+    back with :meth:`release` to be used again. They are retired (killed)
+    instead once they've handled `max_messages` messages or their resident
+    memory has grown beyond `max_rss`. Idle processes are killed after
+    `max_idle` seconds. Processes that can handle several messages at once
+    are handed out again while they have fewer than `concurrency` messages.
+
+    :param start_func:
+        Called with a config to start a new sandbox process. Should return a
+        deferred that fires with its :class:`SandboxProtocol` once the
+        process has started and been initialised.
+    :param int warm_size:
+        Number of idle processes to keep ready for each key.
+    :param int max_messages:
+        Number of messages a process may handle. 1 gives every message a
+        fresh process.
+    :param float max_idle:
+        Number of seconds an idle process is kept for.
+    :param int max_rss:
+        Resident memory (in bytes) above which a process is retired instead
+        of being reused. `None` means no limit.
+    :param int concurrency:
+        Number of messages a process may handle at the same time.
+    :param clock:
+        Something providing `callLater` and `seconds`. Defaults to the
+        reactor.
+    """
+
+    def __init__(self, start_func, warm_size=1, max_messages=1, max_idle=300,
+                 max_rss=None, concurrency=1, clock=None):
+        if clock is None:
+            clock = reactor
+        self.start_func = start_func
+        self.warm_size = warm_size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.max_rss = max_rss
+        self.concurrency = concurrency
+        self.clock = clock
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+        self._configs = {}
+        self._idle = {}
+        self._starting = {}
+        self._waiters = {}
+        self._idle_calls = {}
+        self._uses = {}
+        self._active = {}
+        self._pending_starts = set()
+        self._metrics = None
+
+    def idle_count(self, key=None):
+        if key is not None:
+            return len(self._idle.get(key, ()))
+        return sum(len(idle) for idle in self._idle.itervalues())
+
+    def acquire(self, key, config):
+        """Return a deferred that fires with a ready sandbox protocol for
+        `key`. `config` is used to start new processes for `key`.
+        """
+        self._configs[key] = config
+        idle = self._idle.get(key)
+        if idle:
+            self._record_hit()
+            d = succeed(self._hand_out(key, idle[-1]))
+        else:
+            d = Deferred()
+            waiters = self._waiters.setdefault(key, [])
+            waiters.append(d)
+            starting = self._starting.get(key, 0)
+            if starting * self.concurrency < len(waiters):
+                self._record_miss()
+                self._start(key)
+            else:
+                self._record_hit()
+        self._replenish(key)
+        return d
+
+    def release(self, key, protocol):
+        """Give back a process that has finished handling a message."""
+        uses = self._uses.get(protocol)
+        if uses is None:
+            # It has already ended.
+            return
+        self._active[protocol] -= 1
+        if self.stopped or not self._reusable(protocol, uses):
+            self._retire(key, protocol)
+            return
+        self._ready(key, protocol)
+
+    def _retire(self, key, protocol):
+        """Stop handing `protocol` out and kill it once it's not handling
+        any messages. Returns a deferred that fires when it has been killed
+        and has ended, or `None` if it's still busy.
+        """
+        idle = self._idle.get(key, [])
+        if protocol in idle:
+            idle.remove(protocol)
+        if self._active[protocol] == 0:
+            d = protocol.done()
+            protocol.kill()
+            return d
+
+    def _reusable(self, protocol, uses):
+        if uses >= self.max_messages:
+            return False
+        if self.max_rss is not None:
+            rss = get_process_rss(protocol.transport.pid)
+            if rss is not None and rss > self.max_rss:
+                return False
+        return True
+
+    def _has_capacity(self, protocol):
+        return (self._active[protocol] < self.concurrency
+                and self._uses[protocol] < self.max_messages)
+
+    def _hand_out(self, key, protocol):
+        self._cancel_idle_call(protocol)
+        self._uses[protocol] += 1
+        self._active[protocol] += 1
+        idle = self._idle.get(key, [])
+        if protocol in idle and not self._has_capacity(protocol):
+            idle.remove(protocol)
+        protocol.start_timeout()
+        return protocol
+
+    def _replenish(self, key):
+        if self.stopped:
+            return
+        waiting = len(self._waiters.get(key, ()))
+        spare = (self.idle_count(key) + self._starting.get(key, 0)
+                 - (waiting + self.concurrency - 1) // self.concurrency)
+        for _ in range(self.warm_size - spare):
+            self._start(key)
+
+    def _start(self, key):
+        self._starting[key] = self._starting.get(key, 0) + 1
+        start_time = self.clock.seconds()
+        d = maybeDeferred(self.start_func, self._configs[key])
+        d.addCallbacks(self._started, self._start_failed,
+                       callbackArgs=(key, start_time), errbackArgs=(key,))
+        self._pending_starts.add(d)
+        d.addBoth(self._start_finished, d)
+
+    def _start_finished(self, result, d):
+        self._pending_starts.discard(d)
+
+    def _started(self, protocol, key, start_time):
+        self._starting[key] -= 1
+        self._record_spawn_time(self.clock.seconds() - start_time)
+        self._uses[protocol] = 0
+        self._active[protocol] = 0
+        protocol.done().addBoth(self._ended, key, protocol)
+        return self._ready(key, protocol)
+
+    def _start_failed(self, failure, key):
+        self._starting[key] -= 1
+        waiters = self._waiters.get(key, [])
+        # Fail the waiters that the remaining starting processes can't serve.
+        served = self._starting[key] * self.concurrency
+        if len(waiters) > served:
+            while len(waiters) > served:
+                waiters.pop().errback(failure)
+        else:
+            log.error(failure, "Failed to start a sandbox for the pool.")
+        self._cleanup(key)
+
+    def _ready(self, key, protocol):
+        """Hand `protocol`, which can take another message, to waiting
+        callers or add it to the idle processes.
+        """
+        waiters = self._waiters.get(key)
+        while waiters and self._has_capacity(protocol):
+            waiters.pop(0).callback(self._hand_out(key, protocol))
+        if not self._has_capacity(protocol):
+            return
+        if self.stopped:
+            return self._retire(key, protocol)
+        idle = self._idle.setdefault(key, [])
+        if protocol not in idle:
+            idle.append(protocol)
+        if self._active[protocol] == 0:
+            protocol.cancel_timeout()
+            self._idle_calls[protocol] = self.clock.callLater(
+                self.max_idle, self._evict, key, protocol)
+
+    def _evict(self, key, protocol):
+        self._idle_calls.pop(protocol, None)
+        protocol.kill()
+
+    def _ended(self, result, key, protocol):
+        self._cancel_idle_call(protocol)
+        self._uses.pop(protocol, None)
+        self._active.pop(protocol, None)
+        idle = self._idle.get(key, [])
+        if protocol in idle:
+            idle.remove(protocol)
+        self._cleanup(key)
+
+    def _cleanup(self, key):
+        if not (self._idle.get(key) or self._starting.get(key)
+                or self._waiters.get(key)):
+            for state in (self._configs, self._idle, self._starting,
+                          self._waiters):
+                state.pop(key, None)
+
+    def _cancel_idle_call(self, protocol):
+        delayed = self._idle_calls.pop(protocol, None)
+        if delayed is not None and delayed.active():
+            delayed.cancel()
+
+    def _record_hit(self):
+        self.hits += 1
+        if self._metrics is not None:
+            self._metrics['hits'].inc()
+
+    def _record_miss(self):
+        self.misses += 1
+        if self._metrics is not None:
+            self._metrics['misses'].inc()
+
+    def _record_spawn_time(self, duration):
+        if self._metrics is not None:
+            self._metrics['spawn_time'].set(duration)
+
+    def register_metrics(self, metric_manager):
+        """Register pool hit, miss and spawn time metrics with
+        `metric_manager`.
+        """
+        self._metrics = {
+            'hits': metric_manager.register(Count('sandbox_pool.hits')),
+            'misses': metric_manager.register(Count('sandbox_pool.misses')),
+            'spawn_time': metric_manager.register(
+                Metric('sandbox_pool.spawn_time', [AVG, MAX])),
+        }
+
+    def stop(self):
+        """Kill all idle processes and stop starting new ones.
+
+        Returns a deferred that fires once the idle processes (and any that
+        were still starting) have ended.
+        """
+        self.stopped = True
+        # Processes that are still starting are killed once they're ready.
+        ds = list(self._pending_starts)
+        for key, idle in self._idle.items():
+            for protocol in list(idle):
+                d = self._retire(key, protocol)
+                if d is not None:
+                    ds.append(d)
+        for protocol in self._idle_calls.keys():
+            self._cancel_idle_call(protocol)
+        return DeferredList(ds, consumeErrors=True)
 
 
 class SandboxResources(object):
@@ -346,6 +803,12 @@ class SandboxResource(object):
 class RedisResource(SandboxResource):
     """Resource that provices access to a simple key-value store.
 
+    As well as single key `get`, `set`, `incr` and `delete` commands, there
+    are `mget`, `mset` and `pipeline` commands that handle many keys in a
+    fixed number of redis round trips. The key quota for a whole batch is
+    reserved with a single atomic increment before anything is written, so
+    a batch either fits in the quota or is rejected without changes.
+
     Configuration options:
 
     :param dict redis_manager:
@@ -423,6 +886,132 @@ class RedisResource(SandboxResource):
             returnValue(self.reply(command, success=False, reason=unicode(e)))
         returnValue(self.reply(command, value=int(value), success=True))
 
+    BATCH_OPS = ('get', 'set', 'incr', 'delete')
+
+    @inlineCallbacks
+    def _keys_exist(self, keys):
+        """Return a dict saying whether each of `keys` exists."""
+        if not keys:
+            returnValue({})
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        returnValue(dict(zip(keys, (yield pipe.execute()))))
+
+    def _key_count_change(self, ops, existed):
+        """Return the number of keys that running `ops` will add (or remove,
+        if negative) given which keys `existed` beforehand.
+        """
+        exists = dict(existed)
+        change = 0
+        for op, key, _arg in ops:
+            if op in ('set', 'incr') and not exists[key]:
+                exists[key] = True
+                change += 1
+            elif op == 'delete' and exists[key]:
+                exists[key] = False
+                change -= 1
+        return change
+
+    @inlineCallbacks
+    def run_batch(self, sandbox_id, ops):
+        """Run a list of `(op, key, arg)` operations on sandboxed keys.
+
+        Returns a list of the raw redis results, or `None` if the operations
+        would take the sandbox over its key quota. If the operations fail,
+        the key count is corrected for whichever of them ran before the
+        failure is raised.
+        """
+        keys = list(set(key for op, key, _arg in ops if op != 'get'))
+        existed = yield self._keys_exist(keys)
+        change = self._key_count_change(ops, existed)
+        reserved = max(change, 0)
+        count_key = self._count_key(sandbox_id)
+        if reserved:
+            if ((yield self.redis.incr(count_key, reserved))
+                    > self.keys_per_user):
+                yield self.redis.incr(count_key, -reserved)
+                returnValue(None)
+        pipe = self.redis.pipeline()
+        for op, key, arg in ops:
+            if op == 'get':
+                pipe.get(key)
+            elif op == 'set':
+                pipe.set(key, json.dumps(arg))
+            elif op == 'incr':
+                pipe.incr(key, arg)
+            else:
+                pipe.delete(key)
+        try:
+            results = yield pipe.execute()
+        except Exception:
+            failure = Failure()
+            exists = yield self._keys_exist(keys)
+            actual = (sum(1 for key in keys if exists[key]) -
+                      sum(1 for key in keys if existed[key]))
+            if actual != reserved:
+                yield self.redis.incr(count_key, actual - reserved)
+            failure.raiseException()
+        if change < 0:
+            yield self.redis.incr(count_key, change)
+        returnValue(results)
+
+    def _batch_result(self, op, result):
+        if op == 'get':
+            return json.loads(result) if result is not None else None
+        if op == 'set':
+            return True
+        if op == 'incr':
+            return int(result)
+        return bool(result)
+
+    @inlineCallbacks
+    def handle_mget(self, api, command):
+        ops = [('get', self._sandboxed_key(api.sandbox_id, key), None)
+               for key in command.get('keys', [])]
+        try:
+            results = yield self.run_batch(api.sandbox_id, ops)
+        except Exception, e:
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        returnValue(self.reply(command, success=True, values=[
+            self._batch_result('get', result) for result in results]))
+
+    @inlineCallbacks
+    def handle_mset(self, api, command):
+        ops = [('set', self._sandboxed_key(api.sandbox_id, key), value)
+               for key, value in command.get('items', {}).iteritems()]
+        try:
+            results = yield self.run_batch(api.sandbox_id, ops)
+        except Exception, e:
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        if results is None:
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_pipeline(self, api, command):
+        ops = []
+        for op in command.get('commands', []):
+            if op.get('cmd') not in self.BATCH_OPS:
+                returnValue(self.reply(
+                    command, success=False,
+                    reason="Unknown pipeline command %r" % (op.get('cmd'),)))
+            key = self._sandboxed_key(api.sandbox_id, op.get('key'))
+            if op['cmd'] == 'incr':
+                arg = op.get('amount', 1)
+            else:
+                arg = op.get('value')
+            ops.append((op['cmd'], key, arg))
+        try:
+            results = yield self.run_batch(api.sandbox_id, ops)
+        except Exception, e:
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        if results is None:
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True, results=[
+            self._batch_result(op, result)
+            for (op, _key, _arg), result in zip(ops, results)]))
+
 
 class OutboundResource(SandboxResource):
     """Resource that provides the ability to send outbound messages.
@@ -456,14 +1045,32 @@ class JsSandboxResource(SandboxResource):
     a simple node.js based Javascript sandbox.
 
     Requires the worker to have a `javascript_for_api` method.
+
+    Persistent sandboxes are only sent a hash of the code. They fetch the
+    code itself with a `get_code` command if they haven't already compiled
+    it.
     """
     def sandbox_init(self, api):
+        if self.app_worker.persistent_for_api(api):
+            code_hash = self.app_worker.code_hash_for_api(api)
+            api.sandbox_send(SandboxCommand(cmd="initialize", persistent=True,
+                                            code_hash=code_hash))
+            return
         javascript = self.app_worker.javascript_for_api(api)
         app_context = self.app_worker.app_context_for_api(api)
         api.sandbox_send(SandboxCommand(cmd="initialize",
                                         javascript=javascript,
                                         app_context=app_context))
 
+    def handle_get_code(self, api, command):
+        code = self.app_worker.code_for_hash(api, command.get('code_hash'))
+        if code is None:
+            return self.reply(command, success=False,
+                              reason="Unknown code hash")
+        javascript, app_context = code
+        return self.reply(command, success=True, javascript=javascript,
+                          app_context=app_context)
+
 
 class LoggingResource(SandboxResource):
     """Resource that allows a sandbox to log messages via Twisted's
@@ -526,6 +1133,7 @@ class SandboxApi(object):
     def __init__(self, resources, config):
         self._sandbox = None
         self._inbound_messages = {}
+        self.session_id = None
         self.resources = resources
         self.fallback_resource = SandboxResource("fallback", None, {})
         self.config = config
@@ -534,12 +1142,13 @@ class SandboxApi(object):
     def sandbox_id(self):
         return self._sandbox.sandbox_id
 
-    def set_sandbox(self, sandbox):
+    def set_sandbox(self, sandbox, session_id=None):
         if self._sandbox is not None:
             raise SandboxError("Sandbox already set ("
                                "existing id: %r, new id: %r)."
                                % (self.sandbox_id, sandbox.sandbox_id))
         self._sandbox = sandbox
+        self.session_id = session_id
 
     def sandbox_init(self):
         for resource in self.resources.resources.values():
@@ -555,6 +1164,8 @@ class SandboxApi(object):
                                          msg=event.payload))
 
     def sandbox_send(self, msg):
+        if self.session_id is not None:
+            msg['session_id'] = self.session_id
         self._sandbox.send(msg)
 
     def sandbox_kill(self):
@@ -622,6 +1233,12 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
     recv_limit = ConfigInt(
         "Maximum number of bytes that will be read from a sandboxed"
         " process' stdout and stderr combined.", default=1024 * 1024)
+    framing = ConfigText(
+        "How commands are framed once the sandboxed process has started:"
+        " 'lines' (newline separated) or 'length' (length-prefixed, which"
+        " saves scanning large commands for the newline that ends them)."
+        " The sandboxed program must support switching to length-prefixed"
+        " framing (sandboxer.js does).", default=LINES, static=True)
     rlimits = ConfigDict(
         "Dictionary of resource limits to be applied to sandboxed"
         " processes. Defaults are fairly restricted. Keys maybe"
@@ -629,6 +1246,31 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " :module:`resource`. Values should be appropriate integers.",
         default={})
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pool_size = ConfigInt(
+        "Number of started and initialised sandbox processes to keep ready"
+        " for each app. If 0, a new process is started for each message"
+        " instead.", default=0, static=True)
+    pool_max_messages = ConfigInt(
+        "Number of messages a pooled sandbox process may handle before it"
+        " is replaced. 1 gives every message a fresh process, so that no"
+        " state is shared between messages.", default=1, static=True)
+    pool_max_idle = ConfigInt(
+        "Number of seconds an idle pooled sandbox process is kept for.",
+        default=300, static=True)
+    pool_max_rss = ConfigInt(
+        "Resident memory (in bytes) above which a pooled sandbox process is"
+        " replaced rather than reused. Defaults to no limit.", static=True)
+    pool_persistent = ConfigBool(
+        "Keep pooled sandbox processes running between messages, handling"
+        " each message in a session of its own. The sandboxed program must"
+        " support sessions (sandboxer.js does). The timeout, recv_limit and"
+        " CPU time limit apply to each message.", default=False, static=True)
+    pool_concurrency = ConfigInt(
+        "Number of messages a persistent pooled sandbox process may handle"
+        " at the same time.", default=1, static=True)
+    metrics_prefix = ConfigText(
+        "Prefix for sandbox pool metrics. If not set, no metrics are"
+        " published.", static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -649,8 +1291,13 @@ class Sandbox(ApplicationWorker):
         resource.RLIMIT_AS: (196 * MB, 196 * MB),
     }
 
+    sandbox_pool = None
+    metrics = None
+
     def validate_config(self):
         config = self.get_static_config()
+        if config.framing not in (LINES, LENGTH_PREFIXED):
+            raise ConfigError("Unknown framing %r" % (config.framing,))
         self.resources = self.create_sandbox_resources(config.sandbox)
         self.resources.validate_config()
 
@@ -667,11 +1314,31 @@ class Sandbox(ApplicationWorker):
                 raise ConfigError("Unknown resource limit key %r" % (key,))
         return rlimits
 
+    @inlineCallbacks
     def setup_application(self):
-        return self.resources.setup_resources()
+        yield self.resources.setup_resources()
+        config = self.get_static_config()
+        if config.pool_size > 0:
+            concurrency = 1
+            if config.pool_persistent:
+                concurrency = config.pool_concurrency
+            self.sandbox_pool = SandboxPool(
+                self.start_sandbox_protocol, warm_size=config.pool_size,
+                max_messages=config.pool_max_messages,
+                max_idle=config.pool_max_idle, max_rss=config.pool_max_rss,
+                concurrency=concurrency)
+            if config.metrics_prefix is not None:
+                self.metrics = yield self.start_publisher(
+                    MetricManager, config.metrics_prefix)
+                self.sandbox_pool.register_metrics(self.metrics)
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self.sandbox_pool is not None:
+            yield self.sandbox_pool.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        yield self.resources.teardown_resources()
 
     def create_sandbox_resources(self, config):
         return SandboxResources(self, config)
@@ -682,8 +1349,32 @@ class Sandbox(ApplicationWorker):
     def get_rlimits(self, config):
         rlimits = self.DEFAULT_RLIMITS.copy()
         rlimits.update(self._convert_rlimits(config.rlimits))
+        if self.is_persistent(config):
+            # The CPU time limit is for each message the process handles,
+            # and is enforced per session (see get_session_cpu_limit). The
+            # process as a whole gets enough for all of its messages.
+            rlimits[resource.RLIMIT_CPU] = tuple(
+                limit * config.pool_max_messages if limit >= 0 else limit
+                for limit in rlimits[resource.RLIMIT_CPU])
         return rlimits
 
+    def get_session_cpu_limit(self, config):
+        """Return the CPU seconds each message may use in a persistent
+        sandbox process, or `None` if there is no such limit.
+        """
+        if not self.is_persistent(config):
+            return None
+        rlimits = self.DEFAULT_RLIMITS.copy()
+        rlimits.update(self._convert_rlimits(config.rlimits))
+        soft, hard = rlimits[resource.RLIMIT_CPU]
+        return soft if soft >= 0 else None
+
+    def is_persistent(self, config):
+        """Return `True` if sandbox processes for `config` are kept running
+        to handle many messages, each in a session of its own.
+        """
+        return config.pool_size > 0 and config.pool_persistent
+
     def create_sandbox_protocol(self, api):
         executable, args = self.get_executable_and_args(api.config)
         rlimits = self.get_rlimits(api.config)
@@ -691,7 +1382,8 @@ class Sandbox(ApplicationWorker):
             args=args, env=api.config.env, path=api.config.path)
         return SandboxProtocol(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
-            api.config.timeout, api.config.recv_limit)
+            api.config.timeout, api.config.recv_limit, api.config.framing,
+            self.get_session_cpu_limit(api.config))
 
     def create_sandbox_api(self, resources, config):
         return SandboxApi(resources, config)
@@ -712,6 +1404,54 @@ class Sandbox(ApplicationWorker):
         protocol = self.create_sandbox_protocol(api)
         return protocol
 
+    def sandbox_pool_key(self, config):
+        """Return the key that pooled sandbox processes for `config` are
+        shared under.
+
+        Everything about a sandbox process that depends on `config` must be
+        the same for every config with the same key. Sub-classes that add
+        such things should include them in the key.
+        """
+        return config.sandbox_id
+
+    def start_sandbox_protocol(self, config):
+        """Start and initialise a sandbox process for the pool."""
+        api = self.create_sandbox_api(self.resources, config)
+        protocol = self.create_sandbox_protocol(api)
+        protocol.spawn()
+
+        def on_start(_result):
+            api.sandbox_init()
+            return protocol
+
+        return protocol.started().addCallback(on_start)
+
+    def _process_in_pooled_sandbox(self, config, api_callback):
+        key = self.sandbox_pool_key(config)
+
+        def on_acquire(sandbox_protocol):
+            if not self.is_persistent(config):
+                api_callback(sandbox_protocol.api)
+                d = sandbox_protocol.done()
+                d.addErrback(log.error)
+                return d
+            api = self.create_sandbox_api(self.resources, config)
+            session = sandbox_protocol.start_session(api)
+            api.sandbox_init()
+            api_callback(api)
+            d = session.done()
+            d.addErrback(log.error)
+            d.addBoth(on_session_done, sandbox_protocol)
+            return d
+
+        def on_session_done(status, sandbox_protocol):
+            self.sandbox_pool.release(key, sandbox_protocol)
+            return status
+
+        d = self.sandbox_pool.acquire(key, config)
+        d.addCallbacks(on_acquire, log.error)
+        return d
+
     def _process_in_sandbox(self, sandbox_protocol, api_callback):
         sandbox_protocol.spawn()
 
@@ -729,6 +1469,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        if self.sandbox_pool is not None:
+            status = yield self._process_in_pooled_sandbox(
+                config, lambda api: api.sandbox_inbound_message(msg))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
 
         def sandbox_init():
@@ -740,6 +1484,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        if self.sandbox_pool is not None:
+            status = yield self._process_in_pooled_sandbox(
+                config, lambda api: api.sandbox_inbound_event(event))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
 
@@ -808,6 +1556,9 @@ class JsSandbox(Sandbox):
 
     CONFIG_CLASS = JsSandboxConfig
 
+    # Number of versions of app code kept for persistent sandboxes to fetch.
+    CODE_CACHE_SIZE = 100
+
     POSSIBLE_NODEJS_EXECUTABLES = [
         '/usr/local/bin/node',
         '/usr/local/bin/nodejs',
@@ -849,6 +1600,56 @@ class JsSandbox(Sandbox):
         """
         return api.config.app_context
 
+    def persistent_for_api(self, api):
+        """Called by JsSandboxResource.
+
+        :returns: `True` if the sandbox handles each message in a session
+        of its own rather than exiting after one message.
+        """
+        return self.is_persistent(api.config)
+
+    @staticmethod
+    def code_hash(javascript, app_context):
+        """Return a hash identifying `javascript` run with `app_context`."""
+        code = hashlib.sha1()
+        for part in (javascript, app_context or ''):
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            code.update(part + '\0')
+        return code.hexdigest()
+
+    def code_hash_for_api(self, api):
+        """Called by JsSandboxResource.
+
+        :returns: The hash of the code for `api`. The code is remembered so
+        that the sandbox can fetch it with :meth:`code_for_hash`.
+        """
+        javascript = self.javascript_for_api(api)
+        app_context = self.app_context_for_api(api)
+        code_hash = self.code_hash(javascript, app_context)
+        key = (api.sandbox_id, code_hash)
+        self._code.pop(key, None)
+        self._code[key] = (javascript, app_context)
+        while len(self._code) > self.CODE_CACHE_SIZE:
+            self._code.popitem(last=False)
+        return code_hash
+
+    def code_for_hash(self, api, code_hash):
+        """Called by JsSandboxResource.
+
+        :returns: A `(javascript, app_context)` tuple for `code_hash`, or
+        `None` if the code isn't known for `api`'s sandbox.
+        """
+        return self._code.get((api.sandbox_id, code_hash))
+
+    def sandbox_pool_key(self, config):
+        if self.is_persistent(config):
+            # Persistent sandboxes are told which code to run for each
+            # message, and keep any they've seen compiled.
+            return config.sandbox_id
+        return (config.sandbox_id,
+                self.code_hash(config.javascript, config.app_context))
+
     def get_executable_and_args(self, config):
         executable = config.executable
         if executable is None:
@@ -860,6 +1661,7 @@ class JsSandbox(Sandbox):
 
     def validate_config(self):
         super(JsSandbox, self).validate_config()
+        self._code = OrderedDict()
         if 'js' not in self.resources.resources:
             self.resources.add_resource('js', self.get_js_resource())
         if 'log' not in self.resources.resources:
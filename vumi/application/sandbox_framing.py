@@ -0,0 +1,131 @@
+# -*- test-case-name: vumi.application.tests.test_sandbox_framing -*-
+
+"""Splitting the output of a sandboxed process into commands."""
+
+from vumi.utils import OffsetBuffer
+
+# Commands are newline terminated lines unless the sandbox has agreed to
+# switch to "<length>:<data>\n" frames.
+LINES = 'lines'
+LENGTH_PREFIXED = 'length'
+
+
+class SandboxFramingError(Exception):
+    """Raised when a frame is too long or has an invalid length header."""
+
+
+def frame(data, framing=LINES):
+    """Return `data` framed for writing to a stream using `framing`."""
+    if framing == LENGTH_PREFIXED:
+        return "%d:%s\n" % (len(data), data)
+    return data + "\n"
+
+
+class LineBuffer(OffsetBuffer):
+    """Buffer of received bytes that newline terminated lines can be popped
+    off.
+
+    A line that arrives over many reads is only scanned for its newline
+    once.
+
+    :param int max_length:
+        Longest line allowed. :meth:`pop` raises :class:`SandboxFramingError`
+        once the next line is known to be longer than this, so no more than
+        `max_length` bytes (plus the last read) are ever held waiting for
+        the end of a line.
+    :param str data:
+        Bytes to start the buffer with.
+    """
+
+    framing = LINES
+
+    def __init__(self, max_length, data=''):
+        super(LineBuffer, self).__init__(data)
+        self.max_length = max_length
+        # Bytes after the offset known not to contain a newline.
+        self._scanned = 0
+
+    def pop(self):
+        """Return the next complete line, or `None` if there isn't one."""
+        end = self._buffer.find("\n", self._offset + self._scanned)
+        if end < 0:
+            self._scanned = len(self)
+            if self._scanned > self.max_length:
+                raise SandboxFramingError(
+                    "Line longer than %d bytes." % (self.max_length,))
+            return None
+        self._scanned = 0
+        return self._take(self._offset, end, 1)
+
+    def remainder(self):
+        self._scanned = 0
+        return super(LineBuffer, self).remainder()
+
+
+class LengthPrefixedBuffer(OffsetBuffer):
+    """Buffer of received bytes that `<length>:<data>\\n` frames can be
+    popped off.
+
+    :param int max_length:
+        Longest frame allowed. :meth:`pop` raises
+        :class:`SandboxFramingError` as soon as a longer frame's header has
+        been read.
+    :param str data:
+        Bytes to start the buffer with.
+    """
+
+    framing = LENGTH_PREFIXED
+
+    # Longest acceptable length header (not including the ':').
+    MAX_HEADER_LENGTH = 20
+
+    def __init__(self, max_length, data=''):
+        super(LengthPrefixedBuffer, self).__init__(data)
+        self.max_length = max_length
+
+    def pop(self):
+        """Return the next complete frame, or `None` if there isn't one."""
+        header_end = self._buffer.find(
+            ":", self._offset, self._offset + self.MAX_HEADER_LENGTH + 1)
+        if header_end < 0:
+            if len(self) > self.MAX_HEADER_LENGTH:
+                raise SandboxFramingError("Missing length header.")
+            return None
+        header = bytes(self._buffer[self._offset:header_end])
+        if not header.isdigit():
+            raise SandboxFramingError(
+                "Invalid length header: %r" % (header,))
+        length = int(header)
+        if length > self.max_length:
+            raise SandboxFramingError(
+                "Frame longer than %d bytes." % (self.max_length,))
+        start = header_end + 1
+        end = start + length
+        # Frames end with a newline too, to keep the stream readable.
+        if len(self._buffer) <= end:
+            return None
+        if self._buffer[end] != ord("\n"):
+            raise SandboxFramingError("Frame not terminated by a newline.")
+        return self._take(start, end, 1)
+
+
+FRAME_BUFFERS = {
+    LINES: LineBuffer,
+    LENGTH_PREFIXED: LengthPrefixedBuffer,
+}
+
+
+def frame_buffer(framing, max_length, data=''):
+    """Return a buffer for reading frames framed using `framing`."""
+    if framing not in FRAME_BUFFERS:
+        raise SandboxFramingError("Unknown framing: %r" % (framing,))
+    return FRAME_BUFFERS[framing](max_length, data)
+
+
+def switch_framing(buf, framing):
+    """Return a buffer for reading whatever hasn't been popped off `buf`
+    using `framing` instead.
+    """
+    if framing == buf.framing:
+        return buf
+    return frame_buffer(framing, buf.max_length, buf.remainder())
@@ -1,15 +1,141 @@
 var vm = require('vm');
 var events = require('events');
 
+// number of compiled versions of the app code a persistent sandbox keeps
+var SCRIPT_CACHE_SIZE = 10;
 
-var SandboxApi = function () {
+
+var KvPipeline = function (api, resource) {
+    // Operations on the key-value resource named resource (e.g. a
+    // RedisResource) that are sent together as a single pipeline
+    // command. The reply has a list of results, one per operation.
+    var self = this;
+    self.commands = [];
+
+    self.get = function (key) {
+        self.commands.push({'cmd': 'get', 'key': key});
+        return self;
+    }
+
+    self.set = function (key, value) {
+        self.commands.push({'cmd': 'set', 'key': key, 'value': value});
+        return self;
+    }
+
+    self.incr = function (key, amount) {
+        var command = {'cmd': 'incr', 'key': key};
+        if (amount !== undefined) {
+            command.amount = amount;
+        }
+        self.commands.push(command);
+        return self;
+    }
+
+    self.del = function (key) {
+        self.commands.push({'cmd': 'delete', 'key': key});
+        return self;
+    }
+
+    self.send = function (callback) {
+        api.request(resource + '.pipeline', {'commands': self.commands},
+                    callback);
+    }
+}
+
+var FrameReader = function (on_frame) {
+    // Splits the data read from stdin into commands.
+    // * frames are newline terminated lines until set_framing('length')
+    //   is called, after which they're "<length>:<data>\n".
+    // * the pieces of a partial frame are only joined once the whole
+    //   frame has arrived, so large commands aren't copied on every read.
+    // * lengths are counted in characters, which are the same as bytes
+    //   because the worker only sends ASCII JSON.
+    var self = this;
+    self.framing = 'lines';
+    self.pieces = [];
+    self.received = 0;
+    self.header = "";
+    self.length = null;
+
+    self.set_framing = function (framing) {
+        self.framing = framing;
+    }
+
+    self.take_frame = function (last_piece) {
+        self.pieces.push(last_piece);
+        var data = self.pieces.join("");
+        self.pieces = [];
+        self.received = 0;
+        self.length = null;
+        return data;
+    }
+
+    self.feed = function (data) {
+        // on_frame may change the framing, which applies to the rest of
+        // data straight away.
+        while (data.length) {
+            if (self.framing == 'length') {
+                data = self.feed_length_prefixed(data);
+            }
+            else {
+                data = self.feed_lines(data);
+            }
+        }
+    }
+
+    self.feed_lines = function (data) {
+        var end = data.indexOf("\n");
+        if (end < 0) {
+            self.pieces.push(data);
+            return "";
+        }
+        var line = self.take_frame(data.slice(0, end));
+        if (line) {
+            on_frame(line);
+        }
+        return data.slice(end + 1);
+    }
+
+    self.feed_length_prefixed = function (data) {
+        if (self.length === null) {
+            var header_end = data.indexOf(":");
+            if (header_end < 0) {
+                self.header += data;
+                return "";
+            }
+            self.length = parseInt(self.header + data.slice(0, header_end),
+                                   10);
+            self.header = "";
+            data = data.slice(header_end + 1);
+        }
+        // the frame's data is followed by a newline
+        var wanted = self.length + 1 - self.received;
+        if (data.length < wanted) {
+            self.pieces.push(data);
+            self.received += data.length;
+            return "";
+        }
+        on_frame(self.take_frame(data.slice(0, wanted - 1)));
+        return data.slice(wanted);
+    }
+}
+
+var SandboxApi = function (session_id) {
     // API for use by applications
+    // * session_id is given when the API is for a single message
+    //   handled by a persistent sandbox.
     var self = this;
     self.id = 0;
+    self.session_id = session_id;
     self.waiting_requests = [];
 
     self.next_id = function () {
         self.id += 1;
+        if (self.session_id) {
+            // namespaced so that replies find their way back to the
+            // right session
+            return self.session_id + "." + self.id;
+        }
         return self.id.toString();
     }
 
@@ -17,6 +143,9 @@ var SandboxApi = function () {
         msg.cmd = command;
         msg.reply = false;
         msg.cmd_id = self.next_id();
+        if (self.session_id) {
+            msg.session_id = self.session_id;
+        }
         return msg;
     }
 
@@ -43,8 +172,25 @@ var SandboxApi = function () {
         self.request('log.info', {'msg': msg}, callback);
     }
 
+    self.kv_mget = function (resource, keys, callback) {
+        self.request(resource + '.mget', {'keys': keys}, callback);
+    }
+
+    self.kv_mset = function (resource, items, callback) {
+        self.request(resource + '.mset', {'items': items}, callback);
+    }
+
+    self.kv_pipeline = function (resource) {
+        return new KvPipeline(self, resource);
+    }
+
     self.done = function () {
-        self.request('log.info', {'_last': true, 'msg': "Done."});
+        if (self.session_id) {
+            self.request('done', {'_last': true});
+        }
+        else {
+            self.request('log.info', {'_last': true, 'msg': "Done."});
+        }
     }
 
     // handlers:
@@ -59,27 +205,33 @@ var SandboxRunner = function (api) {
 
     self.api = api;
     self.emitter = new events.EventEmitter();
-    self.chunk = "";
+    self.reader = new FrameReader(function (data) {
+        self.frame_from_stdin(data); });
+    self.output_framing = 'lines';
     self.pending_requests = {};
     self.loaded = false;
+    self.code = null;
+    // compiled code, by hash, for persistent sandboxes
+    self.scripts = {};
+    self.script_hashes = [];
+    self.fetching = {};
+    self.sessions = {};
 
     self.emitter.on('command', function (command) {
-        var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
-        var handler = api[handler_name];
-        if (!handler) {
-            handler = api.on_unknown_command;
+        if (command.session_id) {
+            self.session_command(command);
         }
-        if (handler) {
-            handler.call(self.api, command);
-            self.process_requests(api.pop_requests());
+        else {
+            self.dispatch_command(self.api, command);
         }
     });
 
     self.emitter.on('reply', function (reply) {
         var handler = self.pending_requests[reply.cmd_id];
+        delete self.pending_requests[reply.cmd_id];
         if (handler && handler.callback) {
-            handler.callback.call(self.api, reply);
-            self.process_requests(api.pop_requests());
+            handler.callback.call(handler.api, reply);
+            self.process_requests(handler.api);
         }
     });
 
@@ -87,23 +239,141 @@ var SandboxRunner = function (api) {
         process.exit(0);
     });
 
+    self.emitter.on('end_session', function (api) {
+        delete self.sessions[api.session_id];
+        // replies to the session's outstanding requests are dropped
+        for (var cmd_id in self.pending_requests) {
+            if (self.pending_requests[cmd_id].api === api) {
+                delete self.pending_requests[cmd_id];
+            }
+        }
+    });
+
+    self.dispatch_command = function (api, command) {
+        var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
+        var handler = api[handler_name];
+        if (!handler) {
+            handler = api.on_unknown_command;
+        }
+        if (handler) {
+            handler.call(api, command);
+            self.process_requests(api);
+        }
+    }
+
     self.load_code = function (command) {
         self.log("Loading sandboxed code ...");
+        self.loaded = true;
+        if (command['persistent']) {
+            // only compile the code, ready for the first message
+            self.with_code(command['code_hash'], function (code) {});
+            return;
+        }
+        self.code = self.compile(command['javascript'],
+                                 command['app_context']);
+        self.run_code(self.api, self.code);
+    }
+
+    self.compile = function (javascript, app_context) {
+        return {
+            'script': vm.createScript(javascript),
+            'app_context': app_context
+        };
+    }
+
+    self.with_code = function (code_hash, callback) {
+        // * callback is called with the compiled code for code_hash, or
+        //   with null if it can't be fetched.
+        // * code that hasn't been compiled yet is fetched from the
+        //   js resource, once no matter how many callers are waiting.
+        var code = self.scripts[code_hash];
+        if (code) {
+            callback(code);
+            return;
+        }
+        if (self.fetching[code_hash]) {
+            self.fetching[code_hash].push(callback);
+            return;
+        }
+        self.fetching[code_hash] = [callback];
+        self.api.request('js.get_code', {'code_hash': code_hash},
+            function (reply) {
+                var callbacks = self.fetching[code_hash];
+                delete self.fetching[code_hash];
+                var code = null;
+                if (reply.success) {
+                    code = self.compile(reply.javascript, reply.app_context);
+                    self.cache_code(code_hash, code);
+                }
+                else {
+                    self.log("Failed to fetch code " + code_hash + ": " +
+                             reply.reason);
+                }
+                callbacks.forEach(function (callback) { callback(code); });
+            });
+        self.process_requests(self.api);
+    }
+
+    self.cache_code = function (code_hash, code) {
+        self.scripts[code_hash] = code;
+        self.script_hashes.push(code_hash);
+        if (self.script_hashes.length > SCRIPT_CACHE_SIZE) {
+            delete self.scripts[self.script_hashes.shift()];
+        }
+    }
+
+    self.run_code = function (api, code) {
         var ctxt;
-        var loaded_module = vm.createScript(command['javascript']);
-        if (command['app_context']) {
-            eval("ctxt = " + command['app_context'] + ";");
+        if (code.app_context) {
+            eval("ctxt = " + code.app_context + ";");
         } else {
             ctxt = {};
         }
-        ctxt.api = self.api;
-        loaded_module.runInNewContext(ctxt);
-        self.loaded = true;
+        ctxt.api = api;
+        code.script.runInNewContext(ctxt);
         // process any requests created when the app module was loaded.
-        self.process_requests(api.pop_requests());
+        self.process_requests(api);
     }
 
-    self.process_requests = function (requests) {
+    self.session_command = function (command) {
+        var session = self.sessions[command.session_id];
+        if (!session) {
+            session = {'id': command.session_id, 'api': null, 'queue': []};
+            self.sessions[command.session_id] = session;
+        }
+        if (command.cmd == 'initialize') {
+            self.start_session(session, command.code_hash);
+        }
+        else if (session.api) {
+            self.dispatch_command(session.api, command);
+        }
+        else {
+            // the session's code isn't ready yet
+            session.queue.push(command);
+        }
+    }
+
+    self.start_session = function (session, code_hash) {
+        self.with_code(code_hash, function (code) {
+            // each message handled by a persistent sandbox gets an API
+            // and a context of its own
+            var api = new SandboxApi(session.id);
+            session.api = api;
+            if (!code) {
+                api.done();
+                self.process_requests(api);
+                return;
+            }
+            self.run_code(api, code);
+            var queued = session.queue.splice(0, session.queue.length);
+            queued.forEach(function (command) {
+                self.dispatch_command(api, command);
+            });
+        });
+    }
+
+    self.process_requests = function (api) {
+        var requests = api.pop_requests();
         requests.forEach(function (msg) {
             var last = msg._last;
             delete msg._last;
@@ -111,17 +381,42 @@ var SandboxRunner = function (api) {
             delete msg._callback;
             self.send_command(msg);
             if (last) {
-                self.emitter.emit('exit');
+                if (api.session_id) {
+                    self.emitter.emit('end_session', api);
+                }
+                else {
+                    self.emitter.emit('exit');
+                }
             }
-            if (callback) {
-                self.pending_requests[msg.cmd_id] = {'callback': callback};
+            else if (callback) {
+                self.pending_requests[msg.cmd_id] = {
+                    'callback': callback,
+                    'api': api
+                };
             }
         });
     }
 
     self.send_command = function (cmd) {
-        process.stdout.write(JSON.stringify(cmd));
-        process.stdout.write("\n");
+        var data = JSON.stringify(cmd);
+        if (self.output_framing == 'length') {
+            process.stdout.write(Buffer.byteLength(data) + ":" + data + "\n");
+        }
+        else {
+            process.stdout.write(data);
+            process.stdout.write("\n");
+        }
+    }
+
+    self.set_framing = function (command) {
+        // Commands from the worker use the new framing straight after
+        // its request. Ours do straight after this reply.
+        self.reader.set_framing(command.framing);
+        self.send_command({
+            'cmd': 'framing', 'cmd_id': command.cmd_id, 'reply': true,
+            'framing': command.framing
+        });
+        self.output_framing = command.framing;
     }
 
     self.log = function(msg) {
@@ -129,27 +424,26 @@ var SandboxRunner = function (api) {
         self.send_command(cmd);
     }
 
-    self.data_from_stdin = function (data) {
-        var parts = data.split("\n");
-        parts[0] = self.chunk + parts[0];
-        for (i = 0; i < parts.length - 1; i++) {
-            if (!parts[i]) {
-                continue;
-            }
-            var msg = JSON.parse(parts[i]);
-            if (!self.loaded) {
-                if (msg.cmd == 'initialize') {
-                    self.load_code(msg);
-                }
-            }
-            else if (!msg.reply) {
-                self.emitter.emit('command', msg);
-            }
-            else {
-                self.emitter.emit('reply', msg);
+    self.frame_from_stdin = function (data) {
+        var msg = JSON.parse(data);
+        if (msg.cmd == 'framing') {
+            self.set_framing(msg);
+        }
+        else if (!self.loaded) {
+            if (msg.cmd == 'initialize') {
+                self.load_code(msg);
             }
         }
-        self.chunk = parts[parts.length - 1];
+        else if (!msg.reply) {
+            self.emitter.emit('command', msg);
+        }
+        else {
+            self.emitter.emit('reply', msg);
+        }
+    }
+
+    self.data_from_stdin = function (data) {
+        self.reader.feed(data);
     }
 
     self.run = function () {
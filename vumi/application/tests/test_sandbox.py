@@ -3,18 +3,24 @@
 import os
 import sys
 import json
+import resource
 import pkg_resources
 from collections import defaultdict
 
-from twisted.internet.defer import inlineCallbacks, fail, succeed
-from twisted.internet.error import ProcessTerminated
+from twisted.internet.defer import inlineCallbacks, fail, succeed, Deferred
+from twisted.internet.task import Clock
+from twisted.internet.error import ProcessTerminated, ProcessDone
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase, SkipTest
 
-from vumi.message import TransportUserMessage, TransportEvent
+from vumi.message import TransportUserMessage, TransportEvent, Message
 from vumi.application.tests.utils import ApplicationTestCase
+from vumi.application import sandbox
 from vumi.application.sandbox import (
     Sandbox, SandboxCommand, SandboxError, RedisResource, OutboundResource,
-    JsSandboxResource, LoggingResource, HttpClientResource, JsSandbox)
+    JsSandboxResource, LoggingResource, HttpClientResource, JsSandbox,
+    SandboxPool, MultiDeferred, SandboxProtocol)
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.tests.utils import LogCatcher, PersistenceMixin
 
 
@@ -273,6 +279,488 @@ class SandboxTestCase(SandboxTestCaseBase):
         return self.echo_check('consume_delivery_report',
             self.mk_delivery_report(), 'inbound-event')
 
+    @inlineCallbacks
+    def test_pooled_sandbox(self):
+        app = yield self.setup_app(
+            "import sys, json\n"
+            "cmd = json.loads(sys.stdin.readline())\n"
+            "log = {'cmd': 'log.info', 'cmd_id': '1',\n"
+            "       'reply': False, 'msg': cmd['msg']['content']}\n"
+            "sys.stdout.write(json.dumps(log) + '\\n')\n",
+            {'pool_size': '1',
+             'sandbox': {
+                 'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+             }},
+        )
+        with LogCatcher() as lc:
+            status1 = yield app.process_message_in_sandbox(
+                self.mk_msg(content='one'))
+            status2 = yield app.process_message_in_sandbox(
+                self.mk_msg(content='two'))
+            self.assertEqual(['one', 'two'], lc.messages())
+        self.assertEqual((0, 0), (status1, status2))
+        # The second message was handled by a process started while the
+        # first one was being handled.
+        self.assertEqual((1, 1), (app.sandbox_pool.hits,
+                                  app.sandbox_pool.misses))
+
+    @inlineCallbacks
+    def test_persistent_sandbox(self):
+        app = yield self.setup_app(
+            "import sys, json\n"
+            "for line in iter(sys.stdin.readline, ''):\n"
+            "    cmd = json.loads(line)\n"
+            "    if cmd['reply']:\n"
+            "        continue\n"
+            "    sid = cmd['session_id']\n"
+            "    log = {'cmd': 'log.info', 'cmd_id': sid + '.1',\n"
+            "           'reply': False, 'session_id': sid,\n"
+            "           'msg': '%s %s' % (sid, cmd['msg']['content'])}\n"
+            "    done = {'cmd': 'done', 'cmd_id': sid + '.2',\n"
+            "            'reply': False, 'session_id': sid}\n"
+            "    sys.stdout.write(json.dumps(log) + '\\n')\n"
+            "    sys.stdout.write(json.dumps(done) + '\\n')\n"
+            "    sys.stdout.flush()\n",
+            {'pool_size': '1', 'pool_persistent': True,
+             'pool_max_messages': '10',
+             'sandbox': {
+                 'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+             }},
+        )
+        with LogCatcher() as lc:
+            status1 = yield app.process_message_in_sandbox(
+                self.mk_msg(content='one'))
+            status2 = yield app.process_message_in_sandbox(
+                self.mk_msg(content='two'))
+            msgs = lc.messages()
+        self.assertEqual((0, 0), (status1, status2))
+        self.assertEqual(['1 one'], msgs[:1])
+        self.assertTrue(msgs[1] in ('2 two', '1 two'))
+        self.assertEqual((1, 1), (app.sandbox_pool.hits,
+                                  app.sandbox_pool.misses))
+
+    @inlineCallbacks
+    def test_persistent_rlimits(self):
+        app = yield self.setup_app("", {
+            'pool_size': '1', 'pool_persistent': True,
+            'pool_max_messages': '10', 'rlimits': {'RLIMIT_CPU': [2, 3]}})
+        config = yield app.get_config(self.mk_msg())
+        rlimits = app.get_rlimits(config)
+        self.assertEqual((20, 30), rlimits[resource.RLIMIT_CPU])
+        self.assertEqual(2, app.get_session_cpu_limit(config))
+        protocol = app.create_sandbox_protocol(
+            app.create_sandbox_api(app.resources, config))
+        protocol.cancel_timeout()
+        self.assertEqual(2, protocol.session_cpu_limit)
+
+
+class FakeProcessTransport(object):
+    pid = os.getpid()
+
+    def __init__(self):
+        self.signals = []
+        self.written = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class FakeSandboxApi(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def set_sandbox(self, sandbox, session_id=None):
+        self.sandbox = sandbox
+        self.session_id = session_id
+
+    def dispatch_request(self, command):
+        self.requests.append(command)
+        return succeed(None)
+
+
+class SandboxSessionTestCase(TestCase):
+
+    def mk_protocol(self, recv_limit=1000, framing='lines', **kw):
+        protocol = SandboxProtocol('sandbox1', FakeSandboxApi(), None, {}, {},
+                                   10, recv_limit, framing, **kw)
+        protocol.transport = FakeProcessTransport()
+        self.addCleanup(protocol.processEnded, Failure(ProcessDone(0)))
+        return protocol
+
+    def line(self, session_id, cmd='log.info', **kw):
+        kw.update({'cmd': cmd, 'cmd_id': '%s.1' % (session_id,),
+                   'reply': False, 'session_id': session_id})
+        return json.dumps(kw) + "\n"
+
+    def framing_reply(self, framing):
+        return json.dumps({'cmd': 'framing', 'cmd_id': '1', 'reply': True,
+                           'framing': framing}) + "\n"
+
+    def send(self, protocol, session_id, cmd='log.info', **kw):
+        protocol.outReceived(self.line(session_id, cmd, **kw))
+
+    def test_session(self):
+        protocol = self.mk_protocol()
+        session = protocol.start_session(FakeSandboxApi())
+        self.assertEqual(session.session_id, session.api.session_id)
+        statuses = []
+        session.done().addCallback(statuses.append)
+        self.send(protocol, session.session_id, msg='hello')
+        self.send(protocol, None, msg='not in a session')
+        [command] = session.api.requests
+        self.assertEqual('hello', command['msg'])
+        self.assertEqual(1, len(protocol.api.requests))
+        self.send(protocol, session.session_id, cmd='done')
+        self.assertEqual([0], statuses)
+        self.assertEqual(1, len(session.api.requests))
+
+    def test_session_ids(self):
+        protocol = self.mk_protocol()
+        session1 = protocol.start_session(FakeSandboxApi())
+        session2 = protocol.start_session(FakeSandboxApi())
+        self.assertNotEqual(session1.session_id, session2.session_id)
+
+    def test_recv_limit_per_session(self):
+        protocol = self.mk_protocol(recv_limit=2 * len(self.line('1')))
+        session1 = protocol.start_session(FakeSandboxApi())
+        session2 = protocol.start_session(FakeSandboxApi())
+        for session in (session1, session2, session1):
+            self.send(protocol, session.session_id)
+        self.assertEqual([], protocol.transport.signals)
+        self.send(protocol, session1.session_id)
+        self.assertEqual(['KILL'], protocol.transport.signals)
+        self.assertEqual((2, 1), (len(session1.api.requests),
+                                  len(session2.api.requests)))
+
+    def test_recv_limit_outside_sessions_reset(self):
+        line = self.line(None)
+        protocol = self.mk_protocol(recv_limit=2 * len(line))
+        for i in range(3):
+            session = protocol.start_session(FakeSandboxApi())
+            protocol.outReceived(line)
+            protocol.errReceived("oops\n")
+            self.send(protocol, session.session_id, cmd='done')
+        self.assertEqual(3, len(self.flushLoggedErrors(SandboxError)))
+        self.assertEqual([], protocol.transport.signals)
+        protocol.outReceived(line * 3)
+        self.assertEqual(['KILL'], protocol.transport.signals)
+
+    def test_session_cpu_limit(self):
+        cpu_times = [10.0]
+        self.patch(sandbox, 'get_process_cpu_time', lambda pid: cpu_times[0])
+        protocol = self.mk_protocol(session_cpu_limit=2)
+        session1 = protocol.start_session(FakeSandboxApi())
+        self.assertEqual(10.0, session1.cpu_start)
+        self.assertTrue(session1.cpu_task.active())
+        cpu_times[0] = 11.5
+        protocol._check_session_cpu(session1)
+        self.assertTrue(session1.cpu_task.active())
+        self.send(protocol, session1.session_id, cmd='done')
+        self.assertEqual(None, session1.cpu_task)
+
+        # Only CPU time used since the session started counts.
+        session2 = protocol.start_session(FakeSandboxApi())
+        cpu_times[0] = 13.5
+        protocol._check_session_cpu(session2)
+        self.assertEqual([], protocol.transport.signals)
+        cpu_times[0] = 14
+        protocol._check_session_cpu(session2)
+        self.assertEqual(['KILL'], protocol.transport.signals)
+        self.assertEqual(None, session2.cpu_task)
+
+    def test_no_session_cpu_limit(self):
+        protocol = self.mk_protocol()
+        session = protocol.start_session(FakeSandboxApi())
+        self.assertEqual(None, session.cpu_task)
+
+    def test_get_process_cpu_time(self):
+        cpu_time = sandbox.get_process_cpu_time(os.getpid())
+        if cpu_time is None:
+            raise SkipTest("/proc/<pid>/stat not available.")
+        self.assertTrue(cpu_time >= 0)
+        self.assertEqual(None, sandbox.get_process_cpu_time(-1))
+
+    def test_unterminated_line(self):
+        protocol = self.mk_protocol(recv_limit=10)
+        protocol.outReceived("x" * 11)
+        self.assertEqual(['KILL'], protocol.transport.signals)
+
+    def test_process_ended(self):
+        protocol = self.mk_protocol()
+        session = protocol.start_session(FakeSandboxApi())
+        statuses = []
+        session.done().addCallback(statuses.append)
+        protocol.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual([0], statuses)
+
+    def test_lines_split_across_reads(self):
+        protocol = self.mk_protocol()
+        data = self.line(None, msg='one') + self.line(None, msg='two')
+        for i in range(0, len(data), 7):
+            protocol.outReceived(data[i:i + 7])
+        self.assertEqual(['one', 'two'],
+                         [command['msg'] for command in protocol.api.requests])
+
+    def test_unterminated_last_line(self):
+        protocol = self.mk_protocol()
+        protocol.outReceived(self.line(None, msg='last').rstrip("\n"))
+        self.assertEqual([], protocol.api.requests)
+        protocol.outConnectionLost()
+        [command] = protocol.api.requests
+        self.assertEqual('last', command['msg'])
+
+    def test_length_prefixed_framing(self):
+        protocol = self.mk_protocol(framing='length')
+        protocol.connectionMade()
+        [request] = protocol.transport.written
+        command = SandboxCommand.from_json(request)
+        self.assertEqual(('framing', 'length'),
+                         (command['cmd'], command['framing']))
+        self.assertTrue(request.endswith("\n"))
+        # Commands to the sandbox are framed straight after the request.
+        protocol.send(SandboxCommand(cmd='log.info', cmd_id='1'))
+        data = protocol.transport.written[-1]
+        length, _, rest = data.partition(":")
+        self.assertEqual(int(length) + 1, len(rest))
+        # Commands from the sandbox are framed after its reply.
+        reply = self.framing_reply('length')
+        body = self.line(None, msg='framed').rstrip("\n")
+        framed = "%d:%s\n" % (len(body), body)
+        protocol.outReceived(reply + framed[:5])
+        self.assertEqual([], protocol.api.requests)
+        protocol.outReceived(framed[5:])
+        [command] = protocol.api.requests
+        self.assertEqual('framed', command['msg'])
+
+    def test_bad_length_header(self):
+        protocol = self.mk_protocol(framing='length')
+        protocol.outReceived(self.framing_reply('length'))
+        protocol.outReceived("abc:{}\n")
+        self.assertEqual(['KILL'], protocol.transport.signals)
+
+
+class SandboxCommandTestCase(TestCase):
+
+    def test_from_json(self):
+        data = json.dumps({'cmd': 'log.info', 'cmd_id': '1', 'reply': False,
+                           'msg': {'text': 'hello'}})
+        command = SandboxCommand.from_json(data)
+        self.assertEqual(Message.from_json(data).payload, command.payload)
+        self.assertEqual({'text': 'hello'}, command['msg'])
+
+    def test_from_json_timestamp(self):
+        msg = TransportUserMessage(to_addr='123', from_addr='456',
+                                   transport_name='test',
+                                   transport_type='sms')
+        command = SandboxCommand(cmd='outbound.reply_to', msg=msg.payload)
+        decoded = SandboxCommand.from_json(command.to_json())
+        self.assertEqual(msg['timestamp'], decoded['msg']['timestamp'])
+
+
+class FakeSandboxProtocol(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.transport = FakeProcessTransport()
+        self.killed = False
+        self.timeout_running = True
+        self._done = MultiDeferred()
+
+    def done(self):
+        return self._done.get()
+
+    def kill(self):
+        self.killed = True
+        self._done.callback(None)
+
+    def start_timeout(self):
+        self.timeout_running = True
+
+    def cancel_timeout(self):
+        self.timeout_running = False
+
+
+class SandboxPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.starting = []
+
+    def start_now(self, config):
+        return FakeSandboxProtocol(config)
+
+    def start_later(self, config):
+        d = Deferred()
+        self.starting.append((d, config))
+        return d
+
+    def finish_start(self):
+        d, config = self.starting.pop(0)
+        protocol = FakeSandboxProtocol(config)
+        d.callback(protocol)
+        return protocol
+
+    def mk_pool(self, start_func=None, **kw):
+        kw.setdefault('clock', self.clock)
+        return SandboxPool(start_func or self.start_now, **kw)
+
+    def acquire(self, pool, key='app1', config='config1'):
+        acquired = []
+        pool.acquire(key, config).addCallback(acquired.append)
+        return acquired
+
+    def test_miss_then_hit(self):
+        pool = self.mk_pool(self.start_later)
+        acquired = self.acquire(pool)
+        # One process for this message and one to keep warm.
+        self.assertEqual(2, len(self.starting))
+        self.assertEqual((0, 1), (pool.hits, pool.misses))
+        protocol = self.finish_start()
+        self.assertEqual([protocol], acquired)
+        self.assertTrue(protocol.timeout_running)
+        warm = self.finish_start()
+        self.assertFalse(warm.timeout_running)
+        self.assertEqual(1, pool.idle_count('app1'))
+
+        self.assertEqual([warm], self.acquire(pool))
+        self.assertTrue(warm.timeout_running)
+        self.assertEqual((1, 1), (pool.hits, pool.misses))
+        self.assertEqual(['config1'], [c for d, c in self.starting])
+
+    def test_wait_for_starting_process(self):
+        pool = self.mk_pool(self.start_later)
+        self.acquire(pool)
+        self.finish_start()
+        # The warm process is still starting, so we wait for it.
+        acquired = self.acquire(pool)
+        self.assertEqual((1, 1), (pool.hits, pool.misses))
+        self.assertEqual(2, len(self.starting))
+        self.assertEqual([self.finish_start()], acquired)
+
+    def test_keys(self):
+        pool = self.mk_pool()
+        [protocol1] = self.acquire(pool, 'app1', 'config1')
+        [protocol2] = self.acquire(pool, 'app2', 'config2')
+        self.assertEqual(('config1', 'config2'),
+                         (protocol1.config, protocol2.config))
+        self.assertEqual(1, pool.idle_count('app1'))
+        self.assertEqual(1, pool.idle_count('app2'))
+
+    def test_release(self):
+        pool = self.mk_pool(warm_size=0, max_messages=2)
+        [protocol] = self.acquire(pool)
+        pool.release('app1', protocol)
+        self.assertFalse(protocol.killed)
+        self.assertEqual([protocol], self.acquire(pool))
+        pool.release('app1', protocol)
+        # It has handled max_messages messages.
+        self.assertTrue(protocol.killed)
+        self.assertEqual(0, pool.idle_count())
+
+    def test_release_max_rss(self):
+        pool = self.mk_pool(warm_size=0, max_messages=10, max_rss=1)
+        [protocol] = self.acquire(pool)
+        pool.release('app1', protocol)
+        self.assertTrue(protocol.killed)
+
+    def test_release_ended(self):
+        pool = self.mk_pool(warm_size=0, max_messages=10)
+        [protocol] = self.acquire(pool)
+        protocol.kill()
+        pool.release('app1', protocol)
+        self.assertEqual(0, pool.idle_count())
+
+    def test_idle_eviction(self):
+        pool = self.mk_pool(max_idle=10)
+        self.acquire(pool)
+        [warm] = pool._idle['app1']
+        self.clock.advance(10)
+        self.assertTrue(warm.killed)
+        self.assertEqual(0, pool.idle_count())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_idle_process_ends(self):
+        pool = self.mk_pool()
+        self.acquire(pool)
+        [warm] = pool._idle['app1']
+        warm.kill()
+        self.assertEqual(0, pool.idle_count())
+
+    def test_start_failure(self):
+        pool = self.mk_pool(self.start_later, warm_size=0)
+        failures = []
+        pool.acquire('app1', 'config1').addErrback(failures.append)
+        d, config = self.starting.pop()
+        d.errback(ValueError("no sandbox for you"))
+        [failure] = failures
+        failure.trap(ValueError)
+
+    @inlineCallbacks
+    def test_stop(self):
+        pool = self.mk_pool(warm_size=2)
+        [protocol] = self.acquire(pool)
+        idle = list(pool._idle['app1'])
+        yield pool.stop()
+        self.assertEqual([True, True], [p.killed for p in idle])
+        self.assertEqual(0, pool.idle_count())
+        pool.release('app1', protocol)
+        self.assertTrue(protocol.killed)
+
+    def test_stop_waits_for_starting(self):
+        pool = self.mk_pool(self.start_later)
+        self.acquire(pool)
+        self.finish_start()
+        stopped = []
+        pool.stop().addCallback(stopped.append)
+        self.assertEqual([], stopped)
+        protocol = self.finish_start()
+        self.assertTrue(protocol.killed)
+        self.assertEqual(1, len(stopped))
+
+    def test_concurrency(self):
+        pool = self.mk_pool(self.start_later, warm_size=0, concurrency=2,
+                            max_messages=10)
+        acquired1 = self.acquire(pool)
+        acquired2 = self.acquire(pool)
+        # Both messages wait for the same process.
+        self.assertEqual(1, len(self.starting))
+        protocol = self.finish_start()
+        self.assertEqual(([protocol], [protocol]), (acquired1, acquired2))
+        self.assertEqual(0, pool.idle_count())
+        pool.release('app1', protocol)
+        # It can take another message, but is still busy.
+        self.assertEqual(1, pool.idle_count())
+        self.assertTrue(protocol.timeout_running)
+        self.assertEqual([protocol], self.acquire(pool))
+        self.assertEqual(0, pool.idle_count())
+
+    def test_concurrency_retire(self):
+        pool = self.mk_pool(warm_size=0, concurrency=2, max_messages=2)
+        [protocol] = self.acquire(pool)
+        self.assertEqual([protocol], self.acquire(pool))
+        pool.release('app1', protocol)
+        # It's still handling a message.
+        self.assertFalse(protocol.killed)
+        pool.release('app1', protocol)
+        self.assertTrue(protocol.killed)
+
+    def test_metrics(self):
+        pool = self.mk_pool(self.start_later)
+        mm = MetricManager("vumi.test.")
+        pool.register_metrics(mm)
+        self.acquire(pool)
+        self.finish_start()
+        self.finish_start()
+        self.acquire(pool)
+        [(_, hits)] = mm['sandbox_pool.hits'].poll()
+        [(_, misses)] = mm['sandbox_pool.misses'].poll()
+        self.assertEqual((1.0, 1.0), (hits, misses))
+        self.assertEqual(2, len(mm['sandbox_pool.spawn_time'].poll()))
+
 
 class JsSandboxTestCase(SandboxTestCaseBase):
 
@@ -313,6 +801,30 @@ class JsSandboxTestCase(SandboxTestCaseBase):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_length_prefixed(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            'framing': 'length',
+        })
+
+        with LogCatcher() as lc:
+            status = yield app.process_message_in_sandbox(self.mk_msg())
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual(status, 0)
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+
     @inlineCallbacks
     def test_js_sandboxer_with_app_context(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
@@ -336,6 +848,46 @@ class JsSandboxTestCase(SandboxTestCaseBase):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_persistent(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            'pool_size': '1', 'pool_persistent': True,
+            'pool_max_messages': '10',
+        })
+
+        with LogCatcher() as lc:
+            status1 = yield app.process_message_in_sandbox(self.mk_msg())
+            status2 = yield app.process_message_in_sandbox(self.mk_msg())
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual((0, 0), (status1, status2))
+        # Each message runs the app code in a context of its own.
+        for msg in ['From init!', 'From command: inbound-message',
+                    'Log successful: true']:
+            self.assertEqual(2, msgs.count(msg))
+
+    @inlineCallbacks
+    def test_code_cache(self):
+        app = yield self.setup_app("api.x = 1;", extra_config={
+            'pool_size': '1', 'pool_persistent': True,
+        })
+        config = yield app.get_config(self.mk_msg())
+        self.assertEqual('sandbox1', app.sandbox_pool_key(config))
+        api = app.create_sandbox_api(app.resources, config)
+        DummyAppWorker.DummyProtocol('sandbox1', api)
+        code_hash = app.code_hash_for_api(api)
+        self.assertEqual(app.code_hash("api.x = 1;", None), code_hash)
+        self.assertEqual(("api.x = 1;", None),
+                         app.code_for_hash(api, code_hash))
+        self.assertEqual(None, app.code_for_hash(api, 'unknown'))
+        other_api = app.create_sandbox_api(app.resources, config)
+        DummyAppWorker.DummyProtocol('sandbox2', other_api)
+        self.assertEqual(None, app.code_for_hash(other_api, code_hash))
+
 
 class DummyAppWorker(object):
 
@@ -516,6 +1068,84 @@ class TestRedisResource(ResourceTestCaseBase, PersistenceMixin):
         self.check_reply(reply, success=False, reason='Too many keys')
         yield self.check_metric('bar', None, 100)
 
+    @inlineCallbacks
+    def test_handle_mget(self):
+        yield self.create_metric('foo', json.dumps({'a': 1}))
+        reply = yield self.dispatch_command('mget', keys=['foo', 'bar'])
+        self.check_reply(reply, success=True, values=[{'a': 1}, None])
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        yield self.create_metric('foo', json.dumps(1))
+        reply = yield self.dispatch_command('mset',
+                                            items={'foo': 2, 'bar': 3})
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps(2), 2)
+        yield self.check_metric('bar', json.dumps(3), 2)
+
+    @inlineCallbacks
+    def test_handle_mset_too_many_keys(self):
+        yield self.create_metric('foo', json.dumps(1), total_count=99)
+        reply = yield self.dispatch_command('mset',
+                                            items={'bar': 2, 'baz': 3})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        # None of the batch is written.
+        yield self.check_metric('bar', None, 99)
+        yield self.check_metric('baz', None, 99)
+
+    @inlineCallbacks
+    def test_handle_pipeline(self):
+        yield self.create_metric('foo', json.dumps(1))
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'get', 'key': 'foo'},
+            {'cmd': 'set', 'key': 'bar', 'value': 'a'},
+            {'cmd': 'incr', 'key': 'baz', 'amount': 2},
+            {'cmd': 'delete', 'key': 'foo'},
+            {'cmd': 'delete', 'key': 'quux'},
+        ])
+        self.check_reply(reply, success=True,
+                         results=[1, True, 2, True, False])
+        yield self.check_metric('foo', None, 2)
+        yield self.check_metric('bar', json.dumps('a'), 2)
+
+    @inlineCallbacks
+    def test_handle_pipeline_failure(self):
+        yield self.create_metric('foo', 'a')
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'set', 'key': 'bar', 'value': 'a'},
+            {'cmd': 'incr', 'key': 'foo'},
+            {'cmd': 'set', 'key': 'baz', 'value': 'b'},
+        ])
+        self.check_reply(reply, success=False)
+        self.assertTrue(reply['reason'])
+        # The quota reserved for the batch is given back, except for keys
+        # written before the failure.
+        written = 0
+        for key in ('bar', 'baz'):
+            if (yield self.r_server.exists('sandboxes#test_id#' + key)):
+                written += 1
+        self.assertEqual(str(1 + written),
+                         (yield self.r_server.get('count#test_id')))
+
+    @inlineCallbacks
+    def test_handle_mget_failure(self):
+        self.resource.run_batch = lambda *a: fail(ValueError("oops"))
+        reply = yield self.dispatch_command('mget', keys=['foo'])
+        self.check_reply(reply, success=False, reason=u'oops')
+
+    @inlineCallbacks
+    def test_handle_mset_failure(self):
+        self.resource.run_batch = lambda *a: fail(ValueError("oops"))
+        reply = yield self.dispatch_command('mset', items={'foo': 1})
+        self.check_reply(reply, success=False, reason=u'oops')
+
+    @inlineCallbacks
+    def test_handle_pipeline_unknown_command(self):
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'flushall'}])
+        self.check_reply(reply, success=False)
+        self.assertTrue(reply['reason'])
+
 
 class TestOutboundResource(ResourceTestCaseBase):
 
@@ -584,6 +1214,28 @@ class TestJsSandboxResource(ResourceTestCaseBase):
                                                javascript='testscript',
                                                app_context='appcontext')])
 
+    def test_sandbox_init_persistent(self):
+        msgs = []
+        self.api.sandbox_send = lambda msg: msgs.append(msg)
+        self.app_worker.persistent_for_api = lambda api: True
+        self.app_worker.code_hash_for_api = lambda api: 'hash1'
+        self.resource.sandbox_init(self.api)
+        self.assertEqual(msgs, [SandboxCommand(cmd='initialize',
+                                               cmd_id=msgs[0]['cmd_id'],
+                                               persistent=True,
+                                               code_hash='hash1')])
+
+    @inlineCallbacks
+    def test_handle_get_code(self):
+        code = {'hash1': ('testscript', 'appcontext')}
+        self.app_worker.code_for_hash = lambda api, h: code.get(h)
+        reply = yield self.dispatch_command('get_code', code_hash='hash1')
+        self.assertEqual(reply['success'], True)
+        self.assertEqual((reply['javascript'], reply['app_context']),
+                         code['hash1'])
+        reply = yield self.dispatch_command('get_code', code_hash='hash2')
+        self.assertEqual(reply['success'], False)
+
 
 class TestLoggingResource(ResourceTestCaseBase):
 
@@ -0,0 +1,107 @@
+"""Tests for vumi.application.sandbox_framing."""
+
+from twisted.trial import unittest
+
+from vumi.application.sandbox_framing import (
+    LineBuffer, LengthPrefixedBuffer, SandboxFramingError, frame,
+    frame_buffer, switch_framing, LINES, LENGTH_PREFIXED)
+
+
+class FrameTestCase(unittest.TestCase):
+
+    def test_lines(self):
+        self.assertEqual('{}\n', frame('{}'))
+        self.assertEqual('{}\n', frame('{}', LINES))
+
+    def test_length_prefixed(self):
+        self.assertEqual('2:{}\n', frame('{}', LENGTH_PREFIXED))
+
+
+class FrameBufferTestCase(unittest.TestCase):
+
+    def test_pop_empty(self):
+        self.assertEqual(None, LineBuffer(100).pop())
+
+    def test_pop_lines(self):
+        buf = LineBuffer(100)
+        buf.feed('one\ntwo\nthr')
+        self.assertEqual(['one', 'two'], list(buf))
+        buf.feed('ee\n')
+        self.assertEqual('three', buf.pop())
+        self.assertEqual(None, buf.pop())
+        self.assertEqual(0, len(buf))
+
+    def test_line_too_long(self):
+        buf = LineBuffer(10)
+        buf.feed('x' * 10)
+        self.assertEqual(None, buf.pop())
+        buf.feed('x')
+        self.assertRaises(SandboxFramingError, buf.pop)
+
+    def test_pop_length_prefixed(self):
+        data = frame('one\ntwo', LENGTH_PREFIXED)
+        buf = LengthPrefixedBuffer(100)
+        for byte in data[:-1]:
+            buf.feed(byte)
+            self.assertEqual(None, buf.pop())
+        buf.feed(data[-1])
+        self.assertEqual('one\ntwo', buf.pop())
+        self.assertEqual(None, buf.pop())
+        buf.feed(frame('', LENGTH_PREFIXED) + frame('three', LENGTH_PREFIXED))
+        self.assertEqual(['', 'three'], list(buf))
+
+    def test_frame_too_long(self):
+        buf = LengthPrefixedBuffer(10)
+        buf.feed('11:')
+        self.assertRaises(SandboxFramingError, buf.pop)
+
+    def test_invalid_length_header(self):
+        buf = LengthPrefixedBuffer(10)
+        buf.feed('-1:\n')
+        self.assertRaises(SandboxFramingError, buf.pop)
+        buf = LengthPrefixedBuffer(10)
+        buf.feed('1' * 21)
+        self.assertRaises(SandboxFramingError, buf.pop)
+
+    def test_missing_newline(self):
+        buf = LengthPrefixedBuffer(10)
+        buf.feed('2:{}x')
+        self.assertRaises(SandboxFramingError, buf.pop)
+
+    def test_switch_framing(self):
+        buf = LineBuffer(100)
+        buf.feed('switch\n' + frame('a\nb', LENGTH_PREFIXED))
+        self.assertEqual('switch', buf.pop())
+        buf = switch_framing(buf, LENGTH_PREFIXED)
+        self.assertEqual(LENGTH_PREFIXED, buf.framing)
+        self.assertEqual(100, buf.max_length)
+        self.assertEqual('a\nb', buf.pop())
+        self.assertEqual(None, buf.pop())
+        self.assertTrue(switch_framing(buf, LENGTH_PREFIXED) is buf)
+        self.assertRaises(SandboxFramingError, switch_framing, buf, 'unknown')
+
+    def test_frame_buffer(self):
+        self.assertTrue(isinstance(frame_buffer(LINES, 10), LineBuffer))
+        buf = frame_buffer(LENGTH_PREFIXED, 10, '2:{}\n')
+        self.assertTrue(isinstance(buf, LengthPrefixedBuffer))
+        self.assertEqual('{}', buf.pop())
+        self.assertRaises(SandboxFramingError, frame_buffer, 'unknown', 10)
+
+    def test_compaction(self):
+        buf = LineBuffer(100)
+        for i in range(100):
+            buf.feed('line\nli')
+            self.assertEqual('line', buf.pop())
+            buf.feed('ne\n')
+            self.assertEqual('line', buf.pop())
+        # Consumed data doesn't pile up.
+        self.assertTrue(len(buf._buffer) <= 20)
+
+    def test_remainder(self):
+        buf = LineBuffer(100)
+        buf.feed('one\ntw')
+        self.assertEqual('one', buf.pop())
+        self.assertEqual('tw', buf.remainder())
+        self.assertEqual(0, len(buf))
+        buf.feed('three\n')
+        self.assertEqual('three', buf.pop())
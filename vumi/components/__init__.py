@@ -1,7 +1,9 @@
 """Various useful components."""
 
-__all__ = ["MessageStore", "SessionManager", "TagpoolManager"]
+__all__ = ["MessageStore", "SessionManager", "TagpoolManager",
+           "EventRoutingStore"]
 
 from vumi.components.message_store import MessageStore
 from vumi.components.session import SessionManager
 from vumi.components.tagpool import TagpoolManager
+from vumi.components.event_routing import EventRoutingStore
@@ -0,0 +1,147 @@
+# -*- test-case-name: vumi.components.tests.test_event_routing -*-
+
+"""Remembering where outbound messages came from, to route their events."""
+
+from collections import OrderedDict
+
+from twisted.internet.defer import succeed, inlineCallbacks, returnValue
+
+from vumi import log
+from vumi.persist.write_behind import WriteBehind
+
+
+class EventRoutingStore(object):
+    """Maps outbound message ids to the name of the endpoint that sent them,
+    so that acks and delivery reports can be routed back.
+
+    Recently used mappings are kept in an in-process LRU cache, so events
+    that arrive soon after their message was sent don't touch Redis at all.
+    New mappings are written to Redis in batches (a single pipelined round
+    trip every `flush_interval` seconds, or sooner once `flush_size` of them
+    have built up).
+
+    In Redis, mappings are stored as fields of one hash per `bucket_size`
+    seconds rather than as a key per message. Each hash expires as a whole,
+    once the newest mapping in it is `expiry` seconds old, so mappings are
+    kept for at least `expiry` seconds and at most `expiry + bucket_size`.
+
+    Mappings that haven't been flushed yet are only visible to this process,
+    so workers that share routing memory should keep `flush_interval` short.
+
+    :param redis:
+        Redis manager to persist to.
+    :param int expiry:
+        Minimum number of seconds to remember each mapping for.
+    :param int bucket_size:
+        Number of seconds of mappings to put in each Redis hash.
+    :param float flush_interval:
+        Maximum number of seconds a new mapping is held in memory before it
+        is written to Redis.
+    :param int flush_size:
+        Number of buffered mappings that triggers an immediate flush.
+    :param int cache_size:
+        Number of mappings to keep in the in-process cache.
+    :param clock:
+        Something providing `callLater` and `seconds`. Defaults to the
+        reactor.
+    """
+
+    KEY_PREFIX = "event_routes"
+
+    def __init__(self, redis, expiry=60 * 60 * 24 * 7, bucket_size=60 * 60,
+                 flush_interval=1.0, flush_size=100, cache_size=10000,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.redis = redis
+        self.expiry = int(expiry)
+        self.bucket_size = int(bucket_size)
+        self.cache_size = cache_size
+        self.clock = clock
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._writer = WriteBehind(
+            self._write, self._pending_count, flush_interval=flush_interval,
+            flush_size=flush_size, clock=clock)
+
+    def bucket_key(self, bucket):
+        return "%s:%d" % (self.KEY_PREFIX, bucket)
+
+    def current_bucket(self):
+        return int(self.clock.seconds() // self.bucket_size)
+
+    def live_buckets(self):
+        """Return the buckets that may still hold mappings, newest first."""
+        current = self.current_bucket()
+        count = -(-self.expiry // self.bucket_size) + 1
+        return range(current, current - count, -1)
+
+    def _cache_put(self, message_id, name):
+        self._cache.pop(message_id, None)
+        self._cache[message_id] = name
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def remember(self, message_id, name):
+        """Remember that the message `message_id` was sent by `name`."""
+        self._cache_put(message_id, name)
+        self._pending[message_id] = name
+        self._writer.changed()
+
+    def lookup(self, message_id):
+        """Return a deferred that fires with the name remembered for
+        `message_id`, or `None` if there isn't one.
+        """
+        name = self._cache.pop(message_id, None)
+        if name is None:
+            name = self._pending.get(message_id)
+        if name is not None:
+            self._cache[message_id] = name
+            return succeed(name)
+        return self._lookup_redis(message_id)
+
+    @inlineCallbacks
+    def _lookup_redis(self, message_id):
+        pipe = self.redis.pipeline()
+        for bucket in self.live_buckets():
+            pipe.hget(self.bucket_key(bucket), message_id)
+        for name in (yield pipe.execute()):
+            if name is not None:
+                self._cache_put(message_id, name)
+                returnValue(name)
+        returnValue(None)
+
+    def _pending_count(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all buffered mappings to Redis in a single round trip.
+
+        Returns a deferred that fires once the mappings have been written.
+        Only one write is ever in progress, mappings added while it is
+        running are written by the next one.
+        """
+        return self._writer.flush()
+
+    def _write(self):
+        pending, self._pending = self._pending, {}
+        bucket = self.current_bucket()
+        rkey = self.bucket_key(bucket)
+        ttl = (bucket + 1) * self.bucket_size + self.expiry
+        pipe = self.redis.pipeline()
+        pipe.hmset(rkey, pending)
+        pipe.expire(rkey, int(ttl - self.clock.seconds()))
+
+        d = pipe.execute()
+        d.addErrback(self._flush_failed, pending)
+        return d
+
+    def _flush_failed(self, failure, pending):
+        log.err(failure, "Failed to write event routing memory to Redis.")
+        for message_id, name in pending.iteritems():
+            self._pending.setdefault(message_id, name)
+
+    def stop(self):
+        """Cancel any scheduled flush and write out what is left."""
+        return self._writer.stop()
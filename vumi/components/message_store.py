@@ -5,7 +5,9 @@
 
 from uuid import uuid4
 
-from twisted.internet.defer import returnValue, inlineCallbacks
+from twisted.internet.defer import (
+    returnValue, inlineCallbacks, Deferred, DeferredList)
+from twisted.python.failure import Failure
 
 from vumi.message import TransportEvent, TransportUserMessage
 from vumi.persist.model import Model, Manager
@@ -76,6 +78,170 @@ class InboundMessage(Model):
     batch = ForeignKey(Batch, null=True)
 
 
+class MessageStoreReconciler(object):
+    """
+    Rebuilds the Redis cache for a batch from the messages and events stored
+    in Riak.
+
+    Message keys are sorted and streamed through the Riak manager's
+    `load_all_bunches` with up to `concurrency` bunches in flight at once.
+    Each loaded bunch is written to the cache with the bulk
+    `MessageStoreCache` operations and then checkpointed, so an interrupted
+    reconciliation can be resumed from the last completed bunch. If a bunch
+    fails, reconciliation stops without moving the checkpoint past it.
+
+    :param MessageStore store:
+        The message store whose cache should be reconciled.
+    :param str batch_id:
+        The batch to reconcile.
+    :param int concurrency:
+        The maximum number of bunch loads to have in flight at once.
+        Defaults to DEFAULT_CONCURRENCY.
+    :param callable progress_callback:
+        Called as `progress_callback(direction, processed, total)` after each
+        bunch has been written to the cache.
+    """
+
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, store, batch_id, concurrency=None,
+                 progress_callback=None):
+        self.store = store
+        self.cache = store.cache
+        self.manager = store.manager
+        self.batch_id = batch_id
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.progress_callback = progress_callback
+
+    @Manager.calls_manager
+    def reconcile(self, resume=False):
+        """
+        Reconcile the inbound and outbound caches (including events).
+
+        :param bool resume:
+            If True, keep the existing cache contents and continue from the
+            last checkpoint. Otherwise the batch's cache is cleared and
+            rebuilt from scratch.
+        """
+        if not resume:
+            yield self.cache.clear_batch(self.batch_id)
+        yield self.cache.batch_start(self.batch_id)
+        yield self.reconcile_inbound()
+        yield self.reconcile_outbound()
+        yield self.cache.clear_reconcile_checkpoints(self.batch_id)
+
+    @Manager.calls_manager
+    def reconcile_inbound(self):
+        keys = yield self.store.batch_inbound_keys(self.batch_id)
+        yield self._reconcile_messages(
+            'inbound', InboundMessage, keys, self._process_inbound_bunch)
+
+    @Manager.calls_manager
+    def reconcile_outbound(self):
+        keys = yield self.store.batch_outbound_keys(self.batch_id)
+        yield self._reconcile_messages(
+            'outbound', OutboundMessage, keys, self._process_outbound_bunch)
+
+    @Manager.calls_manager
+    def _reconcile_messages(self, direction, model, keys, process_bunch):
+        keys = sorted(keys)
+        checkpoint = yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, direction)
+        if checkpoint is not None:
+            keys = [key for key in keys if key > checkpoint]
+
+        total, processed = len(keys), 0
+        log.msg("Reconciling %s %s messages for batch %s." % (
+            total, direction, self.batch_id))
+
+        # Bunch loads start as soon as they're pulled off the iterator, so
+        # keeping `concurrency` of them pulled keeps that many in flight.
+        bunches = self._iter_bunches(model, keys)
+        pending = []
+        while True:
+            for last_key, bunch_size, bunch in bunches:
+                pending.append((last_key, bunch_size, bunch))
+                if len(pending) >= self.concurrency:
+                    break
+            if not pending:
+                break
+
+            last_key, bunch_size, bunch = pending.pop(0)
+            try:
+                records = yield bunch
+                yield process_bunch(records)
+            except Exception:
+                failure = Failure()
+                yield self._abandon_bunches(b for _, _, b in pending)
+                failure.raiseException()
+            yield self.cache.set_reconcile_checkpoint(
+                self.batch_id, direction, last_key)
+
+            processed += bunch_size
+            if self.progress_callback is not None:
+                self.progress_callback(direction, processed, total)
+
+    def _abandon_bunches(self, bunches):
+        """Wait for bunch loads we no longer need, ignoring their results."""
+        deferreds = [bunch for bunch in bunches if isinstance(bunch, Deferred)]
+        if deferreds:
+            return DeferredList(deferreds, consumeErrors=True)
+
+    def _iter_bunches(self, model, keys):
+        """
+        Yield `(last_key, bunch_size, bunch)` tuples for each bunch of keys,
+        where `bunch` is the (possibly deferred) list of loaded records.
+        """
+        bunch_size = self.manager.load_bunch_size
+        for i in xrange(0, len(keys), bunch_size):
+            bunch_keys = keys[i:i + bunch_size]
+            for bunch in self.manager.load_all_bunches(model, bunch_keys):
+                yield bunch_keys[-1], len(bunch_keys), bunch
+
+    def _process_inbound_bunch(self, records):
+        return self.cache.add_inbound_messages(
+            self.batch_id, [record.msg for record in records])
+
+    @Manager.calls_manager
+    def _process_outbound_bunch(self, records):
+        yield self.cache.add_outbound_messages(
+            self.batch_id, [record.msg for record in records])
+
+        # Start all the event key lookups for this bunch before waiting on
+        # any of them.
+        lookups = [self.store.message_event_keys(record.key)
+                   for record in records]
+        event_keys = []
+        for lookup in lookups:
+            event_keys.extend((yield lookup))
+        yield self.reconcile_events(event_keys)
+
+    @Manager.calls_manager
+    def reconcile_events(self, event_keys):
+        """
+        Load the events for the given keys in bunches (up to `concurrency`
+        at once) and add them to the cache.
+        """
+        bunches = iter(self.manager.load_all_bunches(Event, event_keys))
+        pending = []
+        while True:
+            for bunch in bunches:
+                pending.append(bunch)
+                if len(pending) >= self.concurrency:
+                    break
+            if not pending:
+                break
+
+            try:
+                records = yield pending.pop(0)
+                yield self.cache.add_events(
+                    self.batch_id, [record.event for record in records])
+            except Exception:
+                failure = Failure()
+                yield self._abandon_bunches(pending)
+                failure.raiseException()
+
+
 class MessageStore(object):
     """Vumi message store.
 
@@ -123,42 +289,41 @@ class MessageStore(object):
 
         returnValue(False)
 
-    @Manager.calls_manager
-    def reconcile_cache(self, batch_id):
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_inbound_cache(batch_id)
-        yield self.reconcile_outbound_cache(batch_id)
+    def reconciler(self, batch_id, concurrency=None, progress_callback=None):
+        """
+        Return a :class:`MessageStoreReconciler` for the given batch_id.
+        """
+        return MessageStoreReconciler(self, batch_id, concurrency=concurrency,
+                                      progress_callback=progress_callback)
+
+    def reconcile_cache(self, batch_id, resume=False, concurrency=None,
+                        progress_callback=None):
+        """
+        Rebuild the cache for a batch_id from what's stored in Riak.
+
+        :param bool resume:
+            Continue an interrupted reconciliation from its last checkpoint
+            instead of clearing the cache and starting over.
+        :param int concurrency:
+            How many bunches of messages to load in parallel.
+        :param callable progress_callback:
+            Called as `progress_callback(direction, processed, total)` as
+            bunches of messages are written to the cache.
+        """
+        reconciler = self.reconciler(batch_id, concurrency=concurrency,
+                                     progress_callback=progress_callback)
+        return reconciler.reconcile(resume=resume)
 
-    @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+        return self.reconciler(batch_id).reconcile_inbound()
 
-    @Manager.calls_manager
     def reconcile_outbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+        return self.reconciler(batch_id).reconcile_outbound()
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
         event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        yield self.reconciler(batch_id).reconcile_events(event_keys)
 
     @Manager.calls_manager
     def batch_start(self, tags, **metadata):
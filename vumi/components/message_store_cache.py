@@ -3,6 +3,7 @@
 import time
 import hashlib
 import json
+from uuid import uuid4
 
 from twisted.internet.defer import returnValue
 
@@ -29,9 +30,12 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    RECONCILE_KEY = 'reconcile'
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
+    # How many search result keys to materialise per round trip
+    SEARCH_RESULT_CHUNK_SIZE = 1000
 
     def __init__(self, redis):
         # Store redis as `manager` as well since @Manager.calls_manager
@@ -68,6 +72,13 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def search_chunk_key(self, batch_id, token, run_id):
+        return self.batch_key(
+            self.SEARCH_RESULT_KEY, batch_id, token, 'chunk', run_id)
+
+    def reconcile_key(self, batch_id):
+        return self.batch_key(self.RECONCILE_KEY, batch_id)
+
     @Manager.calls_manager
     def batch_start(self, batch_id):
         """
@@ -78,8 +89,10 @@ class MessageStoreCache(object):
 
         This operation idempotent.
         """
-        yield self.redis.sadd(self.batch_key(), batch_id)
-        yield self.init_status(batch_id)
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.batch_key(), batch_id)
+        self._queue_init_status(pipe, batch_id)
+        yield pipe.execute()
 
     @Manager.calls_manager
     def init_status(self, batch_id):
@@ -89,12 +102,17 @@ class MessageStoreCache(object):
         all set to 0. If there's already an existing value then it is
         left untouched.
         """
+        pipe = self.redis.pipeline()
+        self._queue_init_status(pipe, batch_id)
+        yield pipe.execute()
+
+    def _queue_init_status(self, pipe, batch_id):
         events = (TransportEvent.EVENT_TYPES.keys() +
                   ['delivery_report.%s' % status
                    for status in TransportEvent.DELIVERY_STATUSES] +
                   ['sent'])
         for event in events:
-            yield self.redis.hsetnx(self.status_key(batch_id), event, 0)
+            pipe.hsetnx(self.status_key(batch_id), event, 0)
 
     def get_batch_ids(self):
         """
@@ -116,13 +134,16 @@ class MessageStoreCache(object):
                 cached values your UI values might be off while the
                 reconciliation is taking place.
         """
-        yield self.redis.delete(self.inbound_key(batch_id))
-        yield self.redis.delete(self.outbound_key(batch_id))
-        yield self.redis.delete(self.event_key(batch_id))
-        yield self.redis.delete(self.status_key(batch_id))
-        yield self.redis.delete(self.to_addr_key(batch_id))
-        yield self.redis.delete(self.from_addr_key(batch_id))
-        yield self.redis.srem(self.batch_key(), batch_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self.inbound_key(batch_id))
+        pipe.delete(self.outbound_key(batch_id))
+        pipe.delete(self.event_key(batch_id))
+        pipe.delete(self.status_key(batch_id))
+        pipe.delete(self.to_addr_key(batch_id))
+        pipe.delete(self.from_addr_key(batch_id))
+        pipe.delete(self.reconcile_key(batch_id))
+        pipe.srem(self.batch_key(), batch_id)
+        yield pipe.execute()
 
     def get_timestamp(self, datetime):
         """
@@ -130,41 +151,117 @@ class MessageStoreCache(object):
         """
         return time.mktime(datetime.timetuple())
 
+    def _undo_increments(self, batch_id, undo):
+        """
+        Counters are incremented optimistically in the same pipeline as the
+        writes they count, which keeps the common case to a single round
+        trip. This takes a list of `(event_type, amount)` pairs for
+        increments that turned out to be for entries that already existed
+        and reverses them.
+        """
+        pipe = self.redis.pipeline()
+        for event_type, amount in undo:
+            if amount:
+                pipe.hincrby(self.status_key(batch_id), event_type, -amount)
+        if len(pipe):
+            return pipe.execute()
+
     @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
         Add an outbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'], timestamp)
+        yield self.add_outbound_messages(batch_id, [msg])
+
+    @Manager.calls_manager
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add a list of outbound messages to the cache for the given batch_id.
+
+        The message keys, to_addrs and the `sent` counter are all written in
+        a single round trip, no matter how many messages there are.
+        """
+        if not msgs:
+            return
+        message_keys, to_addrs = self._timestamp_mappings(msgs, 'to_addr')
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.outbound_key(batch_id), **message_keys)
+        pipe.zadd(self.to_addr_key(batch_id), **to_addrs)
+        pipe.hincrby(self.status_key(batch_id), 'sent', len(message_keys))
+        [new_entries, _, _] = yield pipe.execute()
+        yield self._undo_increments(batch_id, [
+            ('sent', len(message_keys) - new_entries)])
+
+    def _timestamp_mappings(self, msgs, addr_field):
+        """
+        Build `{message_id: timestamp}` and `{address: timestamp}` mappings
+        suitable for passing to ZADD. If an address appears more than once
+        the most recent timestamp wins.
+        """
+        message_keys, addrs = {}, {}
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            message_keys[msg['message_id'].encode('utf-8')] = timestamp
+            addr = msg[addr_field].encode('utf-8')
+            addrs[addr] = max(timestamp, addrs.get(addr, timestamp))
+        return message_keys, addrs
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
         """
-        new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
             })
-        if new_entry:
-            yield self.increment_event_status(batch_id, 'sent')
+        pipe.hincrby(self.status_key(batch_id), 'sent', 1)
+        [new_entry, _] = yield pipe.execute()
+        yield self._undo_increments(batch_id, [('sent', 1 - new_entry)])
 
     @Manager.calls_manager
     def add_event(self, batch_id, event):
         """
         Add an event to the cache for the given batch_id
         """
+        yield self.add_events(batch_id, [event])
+
+    @Manager.calls_manager
+    def add_events(self, batch_id, events):
+        """
+        Add a list of events to the cache for the given batch_id.
 
-        event_id = event['event_id']
-        new_entry = yield self.add_event_key(batch_id, event_id)
-        if new_entry:
-            event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
+        Events are grouped by type (and delivery status) and all groups are
+        written in a single round trip. Only events not already in the cache
+        are counted.
+        """
+        groups = {}
+        for event in events:
+            group_key = (event['event_type'], event.get('delivery_status'))
+            groups.setdefault(group_key, set()).add(event['event_id'])
+        if not groups:
+            return
+
+        pipe = self.redis.pipeline()
+        counters = []
+        for (event_type, delivery_status), event_ids in groups.iteritems():
+            group_counters = [event_type]
             if event_type == 'delivery_report':
-                yield self.increment_event_status(batch_id,
-                    '%s.%s' % (event_type, event['delivery_status']))
+                group_counters.append('%s.%s' % (event_type, delivery_status))
+            pipe.sadd(self.event_key(batch_id), *event_ids)
+            for counter in group_counters:
+                pipe.hincrby(self.status_key(batch_id), counter,
+                             len(event_ids))
+            counters.append((len(event_ids), group_counters))
+        results = yield pipe.execute()
+
+        undo = []
+        for count, group_counters in counters:
+            new_entries = results.pop(0)
+            del results[:len(group_counters)]
+            undo.extend((counter, count - new_entries)
+                        for counter in group_counters)
+        yield self._undo_increments(batch_id, undo)
 
     def add_event_key(self, batch_id, event_key):
         """
@@ -173,12 +270,13 @@ class MessageStoreCache(object):
         """
         return self.redis.sadd(self.event_key(batch_id), event_key)
 
-    def increment_event_status(self, batch_id, event_type):
+    def increment_event_status(self, batch_id, event_type, amount=1):
         """
-        Increment the status for the given event_type by 1 for the given
-        batch_id
+        Increment the status for the given event_type by `amount` (which
+        defaults to 1) for the given batch_id
         """
-        return self.redis.hincrby(self.status_key(batch_id), event_type, 1)
+        return self.redis.hincrby(self.status_key(batch_id), event_type,
+                                  amount)
 
     @Manager.calls_manager
     def get_event_status(self, batch_id):
@@ -194,10 +292,23 @@ class MessageStoreCache(object):
         """
         Add an inbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
+        yield self.add_inbound_messages(batch_id, [msg])
+
+    @Manager.calls_manager
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add a list of inbound messages to the cache for the given batch_id.
+
+        The message keys and from_addrs are written in a single round trip,
+        no matter how many messages there are.
+        """
+        if not msgs:
+            return
+        message_keys, from_addrs = self._timestamp_mappings(msgs, 'from_addr')
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.inbound_key(batch_id), **message_keys)
+        pipe.zadd(self.from_addr_key(batch_id), **from_addrs)
+        yield pipe.execute()
 
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
@@ -324,6 +435,28 @@ class MessageStoreCache(object):
             timestamp - sample_time, timestamp)
         returnValue(int(count))
 
+    def get_reconcile_checkpoint(self, batch_id, direction):
+        """
+        Return the last message key (in sorted key order) that a
+        reconciliation of `direction` messages fully processed for this
+        batch_id, or None if there is no checkpoint.
+        """
+        return self.redis.hget(self.reconcile_key(batch_id), direction)
+
+    def set_reconcile_checkpoint(self, batch_id, direction, message_key):
+        """
+        Record that a reconciliation of `direction` messages has processed
+        every key up to and including `message_key`.
+        """
+        return self.redis.hset(self.reconcile_key(batch_id), direction,
+                               message_key)
+
+    def clear_reconcile_checkpoints(self, batch_id):
+        """
+        Forget all reconciliation checkpoints for this batch_id.
+        """
+        return self.redis.delete(self.reconcile_key(batch_id))
+
     def get_query_token(self, direction, query):
         """
         Return a token for the query.
@@ -361,9 +494,17 @@ class MessageStoreCache(object):
                             ttl=None):
         """
         Store the inbound query results for a query that was started with
-        `start_inbound_query`. Internally this grabs the timestamps from
-        the cache (there is an assumption that it has already been reconciled)
-        and orders the results accordingly.
+        `start_inbound_query`. The results are ordered by the timestamps
+        already known in the cache (there is an assumption that it has
+        already been reconciled); keys the cache doesn't know about are
+        left out of the results.
+
+        The ordering is done inside redis: each chunk of keys is written to
+        a temporary sorted set, intersected with the batch's timestamp set
+        and merged into the result set, all in a single round trip. Results
+        are readable with `get_query_results()` as soon as the first chunk
+        has been stored. Each call uses a temporary key of its own, so
+        identical queries may store their results at the same time.
 
         :param str token:
             The token to store the results under.
@@ -377,6 +518,7 @@ class MessageStoreCache(object):
         """
         ttl = ttl or self.DEFAULT_SEARCH_RESULT_TTL
         result_key = self.search_result_key(batch_id, token)
+        chunk_key = self.search_chunk_key(batch_id, token, uuid4().hex)
         if direction == 'inbound':
             score_set_key = self.inbound_key(batch_id)
         elif direction == 'outbound':
@@ -384,16 +526,21 @@ class MessageStoreCache(object):
         else:
             raise MessageStoreCacheException('Invalid direction')
 
-        # populate the results set weighted according to the timestamps
-        # that are already known in the cache.
-        for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-                })
+        chunk_size = self.SEARCH_RESULT_CHUNK_SIZE
+        for i in xrange(0, len(keys), chunk_size):
+            pipe = self.redis.pipeline()
+            pipe.zadd(chunk_key, **dict(
+                (key.encode('utf-8'), 0) for key in keys[i:i + chunk_size]))
+            # Weighting the chunk by zero leaves only the timestamp scores.
+            pipe.zinterstore(chunk_key, {chunk_key: 0, score_set_key: 1})
+            # Keys stored more than once keep their timestamp as the score.
+            pipe.zunionstore(
+                result_key, [result_key, chunk_key], aggregate='MAX')
+            pipe.delete(chunk_key)
+            # Auto expire after TTL
+            pipe.expire(result_key, ttl)
+            yield pipe.execute()
 
-        # Auto expire after TTL
-        yield self.redis.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
         yield self.redis.srem(self.search_token_key(batch_id), token)
 
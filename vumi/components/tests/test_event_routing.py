@@ -0,0 +1,96 @@
+"""Tests for vumi.components.event_routing."""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.components import EventRoutingStore
+from vumi.tests.utils import PersistenceMixin
+
+
+class EventRoutingStoreTestCase(unittest.TestCase, PersistenceMixin):
+    timeout = 5
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(10000)
+        self.store = self.mk_store()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_store(self, **kw):
+        kw.setdefault('clock', self.clock)
+        kw.setdefault('expiry', 300)
+        kw.setdefault('bucket_size', 100)
+        return EventRoutingStore(self.redis, **kw)
+
+    def get_bucket(self, bucket):
+        return self.redis.hgetall(self.store.bucket_key(bucket))
+
+    def test_live_buckets(self):
+        self.assertEqual([100, 99, 98, 97], self.store.live_buckets())
+        store = self.mk_store(expiry=250)
+        self.assertEqual([100, 99, 98, 97], store.live_buckets())
+
+    @inlineCallbacks
+    def test_remember_and_lookup(self):
+        self.store.remember('msg1', 'app1')
+        self.assertEqual('app1', (yield self.store.lookup('msg1')))
+        self.assertEqual(None, (yield self.store.lookup('msg2')))
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        self.store.remember('msg1', 'app1')
+        self.assertEqual({}, (yield self.get_bucket(100)))
+        self.clock.advance(1)
+        self.assertEqual({'msg1': 'app1'}, (yield self.get_bucket(100)))
+
+    @inlineCallbacks
+    def test_flush_size(self):
+        store = self.mk_store(flush_size=2)
+        store.remember('msg1', 'app1')
+        self.assertEqual({}, (yield self.get_bucket(100)))
+        store.remember('msg2', 'app2')
+        self.assertEqual({'msg1': 'app1', 'msg2': 'app2'},
+                         (yield self.get_bucket(100)))
+
+    @inlineCallbacks
+    def test_bucket_expiry(self):
+        self.store.remember('msg1', 'app1')
+        yield self.store.flush()
+        # The bucket lasts until `expiry` after the end of its period.
+        ttl = yield self.redis.ttl(self.store.bucket_key(100))
+        self.assertTrue(390 < ttl <= 400)
+
+    @inlineCallbacks
+    def test_lookup_from_redis(self):
+        self.store.remember('msg1', 'app1')
+        yield self.store.flush()
+        self.clock.advance(250)
+        store = self.mk_store()
+        self.assertEqual('app1', (yield store.lookup('msg1')))
+        # The result is cached.
+        yield self.redis._purge_all()
+        self.assertEqual('app1', (yield store.lookup('msg1')))
+
+    @inlineCallbacks
+    def test_cache_size(self):
+        store = self.mk_store(cache_size=2)
+        for i in range(3):
+            store.remember('msg%d' % (i,), 'app%d' % (i,))
+        yield store.flush()
+        yield self.redis._purge_all()
+        self.assertEqual(None, (yield store.lookup('msg0')))
+        self.assertEqual('app1', (yield store.lookup('msg1')))
+        self.assertEqual('app2', (yield store.lookup('msg2')))
+
+    @inlineCallbacks
+    def test_stop(self):
+        self.store.remember('msg1', 'app1')
+        yield self.store.stop()
+        self.assertEqual({'msg1': 'app1'}, (yield self.get_bucket(100)))
+        self.assertEqual([], self.clock.getDelayedCalls())
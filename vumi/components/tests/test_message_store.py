@@ -440,6 +440,91 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_with_inbound_and_delivery_reports(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 5)
+        messages = yield self.create_outbound_messages(batch_id, 5)
+        for msg in messages:
+            dr = self.mkmsg_delivery(user_message_id=msg['message_id'],
+                                     status='delivered')
+            yield self.store.add_event(dr)
+
+        self.clear_cache(self.store)
+        yield self.store.reconcile_cache(batch_id, concurrency=2)
+        self.assertFalse((yield self.store.needs_reconciliation(batch_id,
+            delta=0)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(
+            sent=5, delivered=5))
+        self.assertEqual(
+            (yield self.store.cache.count_from_addrs(batch_id)), 1)
+
+    @inlineCallbacks
+    def test_reconcile_cache_progress(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 5)
+        yield self.create_outbound_messages(batch_id, 7)
+        self.manager.load_bunch_size = 3
+
+        progress = []
+        yield self.store.reconcile_cache(
+            batch_id, progress_callback=lambda *args: progress.append(args))
+        self.assertEqual(progress, [
+            ('inbound', 3, 5), ('inbound', 5, 5),
+            ('outbound', 3, 7), ('outbound', 6, 7), ('outbound', 7, 7),
+        ])
+        # Checkpoints are removed once reconciliation completes.
+        checkpoint = yield self.store.cache.get_reconcile_checkpoint(
+            batch_id, 'outbound')
+        self.assertEqual(checkpoint, None)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 6)
+        self.manager.load_bunch_size = 2
+
+        self.clear_cache(self.store)
+        keys = sorted(msg['message_id'] for msg in messages)
+        # Pretend a previous run got through the first bunch before dying.
+        yield self.store.cache.set_reconcile_checkpoint(
+            batch_id, 'outbound', keys[1])
+
+        progress = []
+        yield self.store.reconcile_cache(
+            batch_id, resume=True,
+            progress_callback=lambda *args: progress.append(args))
+        self.assertEqual(progress, [('outbound', 2, 4), ('outbound', 4, 4)])
+        cached_keys = yield self.store.cache.get_outbound_message_keys(
+            batch_id)
+        self.assertEqual(sorted(cached_keys), keys[2:])
+
+    @inlineCallbacks
+    def test_reconcile_cache_failure_keeps_checkpoint(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 6)
+        self.manager.load_bunch_size = 2
+        keys = sorted(msg['message_id'] for msg in messages)
+
+        calls = []
+        add_outbound_messages = self.store.cache.add_outbound_messages
+
+        def flaky_add_outbound_messages(batch_id, msgs):
+            calls.append(msgs)
+            if len(calls) == 2:
+                raise ValueError("Redis went away.")
+            return add_outbound_messages(batch_id, msgs)
+
+        self.patch(self.store.cache, 'add_outbound_messages',
+                   flaky_add_outbound_messages)
+        yield self.assertFailure(
+            self.store.reconciler(batch_id).reconcile_outbound(), ValueError)
+        # A resumed reconciliation starts with the bunch that failed.
+        checkpoint = yield self.store.cache.get_reconcile_checkpoint(
+            batch_id, 'outbound')
+        self.assertEqual(keys[1], checkpoint)
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
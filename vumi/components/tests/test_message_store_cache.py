@@ -215,6 +215,71 @@ class TestMessageStoreCache(ApplicationTestCase):
             (yield self.cache.get_inbound_message_keys(self.batch_id)),
             ['the-same-thing'])
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        msgs = [self.mkmsg_out(to_addr='to-%s' % (i % 2,)) for i in range(5)]
+        yield self.cache.add_outbound_messages(self.batch_id, msgs)
+        # Adding them again should not change the counts.
+        yield self.cache.add_outbound_messages(self.batch_id, msgs)
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(sorted(keys),
+                         sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual(
+            (yield self.cache.count_to_addrs(self.batch_id)), 2)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 5)
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        msgs = [self.mkmsg_in(from_addr='from-%s' % (i % 3,))
+                for i in range(5)]
+        yield self.cache.add_inbound_messages(self.batch_id, msgs)
+        keys = yield self.cache.get_inbound_message_keys(self.batch_id)
+        self.assertEqual(sorted(keys),
+                         sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 3)
+
+    @inlineCallbacks
+    def test_add_events(self):
+        msg = self.mkmsg_out()
+        yield self.cache.add_outbound_message(self.batch_id, msg)
+        events = [
+            self.mkmsg_ack(user_message_id=msg['message_id'],
+                           sent_message_id=msg['message_id']),
+            self.mkmsg_ack(user_message_id=msg['message_id'],
+                           sent_message_id=msg['message_id']),
+            self.mkmsg_delivery(user_message_id=msg['message_id'],
+                                status='delivered'),
+            self.mkmsg_delivery(user_message_id=msg['message_id'],
+                                status='failed'),
+        ]
+        yield self.cache.add_events(self.batch_id, events)
+        # Adding them again should not change the counts.
+        yield self.cache.add_events(self.batch_id, events)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status, {
+            'delivery_report': 2,
+            'delivery_report.delivered': 1,
+            'delivery_report.failed': 1,
+            'delivery_report.pending': 0,
+            'ack': 2,
+            'nack': 0,
+            'sent': 1,
+            })
+
+    @inlineCallbacks
+    def test_reconcile_checkpoints(self):
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        yield self.cache.set_reconcile_checkpoint(
+            self.batch_id, 'inbound', 'key-1')
+        self.assertEqual('key-1', (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+        yield self.cache.clear_reconcile_checkpoints(self.batch_id)
+        self.assertEqual(None, (yield self.cache.get_reconcile_checkpoint(
+            self.batch_id, 'inbound')))
+
     @inlineCallbacks
     def test_clear_batch(self):
         msg_in = self.mkmsg_in()
@@ -342,3 +407,78 @@ class TestMessageStoreCache(ApplicationTestCase):
         self.assertEqual(
             (yield self.cache.count_query_results(self.batch_id, token)),
             10)
+
+    @inlineCallbacks
+    def test_store_query_results_in_chunks(self):
+        self.cache.SEARCH_RESULT_CHUNK_SIZE = 3
+        now = datetime.now()
+        message_ids = []
+        for i in range(10):
+            msg_in = self.mkmsg_in(content='hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        # Keys the cache doesn't know about are left out of the results.
+        yield self.cache.store_query_results(self.batch_id, token,
+            message_ids[::2] + ['unknown'], 'inbound', 120)
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            list(reversed(message_ids[::2])))
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token,
+                                                asc=True)),
+            message_ids[::2])
+        ttl = yield self.redis.ttl(
+            self.cache.search_result_key(self.batch_id, token))
+        self.assertTrue(0 < ttl <= 120)
+        self.assertEqual([], (yield self.redis.keys(
+            self.cache.search_chunk_key(self.batch_id, token, '*'))))
+
+    @inlineCallbacks
+    def test_store_query_results_concurrently(self):
+        self.cache.SEARCH_RESULT_CHUNK_SIZE = 2
+        now = datetime.now()
+        message_ids = []
+        for i in range(6):
+            msg_in = self.mkmsg_in(content='hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        # Two runs of the same query don't clobber each other's chunks.
+        d1 = self.cache.store_query_results(
+            self.batch_id, token, message_ids[:4], 'inbound', 120)
+        d2 = self.cache.store_query_results(
+            self.batch_id, token, message_ids[2:], 'inbound', 120)
+        yield d1
+        yield d2
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token,
+                                                asc=True)),
+            message_ids)
+
+    @inlineCallbacks
+    def test_store_query_results_duplicate_keys(self):
+        self.cache.SEARCH_RESULT_CHUNK_SIZE = 2
+        now = datetime.now()
+        message_ids = []
+        for i in range(3):
+            msg_in = self.mkmsg_in(content='hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        # The first key is stored again in a later chunk.
+        yield self.cache.store_query_results(self.batch_id, token,
+            message_ids + message_ids[:1], 'inbound', 120)
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token,
+                                                asc=True)),
+            message_ids)
@@ -13,14 +13,21 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, consumer_concurrency=None,
+                 ack_batch_size=None, publish_batch_size=None,
+                 max_outstanding_publishes=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
         self._publishers = {}
         self._endpoint_handlers = {}
         self._default_handlers = {}
+        self._ordering_keys = {}
         self._prefetch_count = prefetch_count
+        self._consumer_concurrency = consumer_concurrency or 1
+        self._ack_batch_size = ack_batch_size or 1
+        self._publish_batch_size = publish_batch_size or 1
+        self._max_outstanding_publishes = max_outstanding_publishes
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -52,7 +59,9 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), batch_size=self._publish_batch_size,
+            max_outstanding=self._max_outstanding_publishes)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -65,9 +74,13 @@ class BaseConnector(object):
         def handler(msg):
             return self._consume_message(mtype, msg)
 
-        consumer = yield self.worker.consume(self._rkey(mtype), handler,
-                                             message_class=msg_class,
-                                             paused=True)
+        def ordering_key(msg):
+            return self._ordering_key(mtype, msg)
+
+        consumer = yield self.worker.consume(
+            self._rkey(mtype), handler, message_class=msg_class, paused=True,
+            concurrency=self._consumer_concurrency,
+            ack_batch_size=self._ack_batch_size, ordering_key=ordering_key)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         self._set_prefetch_count(consumer)
@@ -83,6 +96,22 @@ class BaseConnector(object):
         self._endpoint_handlers.setdefault(mtype, {})
         self._default_handlers[mtype] = handler
 
+    def set_ordering_key(self, mtype, func):
+        """Preserve delivery order for `mtype` messages with the same key.
+
+        This only matters when the connector's consumers process messages
+        concurrently. `func` is called with each message and should return
+        a key (such as the message's `from_addr`) or None if the message
+        may be processed in any order.
+        """
+        self._ordering_keys[mtype] = func
+
+    def _ordering_key(self, mtype, msg):
+        func = self._ordering_keys.get(mtype)
+        if func is None:
+            return None
+        return func(msg)
+
     def _consume_message(self, mtype, msg):
         endpoint_name = msg.get_routing_endpoint()
         handler = self._endpoint_handlers[mtype].get(endpoint_name)
@@ -13,7 +13,7 @@ from vumi.message import TransportUserMessage, TransportEvent
 from vumi.utils import load_class_by_string, get_first_word
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
-from vumi.components import SessionManager
+from vumi.components import SessionManager, EventRoutingStore
 from vumi.persist.txredis_manager import TxRedisManager
 
 
@@ -438,6 +438,83 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class PrefixTrie(object):
+    """Trie of string prefixes, each with a list of values.
+
+    :meth:`match` finds the values for every prefix of a string in one pass
+    over the string, however many prefixes there are.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.children = {}
+
+    def add(self, prefix, value):
+        node = self
+        for char in prefix:
+            node = node.children.setdefault(char, PrefixTrie())
+        node.values.append(value)
+
+    def match(self, string):
+        """Return the values of all prefixes of `string`, shortest prefix
+        first.
+        """
+        node = self
+        matches = list(node.values)
+        for char in string:
+            node = node.children.get(char)
+            if node is None:
+                break
+            matches.extend(node.values)
+        return matches
+
+
+class KeywordRoutingTable(object):
+    """Index of :class:`ContentKeywordRouter` rules.
+
+    Rules are looked up by keyword, then by `to_addr` and then by
+    `from_addr` prefix, so the cost of finding the rules for a message
+    doesn't depend on how many rules there are.
+    """
+
+    # Key for rules without a `to_addr`. A rule with a `to_addr` of `None`
+    # only matches messages without one, so `None` can't be used.
+    ANY_TO_ADDR = object()
+
+    def __init__(self, rules=()):
+        self._keywords = {}
+        self._count = 0
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        by_to_addr = self._keywords.setdefault(rule['keyword'], {})
+        to_addr = rule['to_addr'] if 'to_addr' in rule else self.ANY_TO_ADDR
+        trie = by_to_addr.get(to_addr)
+        if trie is None:
+            trie = by_to_addr[to_addr] = PrefixTrie()
+        # Remember the order rules were added in, so that matches are
+        # returned in the same order as a linear scan would find them.
+        trie.add(rule.get('prefix', ''), (self._count, rule))
+        self._count += 1
+
+    def match(self, keyword, to_addr, from_addr):
+        """Return the rules matching a message, in the order they were
+        added.
+        """
+        by_to_addr = self._keywords.get(keyword)
+        if by_to_addr is None:
+            return []
+        matches = []
+        for key in (self.ANY_TO_ADDR, to_addr):
+            trie = by_to_addr.get(key)
+            if trie is not None:
+                matches.extend(trie.match(from_addr or ''))
+        if len(matches) > 1:
+            matches.sort()
+        return [rule for _, rule in matches]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -477,6 +554,18 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    :param int routing_memory_bucket_size:
+        Number of seconds of outbound message ids to store in each
+        Redis hash. Default is one hour.
+
+    :param float routing_memory_flush_interval:
+        Maximum time in seconds that outbound message ids are held in
+        memory before being written to Redis. Default is one second.
+
+    :param int routing_memory_cache_size:
+        Number of outbound message ids to keep in memory so that events
+        can be routed without reading from Redis. Default is 10000.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
@@ -497,10 +586,20 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         for transport_name, keyword in keyword_mappings.items():
             self.rules.append({'app': transport_name,
                                'keyword': keyword.lower()})
+        self.routing_table = KeywordRoutingTable(self.rules)
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
             'expire_routing_memory', self.DEFAULT_ROUTING_TIMEOUT))
+        self.routing_memory_config = {
+            'expiry': self.expire_routing_timeout,
+            'bucket_size': int(self.config.get(
+                'routing_memory_bucket_size', 60 * 60)),
+            'flush_interval': float(self.config.get(
+                'routing_memory_flush_interval', 1.0)),
+            'cache_size': int(self.config.get(
+                'routing_memory_cache_size', 10000)),
+            }
 
         # FIXME: The following is a hack to deal with sync-only setup.
         self._redis_d = TxRedisManager.from_config(self.r_config)
@@ -509,9 +608,19 @@ class ContentKeywordRouter(SimpleDispatchRouter):
 
     def _setup_redis(self, redis):
         self.redis = redis
+        self.event_routes = EventRoutingStore(
+            self.redis, **self.routing_memory_config)
+        # Only used to find routes remembered by older versions of this
+        # router, which stored a session per outbound message.
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
 
+    @inlineCallbacks
+    def teardown_routing(self):
+        yield self._redis_d
+        yield self.event_routes.stop()
+        yield self.redis._close()
+
     def get_message_key(self, message):
         return 'message:%s' % (message,)
 
@@ -524,23 +633,18 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     def publish_exposed_event(self, name, msg):
         self.dispatcher.publish_inbound_event(name, msg)
 
-    def is_msg_matching_routing_rules(self, keyword, msg, rule):
-        return all([keyword == rule['keyword'],
-                    (not 'to_addr' in rule) or
-                    (msg['to_addr'] == rule['to_addr']),
-                    (not 'prefix' in rule) or
-                    (msg['from_addr'].startswith(rule['prefix']))])
+    def get_matching_rules(self, msg):
+        keyword = get_first_word(msg['content']).lower()
+        return self.routing_table.match(
+            keyword, msg['to_addr'], msg['from_addr'])
 
     def dispatch_inbound_message(self, msg):
-        keyword = get_first_word(msg['content']).lower()
-        matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
-        if not matched:
+        rules = self.get_matching_rules(msg)
+        for rule in rules:
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
+        if not rules:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
             else:
@@ -549,9 +653,11 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
-        message_key = self.get_message_key(msg['user_message_id'])
-        session = yield self.session_manager.load_session(message_key)
-        name = session.get('name')
+        name = yield self.event_routes.lookup(msg['user_message_id'])
+        if name is None:
+            message_key = self.get_message_key(msg['user_message_id'])
+            session = yield self.session_manager.load_session(message_key)
+            name = session.get('name')
         if not name:
             log.error("No transport_name for return route found in Redis"
                       " while dispatching transport event for message %s"
@@ -567,9 +673,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            yield self.session_manager.create_session(
-                message_key, name=msg['transport_name'])
+            self.event_routes.remember(
+                msg['message_id'], msg['transport_name'])
         else:
             log.error("No transport for %s" % (msg['from_addr'],))
 
@@ -1,7 +1,10 @@
 # -*- test-case-name: vumi.dispatchers.tests.test_load_balancer -*-
 
-"""Router for round-robin load balancing between two transports."""
+"""Routers for load balancing between transports."""
 
+import struct
+import bisect
+import hashlib
 import itertools
 
 from vumi import log
@@ -41,6 +44,10 @@ class LoadBalancingRouter(BaseDispatchRouter):
             self.dispatcher.transport_names)
         self.transport_name_set = set(self.dispatcher.transport_names)
 
+    def choose_transport_name(self, msg):
+        """Return the transport to send an outbound message to."""
+        return self.transport_name_cycle.next()
+
     def push_transport_name(self, msg, transport_name):
         hm = msg['helper_metadata']
         lm = hm.setdefault('load_balancer', {})
@@ -79,7 +86,120 @@ class LoadBalancingRouter(BaseDispatchRouter):
                             % (transport_name,))
                 transport_name = self.transport_name_cycle.next()
         else:
-            transport_name = self.transport_name_cycle.next()
+            transport_name = self.choose_transport_name(msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = transport_name
         self.dispatcher.publish_outbound_message(transport_name, msg)
+
+
+class HashRing(object):
+    """A consistent hash ring of weighted nodes.
+
+    Each node is placed on the ring at `replicas * weight` points and a key
+    belongs to the node at the first point after the key's hash. Adding or
+    removing a node only moves the keys between that node and its
+    neighbours, roughly `1 / len(nodes)` of them, and the share of keys each
+    node gets is proportional to its weight.
+
+    :param int replicas:
+        Number of points per unit of weight.
+    """
+
+    HASH = struct.Struct('>Q')
+
+    def __init__(self, replicas=100):
+        self.replicas = replicas
+        self.weights = {}
+        self._points = []
+        self._nodes = []
+
+    def hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.HASH.unpack(hashlib.md5(key).digest()[:8])[0]
+
+    def add(self, node, weight=1):
+        self.weights[node] = weight
+        self._rebuild()
+
+    def remove(self, node):
+        del self.weights[node]
+        self._rebuild()
+
+    def _rebuild(self):
+        ring = []
+        for node, weight in self.weights.iteritems():
+            for i in xrange(int(self.replicas * weight)):
+                ring.append((self.hash('%s-%d' % (node, i)), node))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get_node(self, key):
+        """Return the node `key` belongs to, or `None` if the ring is
+        empty.
+        """
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self.hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+class ConsistentHashingRouter(LoadBalancingRouter):
+    """Router that sends outbound messages with the same value of a
+    message field to the same transport, so that (for example) all
+    messages to one user go over the same transport.
+
+    Transports are chosen from a :class:`HashRing`, so no shared state is
+    needed to keep the mapping stable and adding or removing a transport
+    moves only that transport's share of the keys. Messages without a
+    value for the field are round-robinned over the transports with a
+    weight above zero.
+
+    Supports the same options as :class:`LoadBalancingRouter`, plus:
+
+    :param str hash_field:
+        Message field to hash. Nested fields may be given as a dotted path,
+        e.g. `helper_metadata.session_id`. Default: `to_addr`.
+    :param dict transport_weights:
+        Mapping from transport names to relative capacities. Transports
+        that aren't listed have a weight of 1.
+    :param int hash_replicas:
+        Points on the hash ring for each unit of weight. Default: 100.
+    """
+
+    def setup_routing(self):
+        super(ConsistentHashingRouter, self).setup_routing()
+        self.hash_field = self.config.get('hash_field', 'to_addr').split('.')
+        weights = self.config.get('transport_weights', {})
+        unknown = set(weights) - self.transport_name_set
+        if unknown:
+            raise ConfigError("Weights given for unknown transports: %s" %
+                              (", ".join(sorted(unknown)),))
+        self.ring = HashRing(int(self.config.get('hash_replicas', 100)))
+        for transport_name in self.dispatcher.transport_names:
+            self.ring.add(transport_name, weights.get(transport_name, 1))
+        # Messages that can't be hashed are round-robinned over the
+        # transports that take traffic at all.
+        weighted_names = [name for name in self.dispatcher.transport_names
+                          if weights.get(name, 1) > 0]
+        if not weighted_names:
+            raise ConfigError("At least one transport needs a weight above"
+                              " zero for %s." % (type(self).__name__,))
+        self.transport_name_cycle = itertools.cycle(weighted_names)
+
+    def get_hash_key(self, msg):
+        value = msg.payload
+        for name in self.hash_field:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(name)
+        return value
+
+    def choose_transport_name(self, msg):
+        key = self.get_hash_key(msg)
+        if key is None:
+            return self.transport_name_cycle.next()
+        if not isinstance(key, basestring):
+            key = str(key)
+        return self.ring.get_node(key)
@@ -1,7 +1,9 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter, PrefixTrie,
+    KeywordRoutingTable)
 from vumi.tests.utils import VumiWorkerTestCase, LogCatcher
 from vumi.dispatchers.tests.utils import DispatcherTestCase, DummyDispatcher
 
@@ -455,6 +457,74 @@ class UserGroupingRouterTestCase(DispatcherTestCase):
         self.assertEqual(app_msg, transport_msg)
 
 
+class TestPrefixTrie(TestCase):
+
+    def test_match(self):
+        trie = PrefixTrie()
+        trie.add('', 'any')
+        trie.add('+27', 'za')
+        trie.add('+2782', 'vodacom')
+        trie.add('+256', 'ug')
+        self.assertEqual(['any', 'za', 'vodacom'], trie.match('+27821234'))
+        self.assertEqual(['any', 'za'], trie.match('+27831234'))
+        self.assertEqual(['any'], trie.match('+1555'))
+        self.assertEqual(['any'], trie.match(''))
+
+
+class TestKeywordRoutingTable(TestCase):
+
+    def test_match(self):
+        rules = [
+            {'app': 'app1', 'keyword': 'k1', 'to_addr': '8181',
+             'prefix': '+256'},
+            {'app': 'app2', 'keyword': 'k2'},
+            {'app': 'app3', 'keyword': 'k1'},
+            {'app': 'app4', 'keyword': 'k1', 'to_addr': '8181'},
+            {'app': 'app5', 'keyword': 'k1', 'prefix': '+2567'},
+            {'app': 'app6', 'keyword': 'k1', 'to_addr': None},
+            ]
+        table = KeywordRoutingTable(rules)
+
+        def apps(*args):
+            return [rule['app'] for rule in table.match(*args)]
+
+        self.assertEqual(['app1', 'app3', 'app4', 'app5'],
+                         apps('k1', '8181', '+256788'))
+        self.assertEqual(['app1', 'app3', 'app4'],
+                         apps('k1', '8181', '+256188'))
+        self.assertEqual(['app3', 'app5'], apps('k1', '8282', '+256788'))
+        self.assertEqual(['app3', 'app4'], apps('k1', '8181', None))
+        self.assertEqual(['app2'], apps('k2', '8181', '+256788'))
+        self.assertEqual([], apps('k3', '8181', '+256788'))
+        # Rules without a to_addr match messages without one, once. A
+        # to_addr of None only matches those messages.
+        self.assertEqual(['app3', 'app5', 'app6'],
+                         apps('k1', None, '+256788'))
+
+    def test_match_same_as_linear_scan(self):
+        rules = []
+        for i in range(50):
+            rule = {'app': 'app%d' % i, 'keyword': 'k%d' % (i % 3)}
+            if i % 2:
+                rule['to_addr'] = str(i % 4)
+            elif i % 4 == 2:
+                rule['to_addr'] = None
+            if i % 5:
+                rule['prefix'] = '+2%d' % (i % 7)
+            rules.append(rule)
+        table = KeywordRoutingTable(rules)
+        for keyword in ['k0', 'k1', 'k2']:
+            for to_addr in ['1', '3', None]:
+                for from_addr in ['+21000', '+23000', '+25000']:
+                    expected = [
+                        rule for rule in rules
+                        if rule['keyword'] == keyword
+                        and rule.get('to_addr', to_addr) == to_addr
+                        and from_addr.startswith(rule.get('prefix', ''))]
+                    self.assertEqual(
+                        expected, table.match(keyword, to_addr, from_addr))
+
+
 class TestContentKeywordRouter(DispatcherTestCase):
 
     dispatcher_class = BaseDispatchWorker
@@ -493,11 +563,6 @@ class TestContentKeywordRouter(DispatcherTestCase):
         self.redis = self.router.redis
         yield self.redis._purge_all()  # just in case
 
-    @inlineCallbacks
-    def tearDown(self):
-        yield self.router.session_manager.stop()
-        yield super(TestContentKeywordRouter, self).tearDown()
-
     @inlineCallbacks
     def test_inbound_message_routing(self):
         msg = self.mkmsg_in(content='KEYWORD1 rest of a msg',
@@ -570,8 +635,7 @@ class TestContentKeywordRouter(DispatcherTestCase):
     def test_inbound_event_routing_ok(self):
         msg = self.mkmsg_ack(user_message_id='1',
                              transport_name='transport1')
-        yield self.router.session_manager.create_session(
-            'message:1', name='app2')
+        self.router.event_routes.remember('1', 'app2')
 
         yield self.dispatch(msg,
                             transport_name='transport1',
@@ -584,6 +648,21 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                       direction='event')
         self.assertEqual(app1_event_msg, [])
 
+    @inlineCallbacks
+    def test_inbound_event_routing_legacy_session(self):
+        msg = self.mkmsg_ack(user_message_id='1',
+                             transport_name='transport1')
+        yield self.router.session_manager.create_session(
+            'message:1', name='app2')
+
+        yield self.dispatch(msg,
+                            transport_name='transport1',
+                            direction='event')
+
+        app2_event_msg = self.get_dispatched_messages('app2',
+                                                      direction='event')
+        self.assertEqual(app2_event_msg, [msg])
+
     @inlineCallbacks
     def test_inbound_event_routing_failing_publisher_not_defined(self):
         msg = self.mkmsg_ack(transport_name='transport1')
@@ -631,8 +710,13 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                        direction='outbound')
         self.assertEqual(transport2_msgs, [])
 
-        session = yield self.router.session_manager.load_session('message:1')
-        self.assertEqual(session['name'], 'app2')
+        name = yield self.router.event_routes.lookup('1')
+        self.assertEqual(name, 'app2')
+        yield self.router.event_routes.flush()
+        bucket = self.router.event_routes.current_bucket()
+        stored = yield self.redis.hgetall(
+            self.router.event_routes.bucket_key(bucket))
+        self.assertEqual(stored, {'1': 'app2'})
 
 
 class TestRedirectOutboundRouterForSMPP(DispatcherTestCase):
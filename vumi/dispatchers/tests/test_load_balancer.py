@@ -1,10 +1,13 @@
 """Tests for vumi.dispatchers.load_balancer."""
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
 
+from vumi.errors import ConfigError
 from vumi.tests.utils import VumiWorkerTestCase, LogCatcher
 from vumi.dispatchers.tests.utils import DummyDispatcher
-from vumi.dispatchers.load_balancer import LoadBalancingRouter
+from vumi.dispatchers.load_balancer import (
+    LoadBalancingRouter, ConsistentHashingRouter, HashRing)
 
 
 class BaseLoadBalancingTestCase(VumiWorkerTestCase):
@@ -162,3 +165,154 @@ class TestLoadBalancingWithoutRewriteTransportNames(BaseLoadBalancingTestCase):
         self.router.dispatch_outbound_message(msg1)
         [new_msg] = self.dispatcher.transport_publisher['transport_1'].msgs
         self.assertEqual(new_msg['transport_name'], 'round_robin')
+
+
+class TestHashRing(TestCase):
+
+    KEYS = ['+2783%07d' % (i,) for i in range(2000)]
+
+    def mk_ring(self, weights):
+        ring = HashRing()
+        for node, weight in weights.items():
+            ring.add(node, weight)
+        return ring
+
+    def assignments(self, ring):
+        return dict((key, ring.get_node(key)) for key in self.KEYS)
+
+    def test_empty(self):
+        self.assertEqual(None, HashRing().get_node('foo'))
+
+    def test_stable(self):
+        ring1 = self.mk_ring({'a': 1, 'b': 1})
+        ring2 = self.mk_ring({'b': 1, 'a': 1})
+        self.assertEqual(self.assignments(ring1), self.assignments(ring2))
+
+    def test_weights(self):
+        ring = self.mk_ring({'a': 1, 'b': 3})
+        counts = {'a': 0, 'b': 0}
+        for node in self.assignments(ring).values():
+            counts[node] += 1
+        share = counts['b'] / float(len(self.KEYS))
+        self.assertTrue(0.65 < share < 0.85, share)
+
+    def test_add_moves_few_keys(self):
+        ring = self.mk_ring({'a': 1, 'b': 1, 'c': 1})
+        before = self.assignments(ring)
+        ring.add('d')
+        after = self.assignments(ring)
+        moved = [key for key in self.KEYS if before[key] != after[key]]
+        # Only keys that now belong to the new node have moved.
+        self.assertEqual(set(['d']), set(after[key] for key in moved))
+        self.assertTrue(len(moved) < len(self.KEYS) * 0.35)
+
+    def test_remove_moves_only_removed_keys(self):
+        ring = self.mk_ring({'a': 1, 'b': 1, 'c': 1})
+        before = self.assignments(ring)
+        ring.remove('c')
+        after = self.assignments(ring)
+        for key in self.KEYS:
+            if before[key] != 'c':
+                self.assertEqual(before[key], after[key])
+            self.assertNotEqual('c', after[key])
+
+
+class TestConsistentHashingRouter(VumiWorkerTestCase):
+
+    @inlineCallbacks
+    def get_router(self, **config_extras):
+        config = {
+            "transport_names": [
+                "transport_1",
+                "transport_2",
+                "transport_3",
+            ],
+            "exposed_names": ["hashed"],
+            "router_class": ("vumi.dispatchers.load_balancer."
+                             "ConsistentHashingRouter"),
+        }
+        config.update(config_extras)
+        self.dispatcher = DummyDispatcher(config)
+        router = ConsistentHashingRouter(self.dispatcher, config)
+        yield router.setup_routing()
+        self.router = router
+
+    def routed_to(self, msg):
+        for name, publisher in self.dispatcher.transport_publisher.items():
+            if msg in publisher.msgs:
+                return name
+
+    @inlineCallbacks
+    def test_affinity(self):
+        yield self.get_router()
+        msgs = [self.mkmsg_out(to_addr='+2783%07d' % (i % 20,),
+                               message_id=str(i))
+                for i in range(100)]
+        routes = {}
+        for msg in msgs:
+            self.router.dispatch_outbound_message(msg)
+            routes.setdefault(msg['to_addr'], set()).add(
+                self.routed_to(msg))
+        self.assertEqual([1] * 20, [len(names) for names in routes.values()])
+        # With 20 users, every transport should get something.
+        used = set(name for names in routes.values() for name in names)
+        self.assertEqual(3, len(used))
+
+    @inlineCallbacks
+    def test_hash_field(self):
+        yield self.get_router(hash_field='helper_metadata.session_id')
+        msg1 = self.mkmsg_out(message_id='1', to_addr='1',
+                              helper_metadata={'session_id': 'x'})
+        msg2 = self.mkmsg_out(message_id='2', to_addr='2',
+                              helper_metadata={'session_id': 'x'})
+        self.router.dispatch_outbound_message(msg1)
+        self.router.dispatch_outbound_message(msg2)
+        self.assertEqual(self.routed_to(msg1), self.routed_to(msg2))
+        self.assertEqual(self.router.ring.get_node('x'), self.routed_to(msg1))
+
+    @inlineCallbacks
+    def test_missing_hash_field(self):
+        yield self.get_router(hash_field='helper_metadata.session_id')
+        msgs = [self.mkmsg_out(message_id=str(i)) for i in range(3)]
+        for msg in msgs:
+            self.router.dispatch_outbound_message(msg)
+        self.assertEqual(['transport_1', 'transport_2', 'transport_3'],
+                         [self.routed_to(msg) for msg in msgs])
+
+    @inlineCallbacks
+    def test_weights(self):
+        yield self.get_router(transport_weights={'transport_1': 0})
+        for i in range(20):
+            self.router.dispatch_outbound_message(
+                self.mkmsg_out(to_addr=str(i)))
+        self.assertEqual(
+            [], self.dispatcher.transport_publisher['transport_1'].msgs)
+
+    @inlineCallbacks
+    def test_zero_weight_round_robin(self):
+        yield self.get_router(hash_field='helper_metadata.session_id',
+                              transport_weights={'transport_1': 0})
+        msgs = [self.mkmsg_out(message_id=str(i)) for i in range(4)]
+        # A reply for a transport we don't know about falls back to
+        # round-robin too.
+        msgs.append(self.mkmsg_out(
+            message_id='4', in_reply_to='3',
+            helper_metadata={
+                'load_balancer': {'transport_names': ['unknown']}}))
+        for msg in msgs:
+            self.router.dispatch_outbound_message(msg)
+        self.assertEqual(
+            ['transport_2', 'transport_3', 'transport_2', 'transport_3',
+             'transport_2'],
+            [self.routed_to(msg) for msg in msgs])
+
+    def test_all_zero_weights(self):
+        return self.assertFailure(
+            self.get_router(transport_weights={
+                'transport_1': 0, 'transport_2': 0, 'transport_3': 0}),
+            ConfigError)
+
+    def test_unknown_weights(self):
+        return self.assertFailure(
+            self.get_router(transport_weights={'transport_4': 2}),
+            ConfigError)
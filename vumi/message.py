@@ -4,7 +4,7 @@ import json
 from uuid import uuid4
 from datetime import datetime
 
-from errors import MissingMessageField, InvalidMessageField
+from errors import MissingMessageField, InvalidMessageField, InvalidMessage
 
 from vumi.utils import to_kwargs
 
@@ -13,15 +13,35 @@ from vumi.utils import to_kwargs
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
 
+def _is_vumi_timestamp(value):
+    # A cheap check so we don't try to parse every string we see.
+    return (isinstance(value, basestring) and len(value) == 26 and
+            value[4] == '-' and value[10] == ' ' and value[19] == '.')
+
+
+def parse_vumi_timestamp(value):
+    """Parse a timestamp in :data:`VUMI_DATE_FORMAT`.
+
+    This is much faster than :func:`datetime.strptime` but only accepts
+    timestamps in exactly the format we write.
+    """
+    try:
+        return datetime(
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+            int(value[20:26]))
+    except ValueError:
+        return datetime.strptime(value, VUMI_DATE_FORMAT)
+
+
 def date_time_decoder(json_object):
     for key, value in json_object.items():
+        if not _is_vumi_timestamp(value):
+            continue
         try:
-            json_object[key] = datetime.strptime(value,
-                    VUMI_DATE_FORMAT)
+            json_object[key] = parse_vumi_timestamp(value)
         except ValueError:
             continue
-        except TypeError:
-            continue
     return json_object
 
 
@@ -41,6 +61,88 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+def copy_payload(value):
+    """Copy the dicts and lists in a message payload.
+
+    Everything else in a payload is immutable (or treated as such), so this
+    is equivalent to a JSON round trip without the encoding and parsing.
+    """
+    if isinstance(value, dict):
+        return dict((k, copy_payload(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [copy_payload(v) for v in value]
+    return value
+
+
+class JSONCodec(object):
+    """Encodes message payloads as JSON."""
+
+    content_type = 'application/json'
+
+    def encode(self, payload):
+        return to_json(payload)
+
+    def decode(self, data):
+        return from_json(data)
+
+
+class MsgpackCodec(object):
+    """Encodes message payloads with msgpack.
+
+    This needs the `msgpack` package, which is not a hard dependency.
+    """
+
+    content_type = 'application/x-msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def _encode_default(self, obj):
+        if isinstance(obj, datetime):
+            return {'__datetime__': obj.strftime(VUMI_DATE_FORMAT)}
+        raise TypeError("Can't encode %r" % (obj,))
+
+    def _decode_hook(self, obj):
+        if len(obj) == 1 and '__datetime__' in obj:
+            return parse_vumi_timestamp(obj['__datetime__'])
+        return obj
+
+    def encode(self, payload):
+        return self.msgpack.packb(
+            payload, default=self._encode_default, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(
+            data, object_hook=self._decode_hook, raw=False)
+
+
+MESSAGE_CODECS = {
+    JSONCodec.content_type: JSONCodec,
+    MsgpackCodec.content_type: MsgpackCodec,
+}
+
+_codecs = {}
+
+
+def get_codec(content_type=None):
+    """Return the codec for `content_type`, defaulting to JSON.
+
+    Parameters such as `charset` are ignored and the media type is matched
+    case-insensitively.
+    """
+    if content_type is None:
+        content_type = JSONCodec.content_type
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    codec = _codecs.get(content_type)
+    if codec is None:
+        if content_type not in MESSAGE_CODECS:
+            raise InvalidMessage(
+                "Unknown message content type %r" % (content_type,))
+        codec = _codecs[content_type] = MESSAGE_CODECS[content_type]()
+    return codec
+
+
 class Message(object):
     """
     Start of a somewhat unified message object to be
@@ -80,6 +182,16 @@ class Message(object):
     def from_json(cls, json_string):
         return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
 
+    def encode(self, content_type=None):
+        """Encode the message using the codec for `content_type`."""
+        return get_codec(content_type).encode(self.payload)
+
+    @classmethod
+    def decode(cls, data, content_type=None):
+        """Decode a message encoded with the codec for `content_type`."""
+        payload = get_codec(content_type).decode(data)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
     def __str__(self):
         return u"<Message payload=\"%s\">" % repr(self.payload)
 
@@ -107,7 +219,8 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        return self.__class__(
+            _process_fields=False, **to_kwargs(copy_payload(self.payload)))
 
 
 class TransportMessage(Message):
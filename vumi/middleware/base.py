@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
@@ -106,32 +107,79 @@ class ApplicationMiddleware(BaseMiddleware):
     """
 
 
+def is_passthrough_handler(handler, method_name):
+    """Return `True` if `handler` is :class:`BaseMiddleware`'s
+    implementation of `method_name`, which returns messages unchanged.
+    """
+    base_handler = getattr(BaseMiddleware, method_name, None)
+    return (base_handler is not None and
+            getattr(handler, 'im_func', None) is base_handler.im_func)
+
+
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    The handlers for each kind of message are looked up once (when first
+    needed) rather than for every message, and middlewares that don't
+    override a handler are left out. Messages are passed through handlers
+    that return plain values without any Deferreds being created apart
+    from the one returned.
+
+    The list of middlewares shouldn't be changed once messages are being
+    processed.
     """
 
     def __init__(self, middlewares):
         self.middlewares = middlewares
-
-    @inlineCallbacks
-    def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
+        self._chains = {}
+
+    def _get_chain(self, handler_name, reverse):
+        chain = self._chains.get((handler_name, reverse))
+        if chain is None:
+            method_name = 'handle_%s' % (handler_name,)
+            middlewares = self.middlewares
+            if reverse:
+                middlewares = reversed(middlewares)
+            chain = []
+            for middleware in middlewares:
+                handler = getattr(middleware, method_name)
+                if not is_passthrough_handler(handler, method_name):
+                    chain.append((middleware, handler))
+            chain = self._chains[(handler_name, reverse)] = tuple(chain)
+        return chain
+
+    def _handle(self, chain, start, handler_name, message, connector_name):
+        for i in xrange(start, len(chain)):
+            middleware, handler = chain[i]
+            try:
+                message = handler(message, connector_name)
+            except:
+                return fail()
+            if isinstance(message, Deferred):
+                return message.addCallback(
+                    self._resume, chain, i, handler_name, connector_name)
             if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+                return fail(self._none_error(middleware, handler_name))
+        return succeed(message)
+
+    def _resume(self, message, chain, i, handler_name, connector_name):
+        if message is None:
+            raise self._none_error(chain[i][0], handler_name)
+        return self._handle(chain, i + 1, handler_name, message,
+                            connector_name)
+
+    def _none_error(self, middleware, handler_name):
+        return MiddlewareError(
+            'Returned value of %s.handle_%s should never be None' % (
+                middleware, handler_name,))
 
     def apply_consume(self, handler_name, message, connector_name):
-        return self._handle(
-            self.middlewares, handler_name, message, connector_name)
+        return self._handle(self._get_chain(handler_name, False), 0,
+                            handler_name, message, connector_name)
 
     def apply_publish(self, handler_name, message, connector_name):
-        return self._handle(
-            reversed(self.middlewares), handler_name, message, connector_name)
+        return self._handle(self._get_chain(handler_name, True), 0,
+                            handler_name, message, connector_name)
 
     @inlineCallbacks
     def teardown(self):
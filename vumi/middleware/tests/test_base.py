@@ -1,10 +1,11 @@
 import time
 import yaml
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.trial.unittest import TestCase
 
 from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError,
                                   create_middlewares_from_config,
                                   setup_middlewares_from_config)
 
@@ -39,6 +40,28 @@ class ToyMiddleware(BaseMiddleware):
         return self._handle('failure', message, connector_name)
 
 
+class AsyncToyMiddleware(ToyMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        d = Deferred()
+        self.worker.pending.append((d, message))
+        d.addCallback(
+            lambda _: self._handle('inbound', message, connector_name))
+        return d
+
+
+class NoneMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        return None
+
+
+class BrokenMiddleware(BaseMiddleware):
+
+    def handle_inbound(self, message, connector_name):
+        raise ValueError("broken")
+
+
 class MiddlewareStackTestCase(TestCase):
 
     @inlineCallbacks
@@ -97,6 +120,48 @@ class MiddlewareStackTestCase(TestCase):
         self.assertEqual([mw.name for mw in teardown_order],
             ['mw3', 'mw2', 'mw1'])
 
+    def test_sync_handlers(self):
+        results = []
+        self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo'
+                                 ).addCallback(results.append)
+        # Nothing waits for the reactor if every handler is synchronous.
+        self.assertEqual(['dummy_msg.mw1.mw2.mw3'], results)
+
+    def test_async_handler(self):
+        self.pending = []
+        self.stack = MiddlewareStack([
+            ToyMiddleware('mw1', {}, self),
+            AsyncToyMiddleware('mw2', {}, self),
+            ToyMiddleware('mw3', {}, self),
+            ])
+        results = []
+        self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo'
+                                 ).addCallback(results.append)
+        self.assertEqual([], results)
+        [(d, message)] = self.pending
+        d.callback(None)
+        self.assertEqual(['dummy_msg.mw1.mw2.mw3'], results)
+
+    def test_passthrough_handlers_skipped(self):
+        mw = BaseMiddleware('base', {}, self)
+        self.stack = MiddlewareStack([mw, ToyMiddleware('mw1', {}, self)])
+        chain = self.stack._get_chain('inbound', False)
+        self.assertEqual(['mw1'], [m.name for m, handler in chain])
+
+    @inlineCallbacks
+    def test_none_returned(self):
+        self.stack = MiddlewareStack([NoneMiddleware('none', {}, self)])
+        yield self.assertFailure(
+            self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo'),
+            MiddlewareError)
+
+    @inlineCallbacks
+    def test_handler_raises(self):
+        self.stack = MiddlewareStack([BrokenMiddleware('broken', {}, self)])
+        yield self.assertFailure(
+            self.stack.apply_publish('inbound', 'dummy_msg', 'end_foo'),
+            ValueError)
+
 
 class UtilityFunctionsTestCase(TestCase):
 
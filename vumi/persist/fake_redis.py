@@ -65,6 +65,14 @@ class FakeRedis(object):
             if not (delayed.cancelled or delayed.called):
                 delayed.cancel()
 
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    @maybe_async
+    def _execute_pipeline(self, calls):
+        return [getattr(self, call).sync(self, *args, **kw)
+                for call, args, kw in calls]
+
     # Global operations
 
     @maybe_async
@@ -303,6 +311,45 @@ class FakeRedis(object):
         zval = self._data.get(key, Zset())
         return zval.zscore(value)
 
+    @maybe_async
+    def zinterstore(self, dest, keys, aggregate=None):
+        return self._zstore(dest, keys, aggregate, intersect=True)
+
+    @maybe_async
+    def zunionstore(self, dest, keys, aggregate=None):
+        return self._zstore(dest, keys, aggregate, intersect=False)
+
+    def _zstore(self, dest, keys, aggregate, intersect):
+        if not isinstance(keys, dict):
+            keys = dict((key, 1) for key in keys)
+        aggregate_func = {
+            'SUM': sum,
+            'MIN': min,
+            'MAX': max,
+        }[(aggregate or 'SUM').upper()]
+
+        weighted = []
+        for key, weight in keys.iteritems():
+            zval = self._data.get(key, Zset())
+            weighted.append(dict((value, score * weight)
+                                 for score, value in zval._zval))
+
+        values = set(weighted[0]) if weighted else set()
+        for scores in weighted[1:]:
+            if intersect:
+                values.intersection_update(scores)
+            else:
+                values.update(scores)
+
+        zval = Zset()
+        zval.zadd(**dict(
+            (value, aggregate_func([s[value] for s in weighted if value in s]))
+            for value in values))
+        self._data.pop(dest, None)
+        if zval.zcard():
+            self._data[dest] = zval
+        return zval.zcard()
+
     # List operations
     @maybe_async
     def llen(self, key):
@@ -396,6 +443,32 @@ class FakeRedis(object):
         return 0
 
 
+class FakePipeline(object):
+    """A fake redis pipeline.
+
+    Calls are queued and then run one after the other when `.execute()` is
+    called, with the same (single) fake delay as any other operation.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        # Fail early for things that aren't redis operations.
+        getattr(self._fake_redis, name).sync
+
+        def queue_call(*args, **kw):
+            self._calls.append((name, args, kw))
+            return self
+
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return self._fake_redis._execute_pipeline(calls)
+
+
 class Zset(object):
     """A Redis-like ordered set implementation."""
 
@@ -2,8 +2,13 @@
 
 """Base classes for Vumi persistence models."""
 
+import time
+from collections import OrderedDict
+from copy import deepcopy
 from functools import wraps
 
+from twisted.internet.defer import returnValue
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -250,11 +255,26 @@ class Model(object):
     def load(cls, manager, key, result=None):
         """Load an object from Riak.
 
+        If the manager has a cache for this model, the object may come from
+        there instead.
+
         :returns:
             A deferred that fires with the new model object.
         """
+        if result is None and manager.is_cached(cls):
+            return manager.load_cached(cls, key)
         return manager.load(cls, key, result=result)
 
+    @classmethod
+    def load_many(cls, manager, keys, concurrency=None):
+        """Load the objects for the given list of keys.
+
+        :returns:
+            A (possibly deferred) list of `(success, result)` tuples. See
+            :meth:`Manager.load_many`.
+        """
+        return manager.load_many(cls, keys, concurrency=concurrency)
+
     @classmethod
     def load_all_bunches(cls, manager, keys):
         """Load batches of objects for the given list of keys.
@@ -477,20 +497,95 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class ModelCache(object):
+    """An LRU cache of loaded model data for a single bucket.
+
+    Entries expire `ttl` seconds after they're loaded and the least recently
+    used entries are evicted once there are more than `max_size` of them.
+    Objects built from the cache are new instances with their own copy of
+    the data, so modifying one doesn't affect the cache.
+    """
+
+    DEFAULT_TTL = 60
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self, ttl=None, max_size=None, get_time=time.time):
+        self.ttl = ttl if ttl is not None else self.DEFAULT_TTL
+        self.max_size = (max_size if max_size is not None
+                         else self.DEFAULT_MAX_SIZE)
+        self.get_time = get_time
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation so that loads which started before an
+        # invalidation don't cache what may be stale data.
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, manager, modelcls, key):
+        """Build a model object from the cache or return None on a miss."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            cached_modelcls, expiry, data, indexes = entry
+            if cached_modelcls is modelcls and expiry > self.get_time():
+                self._entries[key] = entry
+                self.hits += 1
+                return self._build(manager, modelcls, key, data, indexes)
+        self.misses += 1
+        return None
+
+    def _build(self, manager, modelcls, key, data, indexes):
+        riak_object = manager.riak_object(modelcls, key)
+        riak_object.set_data(deepcopy(data))
+        for index_name, values in indexes:
+            for value in values:
+                riak_object.add_index(index_name, value)
+        return modelcls(manager, key, _riak_object=riak_object)
+
+    def put(self, modelobj):
+        riak_object = modelobj._riak_object
+        indexes = []
+        for descriptor in modelobj.field_descriptors.itervalues():
+            index_name = getattr(descriptor, 'index_name', None)
+            if index_name is not None:
+                indexes.append(
+                    (index_name, list(riak_object.get_indexes(index_name))))
+        self._entries.pop(modelobj.key, None)
+        self._entries[modelobj.key] = (
+            type(modelobj), self.get_time() + self.ttl,
+            deepcopy(riak_object.get_data()), indexes)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_BULK_CONCURRENCY = 10
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, model_cache=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
         self._bucket_cache = {}
+        self._model_caches = {}
+        for bucket, cache_config in (model_cache or {}).iteritems():
+            self.enable_cache(bucket, **cache_config)
 
     def proxy(self, modelcls):
         return ModelProxy(self, modelcls)
@@ -510,6 +605,50 @@ class Manager(object):
             self._bucket_cache[modelcls_id] = bucket
         return bucket
 
+    def enable_cache(self, modelcls_or_bucket, ttl=None, max_size=None):
+        """Cache objects loaded for a model.
+
+        :param modelcls_or_bucket:
+            The model class or its bucket name (without the bucket prefix).
+        :param int ttl:
+            Seconds before a cached object is reloaded from Riak.
+        :param int max_size:
+            Maximum number of objects to cache for this model.
+        """
+        bucket = getattr(modelcls_or_bucket, 'bucket', modelcls_or_bucket)
+        self._model_caches[bucket] = ModelCache(ttl=ttl, max_size=max_size)
+
+    def is_cached(self, modelcls):
+        return modelcls.bucket in self._model_caches
+
+    def load_cached(self, modelcls, key):
+        """Load a model instance, using the model's cache if possible."""
+        return self.call_decorator(self._load_cached)(modelcls, key)
+
+    def _load_cached(self, modelcls, key):
+        cache = self._model_caches[modelcls.bucket]
+        modelobj = cache.get(self, modelcls, key)
+        if modelobj is None:
+            generation = cache.generation
+            modelobj = yield self.load(modelcls, key)
+            if modelobj is not None and cache.generation == generation:
+                cache.put(modelobj)
+        returnValue(modelobj)
+
+    def invalidate_cached(self, modelobj):
+        """Drop the cached copy of `modelobj`, if there is one."""
+        cache = self._model_caches.get(modelobj.bucket)
+        if cache is not None:
+            cache.invalidate(modelobj.key)
+
+    def cache_stats(self):
+        """Return hit, miss and size counts for each model cache."""
+        return dict((bucket, {
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'size': len(cache),
+        }) for bucket, cache in self._model_caches.iteritems())
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -565,6 +704,38 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .load(...)")
 
+    def store_many(self, modelobjs, concurrency=None):
+        """Store several model objects in Riak.
+
+        Asynchronous managers store up to `concurrency` objects at once.
+
+        :returns:
+            A (possibly deferred) list of `(success, result)` tuples, one for
+            each object in the order given. `result` is the stored object, or
+            a :class:`Failure` if storing it failed.
+        """
+        return self._run_many(self.store, modelobjs, concurrency)
+
+    def load_many(self, modelcls, keys, concurrency=None):
+        """Load the model instances for a list of keys from Riak.
+
+        Asynchronous managers load up to `concurrency` objects at once.
+
+        :returns:
+            A (possibly deferred) list of `(success, result)` tuples, one for
+            each key in the order given. `result` is the model instance (or
+            None if the key doesn't exist), or a :class:`Failure` if loading
+            it failed.
+        """
+        return self._run_many(
+            lambda key: self.load(modelcls, key), keys, concurrency)
+
+    def _run_many(self, func, items, concurrency):
+        """Call `func` for each item, collecting `(success, result)` tuples.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._run_many(...)")
+
     def _load_bunch(self, model, keys):
         """Load the model instances for a batch of keys from Riak.
 
@@ -655,6 +826,9 @@ class ModelProxy(object):
     def load(self, key):
         return self._modelcls.load(self._manager, key)
 
+    def load_many(self, *args, **kw):
+        return self._modelcls.load_many(self._manager, *args, **kw)
+
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
@@ -179,6 +179,29 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def pipeline(self):
+        """Return a :class:`Pipeline` for queueing up several redis calls.
+
+        The pipeline has the same redis API as the manager (including key
+        prefixing), but calls are only sent to redis when `.execute()` is
+        called. All queued calls are sent in a single round trip and
+        `.execute()` returns (possibly via a deferred) a list of their
+        results in order.
+
+        Pipelines are not transactions: other clients' commands may be
+        interleaved with the pipelined ones.
+        """
+        return Pipeline(self)
+
+    def _execute_pipeline(self, calls):
+        """Send a list of `(call, args, kwargs)` tuples to redis in a single
+        round trip and return the list of results.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        return pipe.execute()
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -199,6 +222,15 @@ class Manager(object):
     def _unkeys(self, keys):
         return [self._unkey(k) for k in keys]
 
+    def _key_weights(self, keys):
+        """
+        Prefix a list of keys or a dict of keys to weights, as taken by
+        ZINTERSTORE and ZUNIONSTORE.
+        """
+        if isinstance(keys, dict):
+            return dict((self._key(k), w) for k, w in keys.iteritems())
+        return [self._key(k) for k in keys]
+
     # Global operations
 
     type = RedisCall(['key'])
@@ -256,6 +288,24 @@ class Manager(object):
     zscore = RedisCall(['key', 'value'])
     zcount = RedisCall(['key', 'min', 'max'])
 
+    def zinterstore(self, dest, keys, aggregate=None):
+        """
+        Store the intersection of the sorted sets in `keys` in `dest`.
+        `keys` may be a list of keys or a dict mapping keys to weights.
+        """
+        return self._make_redis_call('zinterstore', self._key(dest),
+                                     self._key_weights(keys),
+                                     aggregate=aggregate)
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        """
+        Store the union of the sorted sets in `keys` in `dest`.
+        `keys` may be a list of keys or a dict mapping keys to weights.
+        """
+        return self._make_redis_call('zunionstore', self._key(dest),
+                                     self._key_weights(keys),
+                                     aggregate=aggregate)
+
     # List operations
 
     llen = RedisCall(['key'])
@@ -274,3 +324,43 @@ class Manager(object):
     expire = RedisCall(['key', 'seconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+
+
+class Pipeline(Manager):
+    """A queue of redis calls to be sent in a single round trip.
+
+    Use :meth:`Manager.pipeline` to construct one of these rather than
+    instantiating it directly.
+    """
+
+    def __init__(self, manager):
+        super(Pipeline, self).__init__(manager._client, manager._key_prefix,
+                                       key_separator=manager._key_separator)
+        self._manager = manager
+        self._calls = []
+        self._filters = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw))
+
+    def _filter_redis_results(self, func, results):
+        self._filters[len(self._calls) - 1] = func
+
+    def _apply_filters(self, filters, results):
+        return [filters[i](result) if i in filters else result
+                for i, result in enumerate(results)]
+
+    def execute(self):
+        """Send all queued calls and return a list of their results.
+
+        The pipeline is empty again once this has been called, so it may be
+        reused.
+        """
+        calls, self._calls = self._calls, []
+        filters, self._filters = self._filters, {}
+        results = self._manager._execute_pipeline(calls)
+        return self._manager._filter_redis_results(
+            lambda r: self._apply_filters(filters, r), results)
@@ -7,6 +7,8 @@ import json
 from riak import (RiakClient, RiakObject, RiakMapReduce, RiakHttpTransport,
                     RiakPbcTransport)
 
+from twisted.python.failure import Failure
+
 from vumi.persist.model import Manager
 from vumi.utils import flatten_generator
 
@@ -53,7 +55,8 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   model_cache=config.get('model_cache'))
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -77,10 +80,12 @@ class RiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self.invalidate_cached(modelobj)
         modelobj._riak_object.store()
         return modelobj
 
     def delete(self, modelobj):
+        self.invalidate_cached(modelobj)
         modelobj._riak_object.delete()
 
     def load(self, modelcls, key, result=None):
@@ -97,6 +102,17 @@ class RiakManager(Manager):
             riak_object = migrator(riak_object).get_riak_object()
         return None
 
+    def _run_many(self, func, items, concurrency):
+        # Calls block, so they're made one at a time regardless of
+        # concurrency.
+        results = []
+        for item in items:
+            try:
+                results.append((True, func(item)))
+            except Exception:
+                results.append((False, Failure()))
+        return results
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
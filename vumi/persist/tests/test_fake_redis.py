@@ -156,6 +156,30 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(0.1, 'zscore', 'set', 'one')
         yield self.assert_redis_op(0.2, 'zscore', 'set', 'two')
 
+    @inlineCallbacks
+    def test_zinterstore(self):
+        yield self.redis.zadd('set1', one=1, two=2)
+        yield self.redis.zadd('set2', two=20, three=30)
+        yield self.assert_redis_op(1, 'zinterstore', 'dest', ['set1', 'set2'])
+        yield self.assert_redis_op(
+            [('two', 22.0)], 'zrange', 'dest', 0, -1, withscores=True)
+        yield self.assert_redis_op(
+            1, 'zinterstore', 'dest', {'set1': 0, 'set2': 1})
+        yield self.assert_redis_op(
+            [('two', 20.0)], 'zrange', 'dest', 0, -1, withscores=True)
+        yield self.assert_redis_op(0, 'zinterstore', 'dest', ['set1', 'no'])
+        yield self.assert_redis_op(False, 'exists', 'dest')
+
+    @inlineCallbacks
+    def test_zunionstore(self):
+        yield self.redis.zadd('set1', one=1, two=2)
+        yield self.redis.zadd('set2', two=20, three=30)
+        yield self.assert_redis_op(
+            3, 'zunionstore', 'dest', ['set1', 'set2'], aggregate='MAX')
+        yield self.assert_redis_op(
+            [('one', 1.0), ('two', 20.0), ('three', 30.0)],
+            'zrange', 'dest', 0, -1, withscores=True)
+
     @inlineCallbacks
     def test_hgetall_returns_copy(self):
         yield self.redis.hset("hash", "foo", "1")
@@ -300,6 +324,18 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(0, 'persist', "tempval")
         yield self.assert_redis_op(1, 'expire', "tempval", 10)
 
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        pipe.set("foo", "bar")
+        pipe.incr("counter")
+        pipe.get("foo")
+        # Nothing happens until the pipeline is executed.
+        yield self.assert_redis_op(None, 'get', "foo")
+        results = yield pipe.execute()
+        self.assertEqual(results, [None, 1, "bar"])
+        yield self.assert_redis_op("bar", 'get', "foo")
+
     @inlineCallbacks
     def test_type(self):
         yield self.assert_redis_op('none', 'type', 'unknown_key')
@@ -743,6 +743,101 @@ class TestModelOnTxRiak(TestCase):
             self.assertEqual(
                 e.args[0], 'No migrators defined for VersionedModel version 3')
 
+    @Manager.calls_manager
+    def test_store_many_and_load_many(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        objs = [simple_model(str(i), a=i, b=u'x') for i in range(5)]
+        results = yield self.manager.store_many(objs, concurrency=2)
+        self.assertEqual(results, [(True, obj) for obj in objs])
+
+        results = yield simple_model.load_many(
+            ['3', 'missing', '1'], concurrency=2)
+        self.assertEqual([success for success, _ in results], [True] * 3)
+        [s3, missing, s1] = [obj for _, obj in results]
+        self.assertEqual(s3.a, 3)
+        self.assertEqual(missing, None)
+        self.assertEqual(s1.a, 1)
+
+    @Manager.calls_manager
+    def test_load_many_failure(self):
+        odd_model = self.manager.proxy(UnknownVersionedModel)
+        new_model = self.manager.proxy(VersionedModel)
+        yield odd_model("foo", d=1).save()
+        yield new_model("bar", c=2).save()
+
+        [(foo_success, foo), (bar_success, bar)] = yield new_model.load_many(
+            ["foo", "bar"])
+        self.assertFalse(foo_success)
+        self.assertTrue(foo.check(ModelMigrationError))
+        self.assertTrue(bar_success)
+        self.assertEqual(bar.c, 2)
+
+    @Manager.calls_manager
+    def test_cached_load(self):
+        self.manager.enable_cache(SimpleModel)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=1, b=u"x").save()
+
+        s1 = yield simple_model.load("foo")
+        s2 = yield simple_model.load("foo")
+        self.assertFalse(s1 is s2)
+        self.assertEqual((s2.a, s2.b), (1, u"x"))
+        self.assertEqual(self.manager.cache_stats(), {
+            'simplemodel': {'hits': 1, 'misses': 1, 'size': 1}})
+
+        # Changes that haven't been saved don't affect the cache.
+        s2.a = 2
+        s3 = yield simple_model.load("foo")
+        self.assertEqual(s3.a, 1)
+
+        yield s2.save()
+        s4 = yield simple_model.load("foo")
+        self.assertEqual(s4.a, 2)
+        self.assertEqual(self.manager.cache_stats()['simplemodel']['misses'],
+                         2)
+
+        yield s4.delete()
+        s5 = yield simple_model.load("foo")
+        self.assertEqual(s5, None)
+
+    @Manager.calls_manager
+    def test_cached_load_keeps_indexes(self):
+        self.manager.enable_cache(IndexedModel)
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo", a=1, b=u"x").save()
+        yield indexed_model.load("foo")
+
+        cached = yield indexed_model.load("foo")
+        cached.b = u"y"
+        yield cached.save()
+        keys = yield indexed_model.index_lookup('a', 1).get_keys()
+        self.assertEqual(keys, ["foo"])
+        keys = yield indexed_model.index_lookup('b', u"y").get_keys()
+        self.assertEqual(keys, ["foo"])
+
+    @Manager.calls_manager
+    def test_cache_expiry_and_eviction(self):
+        self.manager.enable_cache('simplemodel', ttl=10, max_size=2)
+        cache = self.manager._model_caches['simplemodel']
+        now = [0]
+        cache.get_time = lambda: now[0]
+        simple_model = self.manager.proxy(SimpleModel)
+        for key in ["one", "two", "three"]:
+            yield simple_model(key, a=1, b=u"x").save()
+
+        yield simple_model.load("one")
+        yield simple_model.load("two")
+        yield simple_model.load("one")
+        yield simple_model.load("three")
+        # "two" was least recently used.
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(sorted(cache._entries), ["one", "three"])
+
+        now[0] = 10
+        yield simple_model.load("one")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 4)
+
 
 class TestModelOnRiak(TestModelOnTxRiak):
 
@@ -38,3 +38,18 @@ class RedisManagerTestCase(TestCase):
         self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
+
+    def test_pipeline(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo')
+        pipe.set('baz', 'quux')
+        pipe.keys()
+        self.assertEqual(None, self.manager.get('baz'))
+        self.assertEqual(['bar', None, ['baz', 'foo']],
+                         self.sort_last(pipe.execute()))
+        self.assertEqual('quux', self.manager.get('baz'))
+        self.assertEqual([], pipe.execute())
+
+    def sort_last(self, results):
+        return results[:-1] + [sorted(results[-1])]
@@ -37,3 +37,17 @@ class RedisManagerTestCase(TestCase):
         yield self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], (yield self.manager.keys()))
         self.assertEqual('baz', (yield self.manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        pipe.get('foo')
+        pipe.set('baz', 'quux')
+        pipe.keys()
+        self.assertEqual(None, (yield self.manager.get('baz')))
+        [foo, _, keys] = yield pipe.execute()
+        self.assertEqual('bar', foo)
+        self.assertEqual(['baz', 'foo'], sorted(keys))
+        self.assertEqual('quux', (yield self.manager.get('baz')))
+        self.assertEqual([], (yield pipe.execute()))
@@ -1,7 +1,10 @@
 """Tests for vumi.persist.txriak_manager."""
 
 from twisted.trial.unittest import TestCase
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 
 from vumi.persist.model import Manager
 from vumi.tests.utils import import_skip
@@ -249,3 +252,67 @@ class TestTxRiakManager(CommonRiakManagerTests, TestCase):
             })
         self.assertEqual(type(manager.client.transport),
             transport.HTTPTransport)
+
+    def test_transport_class_pooled_http(self):
+        from vumi.persist.txriak_manager import PooledHTTPTransport
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            'connection_pool': True,
+            'nodes': [['127.0.0.1', 8098], ['localhost', 8098]],
+            'max_connections_per_node': 5,
+            'idle_timeout': 30,
+            })
+        self.addCleanup(manager.connection_pool.close)
+        self.assertTrue(
+            isinstance(manager.client.transport, PooledHTTPTransport))
+        pool = manager.connection_pool
+        self.assertEqual(
+            pool.nodes, [('127.0.0.1', 8098), ('localhost', 8098)])
+        self.assertEqual(pool.max_connections_per_node, 5)
+        self.assertEqual(pool.idle_timeout, 30)
+
+
+class TestRiakConnectionPool(TestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import RiakConnectionPool
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.pool_class = RiakConnectionPool
+
+    @inlineCallbacks
+    def test_request(self):
+        class NodeResource(Resource):
+            isLeaf = True
+
+            def __init__(self, name):
+                Resource.__init__(self)
+                self.name = name
+
+            def render_GET(self, request):
+                return "%s:%s" % (self.name, request.path)
+
+        nodes = []
+        for name in ["a", "b"]:
+            port = reactor.listenTCP(
+                0, Site(NodeResource(name)), interface='127.0.0.1')
+            self.addCleanup(port.stopListening)
+            nodes.append(('127.0.0.1', port.getHost().port))
+
+        pool = self.pool_class(nodes, max_connections_per_node=2)
+        self.addCleanup(pool.close)
+        bodies = []
+        for _ in range(4):
+            code, headers, body = yield pool.request('GET', '/riak/foo')
+            self.assertEqual(code, 200)
+            bodies.append(body)
+        self.assertEqual(bodies, ['a:/riak/foo', 'b:/riak/foo'] * 2)
+
+        metrics = pool.get_metrics()
+        self.assertEqual(sorted(metrics), sorted("%s:%d" % n for n in nodes))
+        for node_metrics in metrics.values():
+            self.assertEqual(node_metrics, {
+                'in_use': 0, 'waiting': 0, 'max': 2,
+                'requests': 2, 'errors': 0})
@@ -0,0 +1,107 @@
+"""Tests for vumi.persist.write_behind."""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+
+from vumi.persist.write_behind import WriteBehind
+
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pending = []
+        self.writes = []
+
+    def write(self):
+        written, self.pending = self.pending, []
+        d = Deferred()
+        self.writes.append((written, d))
+        return d
+
+    def mk_writer(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return WriteBehind(self.write, lambda: len(self.pending), **kw)
+
+    def change(self, writer, value):
+        self.pending.append(value)
+        writer.changed()
+
+    def finish_write(self, index=-1):
+        self.writes[index][1].callback(None)
+
+    def test_flush_interval(self):
+        writer = self.mk_writer(flush_interval=1)
+        self.change(writer, 'a')
+        self.change(writer, 'b')
+        self.clock.advance(0.5)
+        self.assertEqual([], self.writes)
+        self.clock.advance(0.5)
+        self.assertEqual([['a', 'b']], [w for w, _ in self.writes])
+        self.finish_write()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_flush_size(self):
+        writer = self.mk_writer(flush_size=2)
+        self.change(writer, 'a')
+        self.assertEqual([], self.writes)
+        self.change(writer, 'b')
+        self.assertEqual([['a', 'b']], [w for w, _ in self.writes])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_flush_nothing_pending(self):
+        writer = self.mk_writer()
+        self.assertTrue(writer.flush().called)
+        self.assertEqual([], self.writes)
+
+    def test_flushes_coalesced(self):
+        writer = self.mk_writer(flush_size=1)
+        self.change(writer, 'a')
+        # Changes made while a write is running are all written by a
+        # single further write.
+        for value in 'bcdef':
+            self.change(writer, value)
+        self.assertEqual(1, len(self.writes))
+        self.finish_write()
+        self.assertEqual([['a'], list('bcdef')],
+                         [w for w, _ in self.writes])
+        self.finish_write()
+        self.assertEqual(2, len(self.writes))
+
+    def test_flush_waits_for_own_changes(self):
+        writer = self.mk_writer()
+        self.change(writer, 'a')
+        d1 = writer.flush()
+        self.change(writer, 'b')
+        d2 = writer.flush()
+        d3 = writer.flush()
+        self.finish_write()
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        self.assertFalse(d3.called)
+        self.assertEqual([['a'], ['b']], [w for w, _ in self.writes])
+        self.finish_write()
+        self.assertTrue(d2.called)
+        self.assertTrue(d3.called)
+
+    def test_failed_write_rescheduled(self):
+        writer = self.mk_writer(flush_interval=1)
+        self.change(writer, 'a')
+        d = writer.flush()
+        # The owner puts the changes back when a write fails.
+        self.pending.append('a')
+        self.finish_write()
+        self.assertTrue(d.called)
+        self.assertEqual(1, len(self.writes))
+        self.clock.advance(1)
+        self.assertEqual([['a'], ['a']], [w for w, _ in self.writes])
+
+    def test_stop(self):
+        writer = self.mk_writer(flush_interval=1)
+        self.change(writer, 'a')
+        d = writer.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.finish_write()
+        self.assertTrue(d.called)
+        self.assertEqual([['a']], [w for w, _ in self.writes])
@@ -13,7 +13,7 @@ except ImportError:
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, Deferred, maybeDeferred)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
@@ -98,6 +98,58 @@ class VumiRedis(txr.Redis):
             d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
         return d
 
+    def zinterstore(self, dest, keys, aggregate=None):
+        return self._zstore('ZINTERSTORE', dest, keys, aggregate)
+
+    def zunionstore(self, dest, keys, aggregate=None):
+        return self._zstore('ZUNIONSTORE', dest, keys, aggregate)
+
+    def _zstore(self, command, dest, keys, aggregate):
+        weights = None
+        if isinstance(keys, dict):
+            keys, weights = zip(*keys.items())
+        args = [dest, len(keys)] + list(keys)
+        if weights:
+            args.extend(['WEIGHTS'] + list(weights))
+        if aggregate:
+            args.extend(['AGGREGATE', aggregate])
+        self._send(command, *args)
+        return self.getResponse()
+
+    def pipeline(self, transaction=False):
+        return VumiRedisPipeline(self)
+
+
+class VumiRedisPipeline(object):
+    """A pipeline for txredis.
+
+    The txredis protocol already matches responses to requests in order, so
+    pipelining is just a matter of sending all the queued commands without
+    waiting for each response in between.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue_call(*args, **kw):
+            self._calls.append((method, args, kw))
+            return self
+
+        return queue_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        deferreds = [maybeDeferred(method, *args, **kw)
+                     for method, args, kw in calls]
+        d = DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(lambda results: [result for _, result in results],
+                       lambda f: f.value.subFailure)
+        return d
+
 
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
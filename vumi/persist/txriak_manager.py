@@ -2,18 +2,133 @@
 
 """A manager implementation on top of txriak."""
 
+from itertools import cycle
+
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
 from riakasaurus import transport
+from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, gatherResults, maybeDeferred, succeed)
+    inlineCallbacks, gatherResults, maybeDeferred, succeed, DeferredList,
+    DeferredSemaphore)
+from twisted.web.client import Agent, HTTPConnectionPool
 
 from vumi.persist.model import Manager
+from vumi.utils import SimplishReceiver, StringProducer, mkheaders
+
+
+class RiakConnectionPool(object):
+    """Persistent HTTP connections to one or more Riak nodes.
+
+    Requests are spread over `nodes` (a list of `(host, port)` pairs) in
+    round-robin order. At most `max_connections_per_node` requests are made
+    to each node at once and further requests wait for a free connection.
+    Connections are kept open between requests and closed once they have
+    been idle for `idle_timeout` seconds.
+    """
+
+    DEFAULT_MAX_CONNECTIONS_PER_NODE = 20
+    DEFAULT_IDLE_TIMEOUT = 240
+
+    def __init__(self, nodes, max_connections_per_node=None,
+                 idle_timeout=None):
+        self.nodes = [(host, int(port)) for host, port in nodes]
+        self.max_connections_per_node = (
+            max_connections_per_node or self.DEFAULT_MAX_CONNECTIONS_PER_NODE)
+        self.idle_timeout = idle_timeout or self.DEFAULT_IDLE_TIMEOUT
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = self.max_connections_per_node
+        self._pool.cachedConnectionTimeout = self.idle_timeout
+        self._agent = Agent(reactor, pool=self._pool)
+        self._node_cycle = cycle(self.nodes)
+        self._node_slots = dict(
+            (node, DeferredSemaphore(self.max_connections_per_node))
+            for node in self.nodes)
+        self._requests = dict((node, 0) for node in self.nodes)
+        self._errors = dict((node, 0) for node in self.nodes)
+
+    def next_node(self):
+        return next(self._node_cycle)
+
+    def request(self, method, path, headers=None, body=None):
+        """Make an HTTP request to the next node.
+
+        :returns:
+            A deferred that fires with a `(status_code, headers, body)`
+            tuple, where `headers` is a :class:`Headers` instance.
+        """
+        node = self.next_node()
+        self._requests[node] += 1
+        d = self._node_slots[node].run(
+            self._request, node, method, path, headers, body)
+        d.addErrback(self._request_failed, node)
+        return d
+
+    def _request(self, node, method, path, headers, body):
+        url = "http://%s:%d%s" % (node[0], node[1], path)
+        d = self._agent.request(
+            method, url, mkheaders(headers or {}),
+            StringProducer(body) if body else None)
+        d.addCallback(lambda response: SimplishReceiver(response).deferred)
+        d.addCallback(lambda response: (
+            response.code, response.headers, response.delivered_body))
+        return d
+
+    def _request_failed(self, failure, node):
+        self._errors[node] += 1
+        return failure
+
+    def get_metrics(self):
+        """Return pool utilisation figures for each node.
+
+        :returns:
+            A dict mapping `"host:port"` to a dict of `in_use` and `waiting`
+            request counts, `max` connections and total `requests` and
+            `errors` made.
+        """
+        metrics = {}
+        for node in self.nodes:
+            slots = self._node_slots[node]
+            metrics["%s:%d" % node] = {
+                'in_use': slots.limit - slots.tokens,
+                'waiting': len(slots.waiting),
+                'max': slots.limit,
+                'requests': self._requests[node],
+                'errors': self._errors[node],
+            }
+        return metrics
+
+    def close(self):
+        """Close all idle connections."""
+        return self._pool.closeCachedConnections()
+
+
+class PooledHTTPTransport(transport.HTTPTransport):
+    """A riakasaurus HTTP transport that uses a :class:`RiakConnectionPool`.
+
+    The node to talk to is chosen by the pool, so the host and port passed
+    in by the client are ignored. Sub-classes must set `pool`.
+    """
+
+    pool = None
+
+    def http_request(self, method, host, port, path, headers=None, obj=''):
+        d = self.pool.request(method, path, headers, obj)
+
+        def parse_response((code, headers, body)):
+            # Match HTTPTransport's response format.
+            response_headers = {'http_code': code}
+            for name, values in headers.getAllRawHeaders():
+                response_headers[name.lower()] = ', '.join(values)
+            return response_headers, body
+
+        return d.addCallback(parse_response)
 
 
 class TxRiakManager(Manager):
     """A persistence manager for txriak."""
 
     call_decorator = staticmethod(inlineCallbacks)
+    connection_pool = None
 
     @classmethod
     def from_config(cls, config):
@@ -34,14 +149,29 @@ class TxRiakManager(Manager):
         prefix = config.get('prefix', 'riak')
         mapred_prefix = config.get('mapred_prefix', 'mapred')
         client_id = config.get('client_id')
+
+        pool = None
+        if (transport_class is transport.HTTPTransport and
+                config.get('connection_pool', False)):
+            pool = RiakConnectionPool(
+                config.get('nodes', [(host, port)]),
+                max_connections_per_node=config.get(
+                    'max_connections_per_node'),
+                idle_timeout=config.get('idle_timeout'))
+            transport_class = type('PooledHTTPTransport',
+                                   (PooledHTTPTransport,), {'pool': pool})
+
         # NOTE: the current riakasaurus RiakClient doesn't accept
         #       transport_options or solr_transport_class like the sync
         #       RiakManager client.
         client = RiakClient(host=host, port=port, prefix=prefix,
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
-        return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+        manager = cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
+                      mapreduce_timeout=mapreduce_timeout,
+                      model_cache=config.get('model_cache'))
+        manager.connection_pool = pool
+        return manager
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -93,12 +223,21 @@ class TxRiakManager(Manager):
         return riak_object
 
     def store(self, modelobj):
+        self.invalidate_cached(modelobj)
         d = modelobj._riak_object.store()
+        d.addCallback(self._invalidate_after, modelobj)
         d.addCallback(lambda result: modelobj)
         return d
 
     def delete(self, modelobj):
-        return modelobj._riak_object.delete()
+        self.invalidate_cached(modelobj)
+        d = modelobj._riak_object.delete()
+        return d.addCallback(self._invalidate_after, modelobj)
+
+    def _invalidate_after(self, result, modelobj):
+        # Anything cached while the request was in flight may be stale.
+        self.invalidate_cached(modelobj)
+        return result
 
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
@@ -119,6 +258,12 @@ class TxRiakManager(Manager):
 
         return d.addCallback(build_model_object)
 
+    def _run_many(self, func, items, concurrency):
+        semaphore = DeferredSemaphore(
+            concurrency or self.DEFAULT_BULK_CONCURRENCY)
+        return DeferredList([semaphore.run(func, item) for item in items],
+                            consumeErrors=True)
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
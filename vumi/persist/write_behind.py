@@ -0,0 +1,108 @@
+# -*- test-case-name: vumi.persist.tests.test_write_behind -*-
+
+"""Writing buffered changes out in the background."""
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+
+class WriteBehind(object):
+    """Decides when changes buffered by its owner are written out.
+
+    The owner buffers changes itself and calls :meth:`changed` after each
+    one. A write is started `flush_interval` seconds after the first
+    buffered change, or straight away once `flush_size` changes have built
+    up. Only one write is ever in progress. Asking for another while one is
+    running sets a flag, and a single further write is started when the
+    running one is done, however many times it was asked for.
+
+    :param write:
+        Called with no arguments to take everything buffered and write it
+        out. Returns a deferred (or nothing). Write failures should be
+        handled by the owner, usually by buffering the changes again.
+    :param pending_count:
+        Called with no arguments to get the number of buffered changes.
+    :param float flush_interval:
+        Maximum number of seconds a change is held before it is written.
+    :param int flush_size:
+        Number of buffered changes that triggers an immediate write.
+    :param clock:
+        Something providing `callLater`. Defaults to the reactor.
+    """
+
+    def __init__(self, write, pending_count, flush_interval=1.0,
+                 flush_size=100, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.write = write
+        self.pending_count = pending_count
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.clock = clock
+        self._flush_call = None
+        self._flush_d = None
+        self._flush_again = False
+        # Deferreds waiting on the running write and on the one after it.
+        self._waiters = []
+        self._next_waiters = []
+
+    def changed(self):
+        """Note that a change has been buffered."""
+        if self.pending_count() >= self.flush_size:
+            self._start_flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.flush_interval, self._start_flush)
+
+    def flush(self):
+        """Write out everything buffered as soon as possible.
+
+        Returns a deferred that fires once everything buffered before the
+        call has been written (or the write has failed).
+        """
+        self._start_flush()
+        if self._flush_d is None:
+            return succeed(None)
+        d = Deferred()
+        if self._flush_again:
+            self._next_waiters.append(d)
+        else:
+            self._waiters.append(d)
+        return d
+
+    def stop(self):
+        """Cancel any scheduled write and write out what is left."""
+        return self.flush()
+
+    def _cancel_flush_call(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+    def _start_flush(self):
+        self._cancel_flush_call()
+        if self._flush_d is not None:
+            self._flush_again = True
+            return
+        if not self.pending_count():
+            return
+        d = self._flush_d = maybeDeferred(self.write)
+        d.addBoth(self._flushed)
+
+    def _flushed(self, result):
+        self._flush_d = None
+        waiters, self._waiters = self._waiters, self._next_waiters
+        self._next_waiters = []
+        if self._flush_again:
+            self._flush_again = False
+            self._start_flush()
+        if self._flush_d is None:
+            # Nothing left to write, or the write finished already.
+            waiters.extend(self._waiters)
+            self._waiters = []
+            if self.pending_count() and self._flush_call is None:
+                self._flush_call = self.clock.callLater(
+                    self.flush_interval, self._start_flush)
+        for d in waiters:
+            d.callback(None)
@@ -0,0 +1,128 @@
+import sys
+import time
+import random
+from twisted.python import usage
+
+from vumi.message import TransportUserMessage
+from vumi.dispatchers.base import ContentKeywordRouter
+from vumi.utils import get_first_word
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["rules", "r", "10000", "Number of routing rules."],
+        ["messages", "m", "100000", "Number of messages to route."],
+        ["seed", "s", "0", "Random seed for generating rules and messages."],
+    ]
+
+    optFlags = [
+        ["linear", "l",
+         "Also time a linear scan over the rules for comparison."],
+    ]
+
+    longdesc = """Benchmarks inbound message routing in
+    ContentKeywordRouter."""
+
+
+def is_msg_matching_routing_rules(keyword, msg, rule):
+    """The check ContentKeywordRouter used to make against every rule."""
+    return all([keyword == rule['keyword'],
+                (not 'to_addr' in rule) or
+                (msg['to_addr'] == rule['to_addr']),
+                (not 'prefix' in rule) or
+                (msg['from_addr'].startswith(rule['prefix']))])
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.published = 0
+
+    def publish_inbound_message(self, name, msg):
+        self.published += 1
+
+
+class KeywordRoutingBenchmark(object):
+    """
+    Routes messages through a ContentKeywordRouter with many rules.
+    """
+
+    TO_ADDRS = ['%d' % (i,) for i in range(1000, 1050)]
+    PREFIXES = ['+27', '+2782', '+2783', '+256', '+2567', '+254']
+
+    def __init__(self, options):
+        self.rules = int(options['rules'])
+        self.messages = int(options['messages'])
+        self.linear = options['linear']
+        self.random = random.Random(int(options['seed']))
+
+    def make_rules(self):
+        rules = []
+        for i in xrange(self.rules):
+            rule = {'app': 'app%d' % (i % 20,), 'keyword': 'kw%d' % (i,)}
+            if i % 2:
+                rule['to_addr'] = self.random.choice(self.TO_ADDRS)
+            if i % 3:
+                rule['prefix'] = self.random.choice(self.PREFIXES)
+            rules.append(rule)
+        return rules
+
+    def make_messages(self):
+        return [TransportUserMessage(
+            to_addr=self.random.choice(self.TO_ADDRS),
+            from_addr=self.random.choice(self.PREFIXES) + '1234567',
+            transport_name="bench", transport_type="sms",
+            content="kw%d hello" % (self.random.randrange(self.rules),))
+            for _ in xrange(self.messages)]
+
+    def make_router(self, rules):
+        router = ContentKeywordRouter(FakeDispatcher(), {
+            'dispatcher_name': 'bench',
+            'transport_mappings': {},
+            'rules': rules,
+            # setup_routing() connects to Redis, which we don't need.
+            'redis_manager': {'FAKE_REDIS': True},
+            })
+        router.setup_routing()
+        return router
+
+    def time(self, name, router, messages, func):
+        start = time.time()
+        for msg in messages:
+            func(msg)
+        elapsed = time.time() - start
+        print "%-8s %d messages, %d published in %.3fs: %.0f msgs/s" % (
+            name, len(messages), router.dispatcher.published, elapsed,
+            len(messages) / elapsed)
+
+    def linear_dispatch(self, router):
+        def dispatch(msg):
+            keyword = get_first_word(msg['content']).lower()
+            for rule in router.rules:
+                if is_msg_matching_routing_rules(keyword, msg, rule):
+                    router.publish_exposed_inbound(rule['app'], msg.copy())
+        return dispatch
+
+    def run(self):
+        rules = self.make_rules()
+        messages = self.make_messages()
+        router = self.make_router(rules)
+        self.time("indexed", router, messages,
+                  router.dispatch_inbound_message)
+        if self.linear:
+            # A linear scan is slow enough that we only use some messages.
+            messages = messages[:max(1, len(messages) // 100)]
+            router = self.make_router(rules)
+            self.time("linear", router, messages,
+                      self.linear_dispatch(router))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    KeywordRoutingBenchmark(options).run()
@@ -0,0 +1,77 @@
+import sys
+import time
+from twisted.python import usage
+
+from vumi.message import (TransportUserMessage, TransportEvent,
+                          MESSAGE_CODECS, get_codec)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to encode and decode for each codec."],
+    ]
+
+    longdesc = """Benchmarks the message codecs in vumi.message"""
+
+
+class CodecBenchmark(object):
+    """
+    Encodes and decodes user messages and events with each codec.
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+
+    def make_messages(self):
+        user_msg = TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="Hello world",
+            transport_metadata={'foo': 'bar'},
+            helper_metadata={'tag': {'tag': ['pool', 'tag1']}})
+        event = TransportEvent(
+            user_message_id=user_msg['message_id'], event_type='ack',
+            sent_message_id='abc', transport_name="bench")
+        return [user_msg, event]
+
+    def time(self, func, *args):
+        start = time.time()
+        for _ in xrange(self.messages):
+            func(*args)
+        elapsed = time.time() - start
+        return self.messages / elapsed
+
+    def run_codec(self, content_type, msg):
+        msg_class = type(msg)
+        data = msg.encode(content_type)
+        if msg_class.decode(data, content_type) != msg:
+            raise RuntimeError("%s round trip changed %r" % (
+                content_type, msg))
+        encode_rate = self.time(msg.encode, content_type)
+        decode_rate = self.time(msg_class.decode, data, content_type)
+        print "  %-24s %6d bytes %10.0f enc/s %10.0f dec/s" % (
+            content_type, len(data), encode_rate, decode_rate)
+
+    def run(self):
+        for msg in self.make_messages():
+            print "%s:" % (type(msg).__name__,)
+            print "  %-24s %10.0f copies/s" % ("copy()", self.time(msg.copy))
+            for content_type in sorted(MESSAGE_CODECS):
+                try:
+                    get_codec(content_type)
+                except ImportError, e:
+                    print "  %-24s skipped (%s)" % (content_type, e)
+                    continue
+                self.run_codec(content_type, msg)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    CodecBenchmark(options).run()
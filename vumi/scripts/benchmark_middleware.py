@@ -0,0 +1,82 @@
+import sys
+import time
+from twisted.python import usage
+
+from vumi.message import TransportUserMessage
+from vumi.middleware.base import BaseMiddleware, MiddlewareStack
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "100000",
+         "Number of messages to pass through each stack."],
+    ]
+
+    longdesc = """Benchmarks the per-message overhead of MiddlewareStack
+    with 0, 3 and 10 middlewares."""
+
+
+class CountingMiddleware(BaseMiddleware):
+    """Middleware with a (trivial) synchronous inbound handler."""
+
+    def setup_middleware(self):
+        self.count = 0
+
+    def handle_inbound(self, message, connector_name):
+        self.count += 1
+        return message
+
+
+class MiddlewareBenchmark(object):
+    """
+    Passes inbound messages through middleware stacks of various sizes.
+    """
+
+    SIZES = [0, 3, 10]
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+
+    def make_stack(self, cls, size):
+        middlewares = []
+        for i in range(size):
+            mw = cls('mw%d' % (i,), {}, None)
+            mw.setup_middleware()
+            middlewares.append(mw)
+        return MiddlewareStack(middlewares)
+
+    def time(self, stack, msg):
+        results = []
+        start = time.time()
+        for _ in xrange(self.messages):
+            stack.apply_consume('inbound', msg, 'bench').addCallback(
+                results.append)
+        elapsed = time.time() - start
+        if len(results) != self.messages:
+            raise RuntimeError("Expected %d results, got %d" % (
+                self.messages, len(results)))
+        return elapsed
+
+    def run(self):
+        msg = TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="Hello world")
+        for name, cls in [("handler", CountingMiddleware),
+                          ("no handler", BaseMiddleware)]:
+            for size in self.SIZES:
+                elapsed = self.time(self.make_stack(cls, size), msg)
+                print "%-10s %2d middlewares: %6.2fus/msg %10.0f msgs/s" % (
+                    name, size, elapsed * 1e6 / self.messages,
+                    self.messages / elapsed)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    MiddlewareBenchmark(options).run()
@@ -3,7 +3,7 @@ import sys
 import time
 from twisted.python import usage
 from twisted.internet import reactor
-from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
+from twisted.internet.defer import maybeDeferred, inlineCallbacks
 
 from vumi.message import TransportUserMessage
 from vumi.persist.model import Model
@@ -49,20 +49,15 @@ class WriteReadBenchmark(object):
                     content="Batch: %d. Msg: %d" % (batch_no, i))
                 for i in range(num_msgs)]
 
-    def write_batch(self, model, msgs):
+    def write_batch(self, manager, model, msgs):
         print "  Writing %d messages." % len(msgs)
-        deferreds = []
-        for msg in msgs:
-            msg_obj = model(key=msg['message_id'], msg=msg)
-            deferreds.append(msg_obj.save())
-        return DeferredList(deferreds)
+        msg_objs = [model(key=msg['message_id'], msg=msg) for msg in msgs]
+        return manager.store_many(msg_objs, concurrency=self.concurrent)
 
     def read_batch(self, model, msgs):
         print "  Reading %d messages." % len(msgs)
-        deferreds = []
-        for msg in msgs:
-            deferreds.append(model.load(msg['message_id']))
-        return DeferredList(deferreds)
+        return model.load_many([msg['message_id'] for msg in msgs],
+                               concurrency=self.concurrent)
 
     @inlineCallbacks
     def run(self):
@@ -75,7 +70,7 @@ class WriteReadBenchmark(object):
         start = time.time()
 
         for batch in msg_batches:
-            yield self.write_batch(model, batch)
+            yield self.write_batch(manager, model, batch)
 
         write_done = time.time()
         write_time = write_done - start
@@ -0,0 +1,100 @@
+import sys
+import json
+import time
+from twisted.internet.defer import succeed
+from twisted.python import usage
+
+from vumi.application.sandbox import SandboxProtocol
+from vumi.application.sandbox_framing import (
+    frame, frame_buffer, LINES, LENGTH_PREFIXED)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["commands", "n", "100000",
+         "Number of commands to feed in."],
+        ["payload-size", "s", "100",
+         "Bytes of padding to put in each command."],
+        ["chunk-size", "c", "65536",
+         "Bytes per outReceived() call, like reads from a pipe."],
+        ["framing", "f", LINES,
+         "Framing to use, '%s' or '%s'." % (LINES, LENGTH_PREFIXED)],
+    ]
+
+    longdesc = """Benchmarks SandboxProtocol.outReceived with a stream of
+    commands from a sandboxed process."""
+
+
+class NullSandboxApi(object):
+    def set_sandbox(self, sandbox, session_id=None):
+        pass
+
+    def dispatch_request(self, command):
+        return succeed(None)
+
+
+class NullTransport(object):
+    pid = None
+
+    def write(self, data):
+        pass
+
+
+class SandboxProtocolBenchmark(object):
+    """
+    Feeds a stream of commands through SandboxProtocol.outReceived.
+    """
+
+    def __init__(self, options):
+        self.commands = int(options['commands'])
+        self.payload_size = int(options['payload-size'])
+        self.chunk_size = int(options['chunk-size'])
+        self.framing = options['framing']
+
+    def make_protocol(self, recv_limit):
+        protocol = SandboxProtocol(
+            'bench', NullSandboxApi(), None, {}, {}, 60, recv_limit)
+        protocol.cancel_timeout()
+        protocol.transport = NullTransport()
+        protocol._out_buffer = frame_buffer(self.framing, recv_limit)
+        return protocol
+
+    def make_data(self):
+        padding = "x" * self.payload_size
+        return ''.join(
+            frame(json.dumps({
+                'cmd': 'log.info', 'cmd_id': str(i), 'reply': False,
+                'msg': padding}), self.framing)
+            for i in xrange(self.commands))
+
+    def chunks(self, data):
+        return [data[i:i + self.chunk_size]
+                for i in xrange(0, len(data), self.chunk_size)]
+
+    def run(self):
+        data = self.make_data()
+        chunks = self.chunks(data)
+        protocol = self.make_protocol(recv_limit=len(data) + 1)
+        start = time.time()
+        for chunk in chunks:
+            protocol.outReceived(chunk)
+        elapsed = time.time() - start
+        handled = len(protocol._pending_requests)
+        if handled != self.commands:
+            raise RuntimeError("Expected %d commands, got %d" % (
+                self.commands, handled))
+        print "%d commands (%d bytes in %d reads) in %.3fs: %.0f cmds/s" % (
+            self.commands, len(data), len(chunks), elapsed,
+            self.commands / elapsed)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    SandboxProtocolBenchmark(options).run()
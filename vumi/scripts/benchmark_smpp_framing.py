@@ -0,0 +1,108 @@
+import sys
+import time
+from twisted.python import usage
+
+from smpp.pdu_builder import DeliverSM
+
+from vumi.transports.smpp.clientserver.client import (
+    EsmeTransceiver, EsmeCallbacks)
+from vumi.transports.smpp.clientserver.config import ClientConfig
+from vumi.persist.fake_redis import FakeRedis
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["pdus", "n", "100000",
+         "Number of back-to-back deliver_sm PDUs to feed in."],
+        ["chunk-size", "c", "0",
+         "Bytes per dataReceived() call. 0 feeds everything in one call."],
+    ]
+
+    optFlags = [
+        ["process", "p",
+         "Also unpack and handle each PDU, not just frame it."],
+    ]
+
+    longdesc = """Benchmarks EsmeTransceiver.dataReceived with a large burst
+    of deliver_sm PDUs."""
+
+
+class NullTransport(object):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    def loseConnection(self):
+        pass
+
+
+class FramingBenchmark(object):
+    """
+    Feeds a burst of deliver_sm PDUs through EsmeTransceiver.dataReceived.
+    """
+
+    def __init__(self, options):
+        self.pdus = int(options['pdus'])
+        self.chunk_size = int(options['chunk-size'])
+        self.process = options['process']
+
+    def make_esme(self):
+        config = ClientConfig(host="127.0.0.1", port="0",
+                              system_id="bench", password="password")
+        esme = EsmeTransceiver(
+            config, FakeRedis(), EsmeCallbacks(deliver_sm=self.count_pdu))
+        esme.transport = NullTransport()
+        self.handled = 0
+        if self.process:
+            # Bound, so that each deliver_sm is answered and handled.
+            esme.state = 'BOUND_TRX'
+        else:
+            esme.dispatch_pdu = self.count_pdu
+        return esme
+
+    def count_pdu(self, *args, **kw):
+        self.handled += 1
+
+    def make_data(self):
+        return ''.join(
+            DeliverSM(seq, short_message="Message %d" % (seq,),
+                      destination_addr="1234",
+                      source_addr="27831234567").get_bin()
+            for seq in xrange(1, self.pdus + 1))
+
+    def chunks(self, data):
+        if not self.chunk_size:
+            return [data]
+        return [data[i:i + self.chunk_size]
+                for i in xrange(0, len(data), self.chunk_size)]
+
+    def run(self):
+        data = self.make_data()
+        chunks = self.chunks(data)
+        esme = self.make_esme()
+        start = time.time()
+        for chunk in chunks:
+            esme.dataReceived(chunk)
+        elapsed = time.time() - start
+        if self.handled != self.pdus:
+            raise RuntimeError("Expected %d PDUs, got %d" % (
+                self.pdus, self.handled))
+        if self.process and esme.transport.writes != self.pdus:
+            raise RuntimeError("Expected %d responses, got %d" % (
+                self.pdus, esme.transport.writes))
+        print "%d PDUs (%d bytes in %d reads) in %.3fs: %.0f PDUs/s" % (
+            self.pdus, len(data), len(chunks), elapsed,
+            self.pdus / elapsed)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    FramingBenchmark(options).run()
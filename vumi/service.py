@@ -1,12 +1,16 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+import urllib
 from copy import deepcopy
+from collections import deque
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore, maybeDeferred)
 from twisted.internet import protocol, reactor
 from twisted.web.resource import Resource
 import txamqp
@@ -36,13 +40,41 @@ def get_spec(specfile):
     return SPECS[specfile]
 
 
+class VumiDelegate(TwistedDelegate):
+    """Passes channel flow and publisher confirms on to publishers."""
+
+    def __init__(self):
+        TwistedDelegate.__init__(self)
+        self.publishers = {}
+
+    def register_publisher(self, channel, publisher):
+        self.publishers[channel] = publisher
+
+    def channel_flow(self, ch, msg):
+        publisher = self.publishers.get(ch)
+        if publisher is not None:
+            publisher.set_flow(msg.active)
+        return ch.channel_flow_ok(active=msg.active)
+
+    def basic_ack(self, ch, msg):
+        publisher = self.publishers.get(ch)
+        if publisher is not None:
+            publisher.handle_confirm(msg.delivery_tag, msg.multiple)
+
+    def basic_nack(self, ch, msg):
+        publisher = self.publishers.get(ch)
+        if publisher is not None:
+            publisher.handle_confirm(
+                msg.delivery_tag, msg.multiple, ack=False)
+
+
 class AmqpFactory(protocol.ReconnectingClientFactory):
 
     def __init__(self, worker):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = VumiDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -96,6 +128,12 @@ class WorkerAMQClient(AMQClient):
             self.channels[channel_id] = channel
         returnValue(channel)
 
+    def get_binding_index(self):
+        """Return the binding index shared by this client's publishers."""
+        if getattr(self, 'binding_index', None) is None:
+            self.binding_index = BindingIndex(self.vumi_options)
+        return self.binding_index
+
     def get_new_channel_id(self):
         """
         AMQClient keeps track of channels in a dictionary. The
@@ -150,8 +188,10 @@ class WorkerAMQClient(AMQClient):
         # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
+        publisher.binding_index = self.get_binding_index()
         # declare the exchange, doesn't matter if it already exists
         yield self._declare_exchange(publisher, channel)
+        self.delegate.register_publisher(channel, publisher)
         # start!
         yield publisher.start(channel)
         # return the publisher
@@ -204,7 +244,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, concurrency=1,
+                ack_batch_size=1, ordering_key=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -217,11 +258,15 @@ class Worker(MultiService, object):
             'exchange_type': exchange_type,
             'durable': durable,
             'start_paused': paused,
+            'concurrency': concurrency,
+            'ack_batch_size': ack_batch_size,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
         if message_class is not None:
             klass.message_class = message_class
+        if ordering_key is not None:
+            klass.ordering_key = staticmethod(ordering_key)
         return self.start_consumer(klass, callback)
 
     def start_consumer(self, consumer_class, *args, **kw):
@@ -229,7 +274,8 @@ class Worker(MultiService, object):
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, batch_size=1, max_outstanding=None,
+                   publisher_confirms=False, content_type=None):
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type("%sDynamicPublisher" % class_name, (Publisher,),
             {
@@ -238,6 +284,10 @@ class Worker(MultiService, object):
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "batch_size": batch_size,
+                "max_outstanding": max_outstanding,
+                "publisher_confirms": publisher_confirms,
+                "content_type": content_type,
             })
         return self.start_publisher(publisher_class)
 
@@ -276,6 +326,19 @@ class QueueCloseMarker(object):
 
 
 class Consumer(object):
+    """Consumes messages from an AMQP queue.
+
+    By default messages are processed one at a time. Setting `concurrency`
+    to more than one processes up to that many deliveries at once, which
+    lets a consumer make use of the channel's prefetch window. In that mode
+    acknowledgements are sent with `multiple=True` once `ack_batch_size`
+    messages at the front of the delivery order have been processed (or
+    once nothing is left in flight), and every message is acknowledged
+    whatever `consume_message` returns.
+
+    Messages for which `ordering_key` returns the same (non-None) key are
+    processed in the order they were delivered, even in concurrent mode.
+    """
 
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -287,6 +350,9 @@ class Consumer(object):
     message_class = Message
     start_paused = False
 
+    concurrency = 1
+    ack_batch_size = 1
+
     @inlineCallbacks
     def start(self, channel, queue):
         self.channel = channel
@@ -294,6 +360,11 @@ class Consumer(object):
         self.keep_consuming = True
         self._testing = hasattr(channel, 'message_processed')
         self.paused = self.start_paused
+        self._in_flight = DeferredSemaphore(max(self.concurrency, 1))
+        self._unacked = deque()
+        self._ackable_tag = None
+        self._ackable_count = 0
+        self._ordering_tails = {}
 
         @inlineCallbacks
         def read_messages():
@@ -304,7 +375,11 @@ class Consumer(object):
                     if isinstance(message, QueueCloseMarker):
                         log.msg("Queue closed.")
                         return
-                    yield self.consume(message)
+                    if self.concurrency > 1:
+                        yield self._in_flight.acquire()
+                        self.consume_concurrently(message)
+                    else:
+                        yield self.consume(message)
             except txamqp.queue.Closed, e:
                 log.err("Queue has closed", e)
 
@@ -320,10 +395,14 @@ class Consumer(object):
         self.paused = False
         return self.channel.channel_flow(active=True)
 
+    def decode_message(self, message):
+        """Decode an AMQP message using the codec for its content type."""
+        content_type = message.content.properties.get('content type')
+        return self.message_class.decode(message.content.body, content_type)
+
     @inlineCallbacks
     def consume(self, message):
-        result = yield self.consume_message(self.message_class.from_json(
-                                            message.content.body))
+        result = yield self.consume_message(self.decode_message(message))
         if self._testing:
             self.channel.message_processed()
         if result is not False:
@@ -332,6 +411,71 @@ class Consumer(object):
             log.msg('Received %s as a return value consume_message. '
                     'Not acknowledging AMQ message' % result)
 
+    def consume_concurrently(self, message):
+        """Process a message without waiting for earlier ones to finish.
+
+        The caller is expected to have acquired a slot on `_in_flight`,
+        which is released once the message has been processed.
+        """
+        entry = [message.delivery_tag, False]
+        self._unacked.append(entry)
+        # A message that can't be decoded is logged and acked like any
+        # other failure, so that it doesn't hold up the messages after it.
+        d = maybeDeferred(self._dispatch_concurrently, message)
+        d.addErrback(log.err)
+        d.addCallback(lambda _: self._message_done(entry))
+        return d
+
+    def _dispatch_concurrently(self, message):
+        vumi_message = self.decode_message(message)
+        key = self.ordering_key(vumi_message)
+        if key is None:
+            return self.consume_message(vumi_message)
+        return self._consume_in_order(key, vumi_message)
+
+    def _consume_in_order(self, key, vumi_message):
+        previous = self._ordering_tails.get(key)
+        done = Deferred()
+        self._ordering_tails[key] = done
+
+        if previous is None:
+            d = maybeDeferred(self.consume_message, vumi_message)
+        else:
+            d = Deferred()
+            previous.addCallback(lambda _: d.callback(None))
+            d.addCallback(lambda _: self.consume_message(vumi_message))
+
+        def finish(result):
+            if self._ordering_tails.get(key) is done:
+                del self._ordering_tails[key]
+            done.callback(None)
+            return result
+
+        return d.addBoth(finish)
+
+    def _message_done(self, entry):
+        entry[1] = True
+        while self._unacked and self._unacked[0][1]:
+            self._ackable_tag = self._unacked.popleft()[0]
+            self._ackable_count += 1
+        if self._ackable_count and (
+                self._ackable_count >= self.ack_batch_size
+                or not self._unacked):
+            self.channel.basic_ack(self._ackable_tag, True)
+            self._ackable_tag = None
+            self._ackable_count = 0
+        self._in_flight.release()
+        if self._testing:
+            self.channel.message_processed()
+
+    def ordering_key(self, message):
+        """Return a key for messages that must be processed in order.
+
+        Messages with the same key are never processed concurrently. The
+        default of None means no ordering is required.
+        """
+        return None
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
@@ -367,7 +511,161 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class BindingIndex(object):
+    """Routing keys bound to each exchange, from the RabbitMQ management API.
+
+    The index is shared by all the publishers of a worker and refreshed in
+    the background, so :meth:`is_bound` never waits for an HTTP request.
+    A routing key the index doesn't know about is assumed to be bound and
+    triggers a refresh. If the key is still unbound after that it is
+    negatively cached for `negative_ttl` seconds, or until
+    :meth:`invalidate` is called.
+
+    If the management API can't be reached, or doesn't answer within
+    `refresh_timeout` seconds, every routing key is assumed to be bound.
+    """
+
+    management_url = "http://localhost:55672/api"
+    refresh_interval = 60
+    refresh_timeout = 10
+    min_refresh_interval = 1
+    negative_ttl = 60
+
+    def __init__(self, vumi_options):
+        self.vumi_options = vumi_options
+        self.clock = self.get_clock()
+        self._bindings = None
+        self._negative = {}
+        self._suspects = set()
+        self._last_refresh = None
+        self._refresh_d = None
+
+    def get_clock(self):
+        return reactor
+
+    def fetch_bindings(self):
+        """Fetch `{exchange: set(routing_keys)}` for our vhost.
+
+        Cancelling the returned deferred cancels the HTTP request.
+        """
+        management_url = self.vumi_options.get(
+            'management_url', self.management_url)
+        d = http_request(
+            "%s/bindings/%s?columns=source,routing_key" % (
+                management_url,
+                urllib.quote(self.vumi_options['vhost'], safe='')),
+            None, headers={
+                'Authorization': basic_auth_string(
+                    self.vumi_options['username'],
+                    self.vumi_options['password']),
+            }, method='GET')
+        return d.addCallback(self._parse_bindings)
+
+    def _parse_bindings(self, resp):
+        bindings = {}
+        for b in json.loads(resp):
+            bindings.setdefault(b['source'], set()).add(b['routing_key'])
+        return bindings
+
+    def refresh(self):
+        """Refresh the index unless a refresh is already running."""
+        if self._refresh_d is not None:
+            return self._refresh_d
+        self._last_refresh = self.clock.seconds()
+        suspects, self._suspects = self._suspects, set()
+        d = maybeDeferred(self.fetch_bindings)
+        if not d.called:
+            timeout = self.clock.callLater(self.refresh_timeout, d.cancel)
+            d.addBoth(self._cancel_refresh_timeout, timeout)
+        d.addCallbacks(self._refreshed, self._refresh_failed,
+                       callbackArgs=(suspects,))
+        self._refresh_d = d
+        if d.called:
+            self._refresh_d = None
+        return d
+
+    def _cancel_refresh_timeout(self, result, timeout):
+        if timeout.active():
+            timeout.cancel()
+        return result
+
+    def _refreshed(self, bindings, suspects):
+        self._refresh_d = None
+        self._bindings = bindings
+        expiry = self.clock.seconds() + self.negative_ttl
+        for exchange_name, routing_key in suspects:
+            if routing_key not in bindings.get(exchange_name, ()):
+                self._negative[(exchange_name, routing_key)] = expiry
+
+    def _refresh_failed(self, failure):
+        # This is very noisy in the logs if the RabbitMQ Management
+        # plugin isn't installed, so we don't log anything.
+        self._refresh_d = None
+        self._bindings = None
+
+    def _refresh_due(self, interval):
+        return (self._last_refresh is None or
+                self.clock.seconds() - self._last_refresh >= interval)
+
+    def is_bound(self, exchange_name, routing_key):
+        if self._refresh_due(self.refresh_interval):
+            self.refresh()
+        if self._bindings is None:
+            return True
+        if routing_key in self._bindings.get(exchange_name, ()):
+            return True
+        key = (exchange_name, routing_key)
+        expiry = self._negative.get(key)
+        if expiry is not None:
+            if expiry > self.clock.seconds():
+                return False
+            del self._negative[key]
+        self._suspects.add(key)
+        if self._refresh_due(self.min_refresh_interval):
+            self.refresh()
+        return True
+
+    def invalidate(self, exchange_name=None, routing_key=None):
+        """Forget negatively cached routing keys and refresh the index.
+
+        If `exchange_name` and `routing_key` are given only that routing key
+        is forgotten.
+        """
+        if exchange_name is None:
+            self._negative.clear()
+        else:
+            self._negative.pop((exchange_name, routing_key), None)
+        self._last_refresh = None
+
+
+class PublishNackError(VumiError):
+    """Raised when the broker refuses to confirm a published message."""
+
+
 class Publisher(object):
+    """Publishes messages to an AMQP exchange.
+
+    Messages passed to :meth:`publish` are queued and published in
+    batches of up to `batch_size`. A partial batch is published after
+    `batch_delay` seconds. The routing key of each distinct destination in
+    a batch is only checked once. The default `batch_size` of 1 publishes
+    each message immediately.
+
+    The deferred returned by :meth:`publish` fires once the message has
+    been published (or confirmed by the broker if `publisher_confirms` is
+    set). At most `max_outstanding` messages are in flight at once and
+    further messages wait in the queue, as they do while the broker has
+    asked us to stop sending with `channel.flow`. Callers that wait on the
+    returned deferreds are therefore slowed down to match the broker.
+
+    Messages are encoded as JSON unless `content_type` names another codec
+    from :data:`vumi.message.MESSAGE_CODECS`. Consumers pick the codec to
+    decode with from the AMQP content type of each message.
+
+    Publisher confirms need an AMQP spec that includes RabbitMQ's
+    `confirm` class, which the 0-8 spec vumi uses by default does not.
+    """
+
     exchange_name = "vumi"
     exchange_type = "direct"
     routing_key = "routing_key"
@@ -375,41 +673,36 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    batch_size = 1
+    batch_delay = 0
+    max_outstanding = None
+    publisher_confirms = False
+    content_type = None
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
-        self.bound_routing_keys = {}
+        self.clock = self.get_clock()
+        self.flow_active = True
+        self._pending = deque()
+        self._flush_call = None
+        self._flushing = False
+        self._in_flight = 0
+        self._unconfirmed = {}
+        self._publish_seq = 0
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
+        if getattr(self, 'binding_index', None) is None:
+            self.binding_index = BindingIndex(self.vumi_options)
 
-    @inlineCallbacks
-    def list_bindings(self):
-        try:
-            # Note utils.callback() does a POST not a GET
-            # which may lead to errors if the RabbitMQ Management REST api
-            # changes
-            resp = yield http_request(
-                "http://localhost:55672/api/bindings", headers={
-                    'Authorization': basic_auth_string(
-                        self.vumi_options['username'],
-                        self.vumi_options['password']),
-                    })
-            bindings = json.loads(resp)
-            bound_routing_keys = {}
-            for b in bindings:
-                if (b['vhost'] == self.vumi_options['vhost'] and
-                        b['source'] == self.exchange_name):
-                    bound_routing_keys[b['routing_key']] = \
-                            bound_routing_keys.get(b['routing_key'], []) + \
-                            [b['destination']]
-        except:
-            bound_routing_keys = {"bindings": "undetected"}
-        returnValue(bound_routing_keys)
+        if self.publisher_confirms:
+            return self.channel.confirm_select()
+
+    def get_clock(self):
+        return reactor
 
-    @inlineCallbacks
     def routing_key_is_bound(self, key):
         # Don't check for bound routing keys on RPC reply exchanges
         # The one-use queues are changing too frequently to cache efficiently,
@@ -417,23 +710,8 @@ class Publisher(object):
         # and the auto-generated queues & routing_keys are unlikley to
         # result in errors where routing keys are unbound
         if self.exchange_name[-4:].lower() == '_rpc':
-            returnValue(True)
-        if (len(self.bound_routing_keys) == 1 and
-                self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        if key in self.bound_routing_keys.keys():
-            returnValue(True)
-        self.bound_routing_keys = yield self.list_bindings()
-        if (len(self.bound_routing_keys) == 1 and
-                self.bound_routing_keys.get("bindings") == "undetected"):
-            # The following is very noisy in the logs:
-            # log.msg("No bindings detected, is the RabbitMQ Management plugin"
-            #         " installed?")
-            returnValue(True)
-        returnValue(key in self.bound_routing_keys.keys())
+            return True
+        return self.binding_index.is_bound(self.exchange_name, key)
 
     @inlineCallbacks
     def check_routing_key(self, routing_key, require_bind):
@@ -449,18 +727,134 @@ class Publisher(object):
                                   routing_key, self.vumi_options['vhost'],
                                   self.exchange_name))
 
-    @inlineCallbacks
     def publish(self, message, **kwargs):
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         require_bind = kwargs.get('require_bind', self.require_bind)
-        yield self.check_routing_key(routing_key, require_bind)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        d = Deferred()
+        self._pending.append(
+            (exchange_name, routing_key, require_bind, message, d))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.batch_delay, self._flush)
+        return d
+
+    @property
+    def outstanding(self):
+        """The number of messages queued or awaiting publication."""
+        return len(self._pending) + self._in_flight
+
+    def set_flow(self, active):
+        """Stop or resume publishing when the broker asks us to."""
+        self.flow_active = active
+        if active:
+            self._flush()
+
+    def _window_space(self):
+        if not self.flow_active:
+            return 0
+        if self.max_outstanding is None:
+            return len(self._pending)
+        return self.max_outstanding - self._in_flight
+
+    @inlineCallbacks
+    def _flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._flushing:
+            # The running flush will pick up anything new.
+            return
+        self._flushing = True
+        try:
+            while self._pending:
+                space = min(self._window_space(), self.batch_size)
+                if space <= 0:
+                    break
+                batch = [self._pending.popleft()
+                         for _ in range(min(space, len(self._pending)))]
+                yield self._publish_batch(batch)
+        finally:
+            self._flushing = False
+
+    @inlineCallbacks
+    def _publish_batch(self, batch):
+        # Start all the routing key checks before waiting on any of them.
+        checks = {}
+        for _exchange_name, routing_key, require_bind, _msg, _d in batch:
+            check_key = (routing_key, require_bind)
+            if check_key not in checks:
+                checks[check_key] = maybeDeferred(
+                    self.check_routing_key, routing_key, require_bind)
+        failures = {}
+        for check_key, check_d in checks.items():
+            try:
+                yield check_d
+            except Exception:
+                failures[check_key] = Failure()
+
+        for exchange_name, routing_key, require_bind, message, d in batch:
+            failure = failures.get((routing_key, require_bind))
+            if failure is not None:
+                d.errback(failure)
+            else:
+                self._send(exchange_name, routing_key, message, d)
+
+    def _send(self, exchange_name, routing_key, message, d):
+        self._in_flight += 1
+        seq = None
+        if self.publisher_confirms:
+            self._publish_seq += 1
+            seq = self._publish_seq
+            self._unconfirmed[seq] = d
+        publish_d = maybeDeferred(
+            self.channel.basic_publish, exchange=exchange_name,
+            content=message, routing_key=routing_key)
+        if seq is None:
+            publish_d.addBoth(self._settle, d)
+        else:
+            publish_d.addErrback(self._publish_failed, seq)
+
+    def _publish_failed(self, failure, seq):
+        d = self._unconfirmed.pop(seq, None)
+        if d is not None:
+            self._settle(failure, d)
+
+    def _settle(self, result, d):
+        self._in_flight -= 1
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+        if self._pending:
+            self._flush()
+
+    def handle_confirm(self, delivery_tag, multiple, ack=True):
+        """Settle published messages the broker has acked or nacked."""
+        if multiple:
+            seqs = sorted(s for s in self._unconfirmed if s <= delivery_tag)
+        else:
+            seqs = [delivery_tag]
+        for seq in seqs:
+            d = self._unconfirmed.pop(seq, None)
+            if d is None:
+                continue
+            if ack:
+                self._settle(None, d)
+            else:
+                self._settle(Failure(PublishNackError(
+                    "Broker refused to confirm publish %s." % (seq,))), d)
 
     def publish_message(self, message, **kwargs):
-        d = self.publish_raw(message.to_json(), **kwargs)
+        if self.content_type is None:
+            data = message.to_json()
+        else:
+            data = message.encode(self.content_type)
+            kwargs.setdefault('content_type', self.content_type)
+        d = self.publish_raw(data, **kwargs)
         d.addCallback(lambda r: message)
         return d
 
@@ -472,6 +866,9 @@ class Publisher(object):
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop('delivery_mode',
                 self.delivery_mode)
+        content_type = kwargs.pop('content_type', None)
+        if content_type is not None:
+            amq_message['content type'] = content_type
         return self.publish(amq_message, **kwargs)
 
 
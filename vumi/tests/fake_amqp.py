@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, VumiDelegate
 from vumi.message import Message as VumiMessage
 
 
@@ -64,26 +63,26 @@ def mkMethod(name, index=-1):
 
 def mkContent(body, children=None, properties=None):
     return Thing("Content", body=body, children=children,
-                 properties=properties)
+                 properties=properties or {})
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -186,7 +185,8 @@ class FakeAMQPBroker(object):
             dtag, msg = self._get_queue(queue).get_message()
             while dtag is not None:
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'])
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, queue)
                 delivered = True
@@ -359,7 +359,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -445,6 +445,7 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': content.properties,
                 })
 
     def ack(self, delivery_tag):
@@ -462,7 +463,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, VumiDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
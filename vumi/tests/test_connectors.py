@@ -25,14 +25,15 @@ class BaseConnectorTestCase(VumiWorkerTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     **kw):
         if worker is None:
             worker = yield self.get_worker({}, DummyWorker)
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares, **kw)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -93,6 +94,21 @@ class TestBaseConnector(BaseConnectorTestCase):
         conn, consumer = yield self.mk_consumer(prefetch_count=10)
         self.assertEqual(consumer.channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_consumer_concurrency(self):
+        conn, consumer = yield self.mk_consumer(consumer_concurrency=5,
+                                                ack_batch_size=3)
+        self.assertEqual(consumer.concurrency, 5)
+        self.assertEqual(consumer.ack_batch_size, 3)
+
+    @inlineCallbacks
+    def test_set_ordering_key(self):
+        conn, consumer = yield self.mk_consumer()
+        msg = self.mkmsg_in()
+        self.assertEqual(None, consumer.ordering_key(msg))
+        conn.set_ordering_key('inbound', lambda msg: msg['from_addr'])
+        self.assertEqual(msg['from_addr'], consumer.ordering_key(msg))
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
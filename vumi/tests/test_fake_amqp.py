@@ -7,7 +7,7 @@ from vumi.tests import fake_amqp
 
 
 def mkmsg(body):
-    return fake_amqp.Thing("Message", body=body)
+    return fake_amqp.Thing("Message", body=body, properties={})
 
 
 class TestWorker(Worker):
@@ -1,8 +1,12 @@
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 
-from vumi.tests.utils import RegexMatcher, UTCNearNow
+from vumi.tests.utils import RegexMatcher, UTCNearNow, import_skip
+from vumi.errors import InvalidMessage
 from vumi.message import (Message, TransportMessage, TransportEvent,
-                          TransportUserMessage)
+                          TransportUserMessage, from_json, to_json,
+                          parse_vumi_timestamp, get_codec)
 
 
 class MessageTest(TestCase):
@@ -17,6 +21,59 @@ class MessageTest(TestCase):
         self.assertTrue('a' in Message(a=5))
         self.assertFalse('a' in Message(b=5))
 
+    def test_message_copy(self):
+        msg = Message(a={'b': [1, {'c': 2}]}, d=datetime(2012, 1, 2))
+        copy = msg.copy()
+        self.assertEqual(msg, copy)
+        copy['a']['b'][1]['c'] = 3
+        self.assertEqual(2, msg['a']['b'][1]['c'])
+
+    def test_encode_decode(self):
+        msg = Message(a=5, b=datetime(2012, 1, 2, 3, 4, 5, 6))
+        self.assertEqual(msg.to_json(), msg.encode())
+        self.assertEqual(msg, Message.decode(msg.encode()))
+        self.assertEqual(msg, Message.decode(
+            msg.encode('application/json'), 'application/json'))
+
+    def test_encode_decode_msgpack(self):
+        try:
+            get_codec('application/x-msgpack')
+        except ImportError, e:
+            import_skip(e, 'msgpack')
+        msg = Message(a=[u'\u1234', 'b'], b=datetime(2012, 1, 2, 3, 4, 5, 6))
+        data = msg.encode('application/x-msgpack')
+        self.assertEqual(
+            msg, Message.decode(data, 'application/x-msgpack'))
+
+    def test_unknown_content_type(self):
+        self.assertRaises(InvalidMessage, get_codec, 'text/plain')
+
+    def test_content_type_parameters(self):
+        codec = get_codec('application/json')
+        self.assertEqual(codec, get_codec('application/json; charset=utf-8'))
+        self.assertEqual(codec, get_codec('Application/JSON'))
+        msg = Message(a=5)
+        self.assertEqual(msg, Message.decode(
+            msg.encode(), 'application/json;charset=UTF-8'))
+
+
+class JSONTest(TestCase):
+
+    def test_timestamps(self):
+        dt = datetime(2012, 1, 2, 3, 4, 5, 6)
+        obj = {'a': dt, 'b': {'c': dt}, 'd': '2012-01-02 03:04:05'}
+        self.assertEqual(obj, from_json(to_json(obj)))
+
+    def test_timestamp_lookalikes(self):
+        obj = {'a': '2012-01-02 03:04:xx.000000', 'b': 'x' * 26}
+        self.assertEqual(obj, from_json(to_json(obj)))
+
+    def test_parse_vumi_timestamp(self):
+        self.assertEqual(datetime(2012, 1, 2, 3, 4, 5, 6),
+                         parse_vumi_timestamp('2012-01-02 03:04:05.000006'))
+        self.assertRaises(ValueError, parse_vumi_timestamp,
+                          '2012-13-02 03:04:05.000006')
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
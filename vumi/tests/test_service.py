@@ -1,7 +1,11 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, Deferred, returnValue, succeed, fail)
+from twisted.internet.task import deferLater, Clock
 
-from vumi.service import Worker, WorkerCreator
+from vumi.service import (
+    Worker, WorkerCreator, PublishNackError, BindingIndex, RoutingKeyError)
 from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
 from vumi.message import Message
 
@@ -33,6 +37,105 @@ class ServiceTestCase(TestCase):
                                                  message.content)
         self.assertEquals(log, [Message(key="value")])
 
+    @inlineCallbacks
+    def wait_for(self, check):
+        while not check():
+            yield deferLater(reactor, 0, lambda: None)
+
+    @inlineCallbacks
+    def start_concurrent_consumer(self, **kw):
+        worker = get_stubbed_worker(Worker)
+        started = []
+
+        def callback(msg):
+            d = Deferred()
+            started.append((msg['i'], d))
+            return d
+
+        consumer = yield worker.consume('test.routing.key', callback, **kw)
+        returnValue((worker._amqp_client.broker, consumer, started))
+
+    def publish_numbered(self, broker, *numbers, **kw):
+        for i in numbers:
+            broker.publish_message('vumi', 'test.routing.key',
+                                   Message(i=i, **kw))
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        broker, consumer, started = yield self.start_concurrent_consumer(
+            concurrency=2)
+        self.publish_numbered(broker, 0, 1, 2)
+        yield self.wait_for(lambda: len(started) == 2)
+        # Only two messages are processed at once.
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([0, 1], [i for i, _d in started])
+
+        started[0][1].callback(None)
+        yield self.wait_for(lambda: len(started) == 3)
+        self.assertEqual([0, 1, 2], [i for i, _d in started])
+
+    @inlineCallbacks
+    def test_consume_concurrently_acks_in_delivery_order(self):
+        broker, consumer, started = yield self.start_concurrent_consumer(
+            concurrency=3)
+        self.publish_numbered(broker, 0, 1, 2)
+        yield self.wait_for(lambda: len(started) == 3)
+        self.assertEqual(3, len(consumer.channel.unacked))
+
+        # Finishing a later message doesn't ack anything, because acks
+        # cover every message delivered before the acked one.
+        started[2][1].callback(None)
+        self.assertEqual(3, len(consumer.channel.unacked))
+        started[0][1].callback(None)
+        self.assertEqual(2, len(consumer.channel.unacked))
+        started[1][1].callback(None)
+        self.assertEqual(0, len(consumer.channel.unacked))
+
+    @inlineCallbacks
+    def test_consume_concurrently_ack_batch_size(self):
+        broker, consumer, started = yield self.start_concurrent_consumer(
+            concurrency=3, ack_batch_size=2)
+        self.publish_numbered(broker, 0, 1, 2)
+        yield self.wait_for(lambda: len(started) == 3)
+
+        started[0][1].callback(None)
+        self.assertEqual(3, len(consumer.channel.unacked))
+        started[1][1].callback(None)
+        self.assertEqual(1, len(consumer.channel.unacked))
+        # The last message in flight is acked even if the batch isn't full.
+        started[2][1].callback(None)
+        self.assertEqual(0, len(consumer.channel.unacked))
+
+    @inlineCallbacks
+    def test_consume_concurrently_bad_message(self):
+        broker, consumer, started = yield self.start_concurrent_consumer(
+            concurrency=2)
+        broker.publish_raw('vumi', 'test.routing.key', 'not json')
+        self.publish_numbered(broker, 0, 1)
+        yield self.wait_for(lambda: len(started) == 2)
+        # The bad message is logged and acked, and gives up its slot.
+        self.assertEqual(1, len(self.flushLoggedErrors()))
+        self.assertEqual([0, 1], [i for i, _d in started])
+        started[0][1].callback(None)
+        started[1][1].callback(None)
+        self.assertEqual(0, len(consumer.channel.unacked))
+
+    @inlineCallbacks
+    def test_consume_concurrently_with_ordering_key(self):
+        broker, consumer, started = yield self.start_concurrent_consumer(
+            concurrency=3, ordering_key=lambda msg: msg['i'] % 2)
+        self.publish_numbered(broker, 0, 1, 2)
+        yield self.wait_for(lambda: len(started) == 2)
+        yield deferLater(reactor, 0, lambda: None)
+        # Message 2 has the same key as message 0, so it has to wait.
+        self.assertEqual([0, 1], [i for i, _d in started])
+
+        started[1][1].callback(None)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual([0, 1], [i for i, _d in started])
+        started[0][1].callback(None)
+        self.assertEqual([0, 1, 2], [i for i, _d in started])
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -46,6 +149,206 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    def get_dispatched_bodies(self, publisher):
+        msgs = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        return [Message.from_json(msg.body)['n'] for msg in msgs]
+
+    @inlineCallbacks
+    def test_publisher_batching(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key', batch_size=3)
+        publisher.clock = Clock()
+        checked = []
+        orig_check_routing_key = publisher.check_routing_key
+
+        def check_routing_key(routing_key, require_bind):
+            checked.append(routing_key)
+            return orig_check_routing_key(routing_key, require_bind)
+        publisher.check_routing_key = check_routing_key
+
+        publisher.publish_message(Message(n=0))
+        publisher.publish_message(Message(n=1))
+        self.assertEqual(self.get_dispatched_bodies(publisher), [])
+        publisher.publish_message(Message(n=2))
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0, 1, 2])
+        self.assertEqual(checked, ['test.routing.key'])
+
+        d = publisher.publish_message(Message(n=3))
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0, 1, 2])
+        publisher.clock.advance(0)
+        self.assertEqual(
+            self.get_dispatched_bodies(publisher), [0, 1, 2, 3])
+        msg = yield d
+        self.assertEqual(msg['n'], 3)
+
+    @inlineCallbacks
+    def test_publisher_flow(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.set_flow(False)
+        d = publisher.publish_message(Message(n=0))
+        self.assertEqual(self.get_dispatched_bodies(publisher), [])
+        self.assertFalse(d.called)
+        self.assertEqual(publisher.outstanding, 1)
+
+        publisher.set_flow(True)
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0])
+        self.assertTrue(d.called)
+        self.assertEqual(publisher.outstanding, 0)
+
+    @inlineCallbacks
+    def test_publisher_confirms(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to(
+            'test.routing.key', max_outstanding=2)
+        # The fake broker doesn't support confirm.select.
+        publisher.publisher_confirms = True
+        ds = [publisher.publish_message(Message(n=n)) for n in range(4)]
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0, 1])
+        self.assertEqual([d.called for d in ds], [False] * 4)
+
+        publisher.handle_confirm(2, multiple=True)
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0, 1, 2, 3])
+        self.assertEqual([d.called for d in ds], [True, True, False, False])
+
+        publisher.handle_confirm(3, multiple=False)
+        publisher.handle_confirm(4, multiple=False, ack=False)
+        yield ds[2]
+        yield self.assertFailure(ds[3], PublishNackError)
+        self.assertEqual(publisher.outstanding, 0)
+
+    @inlineCallbacks
+    def test_publish_content_type(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to(
+            'test.routing.key', content_type='application/json')
+        publisher.publish_message(Message(n=0))
+        [published_msg] = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEqual(published_msg.properties, {
+            'delivery mode': 2, 'content type': 'application/json'})
+
+    @inlineCallbacks
+    def test_publishers_share_binding_index(self):
+        worker = get_stubbed_worker(Worker)
+        publisher1 = yield worker.publish_to('test.routing.key')
+        publisher2 = yield worker.publish_to('other.routing.key')
+        self.assertTrue(publisher1.binding_index is publisher2.binding_index)
+
+    @inlineCallbacks
+    def test_publish_to_unbound_routing_key(self):
+        worker = get_stubbed_worker(Worker)
+        worker._amqp_client.binding_index = StubBindingIndex(
+            {'vumi': set(['bound.key'])})
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.vumi_options = {'vhost': '/test'}
+        index = publisher.binding_index
+        # Unknown routing keys are allowed until a refresh has checked them.
+        yield publisher.publish_message(Message(n=0))
+        index.clock.advance(index.min_refresh_interval)
+        yield publisher.publish_message(Message(n=1))
+        yield self.assertFailure(
+            publisher.publish_message(Message(n=2)), RoutingKeyError)
+        yield publisher.publish_message(
+            Message(n=3), routing_key='bound.key')
+        self.assertEqual(self.get_dispatched_bodies(publisher), [0, 1])
+
+
+class StubBindingIndex(BindingIndex):
+    def __init__(self, bindings):
+        self.bindings = bindings
+        self.fetches = 0
+        BindingIndex.__init__(self, {})
+
+    def get_clock(self):
+        return Clock()
+
+    def fetch_bindings(self):
+        self.fetches += 1
+        if isinstance(self.bindings, Deferred):
+            return self.bindings
+        if self.bindings is None:
+            return fail(ValueError("No management API."))
+        return succeed(dict((k, set(v)) for k, v in self.bindings.items()))
+
+
+class TestBindingIndex(TestCase):
+    def test_bound(self):
+        index = StubBindingIndex({'vumi': ['foo']})
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertEqual(index.fetches, 1)
+
+    def test_unbound_is_negatively_cached(self):
+        index = StubBindingIndex({'vumi': ['foo']})
+        self.assertTrue(index.is_bound('vumi', 'bar'))
+        self.assertEqual(index.fetches, 1)
+        index.clock.advance(index.min_refresh_interval)
+        self.assertTrue(index.is_bound('vumi', 'bar'))
+        self.assertEqual(index.fetches, 2)
+        self.assertFalse(index.is_bound('vumi', 'bar'))
+        self.assertFalse(index.is_bound('vumi', 'bar'))
+        self.assertEqual(index.fetches, 2)
+
+        index.clock.advance(index.negative_ttl)
+        index.bindings['vumi'].append('bar')
+        self.assertTrue(index.is_bound('vumi', 'bar'))
+        self.assertEqual(index.fetches, 3)
+
+    def test_refresh_interval(self):
+        index = StubBindingIndex({'vumi': ['foo']})
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        index.clock.advance(index.refresh_interval - 1)
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertEqual(index.fetches, 1)
+        index.clock.advance(1)
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertEqual(index.fetches, 2)
+
+    def test_invalidate(self):
+        index = StubBindingIndex({'vumi': []})
+        index.clock.advance(index.min_refresh_interval)
+        index.is_bound('vumi', 'foo')
+        index.clock.advance(index.min_refresh_interval)
+        index.is_bound('vumi', 'foo')
+        self.assertFalse(index.is_bound('vumi', 'foo'))
+
+        index.bindings['vumi'].append('foo')
+        index.invalidate('vumi', 'foo')
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertTrue('foo' in index._bindings['vumi'])
+
+    def test_management_api_unavailable(self):
+        index = StubBindingIndex(None)
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        index.clock.advance(index.min_refresh_interval)
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+
+    def test_refresh_timeout(self):
+        index = StubBindingIndex({'vumi': []})
+        index.is_bound('vumi', 'foo')
+        index.clock.advance(index.refresh_interval)
+        index.bindings = Deferred()
+        stuck = index.bindings
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertEqual(index.fetches, 2)
+        index.clock.advance(index.refresh_timeout - 1)
+        self.assertFalse(stuck.called)
+        index.clock.advance(1)
+        self.assertTrue(stuck.called)
+        self.assertEqual(index._bindings, None)
+        self.assertEqual(index._refresh_d, None)
+        self.assertEqual(index.clock.getDelayedCalls(), [])
+
+        index.bindings = {'vumi': ['foo']}
+        index.clock.advance(index.refresh_interval)
+        self.assertTrue(index.is_bound('vumi', 'foo'))
+        self.assertEqual(index.fetches, 3)
+        self.assertEqual(index._bindings, {'vumi': set(['foo'])})
+        self.assertEqual(index.clock.getDelayedCalls(), [])
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -100,10 +100,10 @@ def mocking(fn):
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
-    Content = namedtuple('Content', ['body'])
+    Content = namedtuple('Content', ['body', 'properties'])
     Message = namedtuple('Message', ['content', 'delivery_tag'])
     return Message(delivery_tag=delivery_tag,
-                   content=Content(body=json.dumps(dictionary)))
+                   content=Content(body=json.dumps(dictionary), properties={}))
 
 
 def get_fake_amq_client(broker=None):
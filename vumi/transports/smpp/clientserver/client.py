@@ -2,13 +2,15 @@
 
 import json
 import uuid
+from collections import deque
 
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
-from twisted.internet.task import LoopingCall
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredQueue
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore)
+from twisted.python.failure import Failure
 
-import binascii
 from smpp.pdu import unpack_pdu
 from smpp.pdu_builder import (
     BindTransceiver, BindTransmitter, BindReceiver, DeliverSMResp, SubmitSM,
@@ -17,6 +19,8 @@ from smpp.pdu_inspector import (
     MultipartMessage, detect_multipart, multipart_key)
 
 from vumi import log
+from vumi.transports.smpp.clientserver.framing import (
+    PduBuffer, PduFramingError, HexDump)
 
 
 def unpacked_pdu_opts(unpacked_pdu):
@@ -40,50 +44,109 @@ def update_ussd_pdu(sm_pdu, continue_session, session_info=None):
     return sm_pdu
 
 
-class EsmeTransceiver(Protocol):
-    BIND_PDU = BindTransceiver
-    CONNECTED_STATE = 'BOUND_TRX'
+class SequenceAllocator(object):
+    """Hands out SMPP sequence numbers from blocks leased from Redis.
 
-    callLater = reactor.callLater
+    Each lease is a single INCRBY on the shared counter, which reserves
+    `block_size` numbers for this process. Numbers from the current block
+    are handed out locally and the next block is leased in the background
+    once the current one is running low. Every process sharing the Redis
+    prefix still gets unique sequence numbers, since no two leases can
+    overlap.
 
-    def __init__(self, config, redis, esme_callbacks):
-        self.config = config
-        self.esme_callbacks = esme_callbacks
-        self.defaults = config.to_dict()
-        self.state = 'CLOSED'
-        log.msg('STATE: %s' % (self.state,))
-        self.smpp_bind_timeout = self.config.smpp_bind_timeout
-        self.smpp_enquire_link_interval = \
-                self.config.smpp_enquire_link_interval
-        self.datastream = ''
+    The valid range of sequence number is 0x00000001 to 0xFFFFFFFF.
+
+    We start trying to wrap at 0xFFFF0000 so that leases (up to 0xFFFF
+    numbers' worth of them) keep working even while someone else is in the
+    middle of resetting the counter. Any part of a block past 0xFFFFFFFF is
+    discarded. If a whole block is past it while someone else holds the
+    wrap lock, we wait `WRAP_RETRY_DELAY` seconds for them to finish
+    before leasing again.
+    """
+
+    SEQ_KEY = 'smpp_last_sequence_number'
+    WRAP_KEY = 'smpp_last_sequence_number_wrap'
+    WRAP_THRESHOLD = 0xFFFF0000
+    MAX_SEQ = 0xFFFFFFFF
+    WRAP_RETRY_DELAY = 0.1
+
+    def __init__(self, redis, block_size=1000, clock=None):
+        if clock is None:
+            clock = reactor
         self.redis = redis
-        self._lose_conn = None
-        # The PDU queue ensures that PDUs are processed in the order
-        # they arrive. `self._process_pdu_queue()` loops forever
-        # pulling PDUs off the queue and handling each before grabbing
-        # the next.
-        self._pdu_queue = DeferredQueue()
-        self._process_pdu_queue()  # intentionally throw away deferred
+        self.clock = clock
+        self.block_size = max(1, int(block_size))
+        # Prefetch the next block once fewer than this many numbers are left.
+        self.low_water = self.block_size // 10
+        self._next = 1
+        self._end = 0
+        self._spare = None
+        self._leasing = False
+        self._waiters = []
+
+    def remaining(self):
+        return self._end - self._next + 1
 
     @inlineCallbacks
-    def get_next_seq(self):
-        """Get the next available SMPP sequence number.
+    def next_seq(self):
+        while self._next > self._end:
+            if self._spare is not None:
+                self._next, self._end = self._spare
+                self._spare = None
+            else:
+                yield self._lease()
+        seq = self._next
+        self._next += 1
+        if (self._spare is None and not self._leasing
+                and self.remaining() < self.low_water):
+            self._lease().addErrback(
+                lambda f: log.err(f, "Failed to prefetch sequence numbers"))
+        returnValue(seq)
 
-        The valid range of sequence number is 0x00000001 to 0xFFFFFFFF.
+    def _lease(self):
+        """Wait for a new block to be leased.
 
-        We start trying to wrap at 0xFFFF0000 so we can keep returning values
-        (up to 0xFFFF of them) even while someone else is in the middle of
-        resetting the counter.
+        Only one lease is ever in flight, everyone who needs a block while
+        it's happening waits for the same one.
         """
-        seq = yield self.redis.incr('smpp_last_sequence_number')
-
-        if seq >= 0xFFFF0000:
-            # We're close to the upper limit, so try to reset. It doesn't
-            # matter if we actually succeed or not, since we're going to return
-            # `seq` anyway.
-            yield self._reset_seq_counter()
+        d = Deferred()
+        self._waiters.append(d)
+        if not self._leasing:
+            self._leasing = True
+            self._lease_block().addBoth(self._leased)
+        return d
+
+    def _leased(self, result):
+        self._leasing = False
+        waiters, self._waiters = self._waiters, []
+        if isinstance(result, Failure):
+            for d in waiters:
+                d.errback(result)
+            return
+        self._spare = result
+        for d in waiters:
+            d.callback(None)
 
-        returnValue(seq)
+    @inlineCallbacks
+    def _lease_block(self):
+        while True:
+            end = yield self.redis.incr(self.SEQ_KEY, self.block_size)
+            start = end - self.block_size + 1
+            wrapped = False
+            if end >= self.WRAP_THRESHOLD:
+                # We're close to the upper limit, so try to reset. It doesn't
+                # matter if we actually succeed or not, since we're going to
+                # use what we can of this block anyway.
+                wrapped = yield self._reset_seq_counter()
+            end = min(end, self.MAX_SEQ)
+            if start <= end:
+                returnValue((start, end))
+            if not wrapped:
+                # Someone else is resetting the counter. Leasing again
+                # straight away would just burn through more of the range
+                # past the limit until they're done.
+                yield deferLater(
+                    self.clock, self.WRAP_RETRY_DELAY, lambda: None)
 
     @inlineCallbacks
     def _reset_seq_counter(self):
@@ -98,56 +161,154 @@ class EsmeTransceiver(Protocol):
         A better solution is to replace this whole method with a lua script
         that we send to redis, but scripting support is still very new at the
         time of writing.
+
+        Returns a deferred that fires with `True` if the counter has been
+        reset, or `False` if someone else holds the lock.
         """
         # SETNX can be used as a lock.
-        locked = yield self.redis.setnx('smpp_last_sequence_number_wrap', 1)
+        locked = yield self.redis.setnx(self.WRAP_KEY, 1)
 
         # If someone crashed in exactly the wrong place, the lock may be
         # held by someone else but have no expire time. A race condition
         # here may set the TTL multiple times, but that's fine.
-        if (yield self.redis.ttl('smpp_last_sequence_number_wrap')) < 0:
+        if (yield self.redis.ttl(self.WRAP_KEY)) < 0:
             # The TTL only gets set if the lock exists and recently had no TTL.
-            yield self.redis.expire('smpp_last_sequence_number_wrap', 10)
+            yield self.redis.expire(self.WRAP_KEY, 10)
 
         if not locked:
             # We didn't actually get the lock, so our job is done.
-            return
+            returnValue(False)
 
-        if (yield self.redis.get('smpp_last_sequence_number')) < 0xFFFF0000:
+        current = yield self.redis.get(self.SEQ_KEY)
+        if int(current or 0) < self.WRAP_THRESHOLD:
             # Our stored sequence number is no longer outside the allowed
             # range, so someone else must have reset it before we got the lock.
-            return
+            returnValue(True)
+
+        # We reset the counter by deleting the key. The next INCRBY will
+        # recreate it for us.
+        yield self.redis.delete(self.SEQ_KEY)
+        returnValue(True)
+
+
+class PduDispatcher(object):
+    """Runs PDU handlers with bounded concurrency.
+
+    At most `concurrency` handlers run at once, and handlers are started in
+    the order they were dispatched. Handlers dispatched with the same
+    (non-`None`) key never overlap: each one only starts once the previous
+    one for that key has finished. With a concurrency of 1 everything is
+    handled strictly in order.
+    """
+
+    def __init__(self, concurrency=1):
+        self.concurrency = max(1, int(concurrency))
+        self._semaphore = DeferredSemaphore(self.concurrency)
+        self._keyed = {}
+
+    def dispatch(self, key, func, *args, **kw):
+        """Call `func(*args, **kw)` when there is capacity for it.
+
+        Returns a deferred that fires with its result once it has run.
+        """
+        if key is None or self.concurrency == 1:
+            return self._semaphore.run(func, *args, **kw)
+        if key in self._keyed:
+            d = Deferred()
+            self._keyed[key].append((d, func, args, kw))
+            return d
+        self._keyed[key] = deque()
+        return self._run_keyed(key, func, args, kw)
+
+    def _run_keyed(self, key, func, args, kw):
+        d = self._semaphore.run(func, *args, **kw)
+        d.addBoth(self._keyed_done, key)
+        return d
+
+    def _keyed_done(self, result, key):
+        waiting = self._keyed[key]
+        if waiting:
+            d, func, args, kw = waiting.popleft()
+            self._run_keyed(key, func, args, kw).chainDeferred(d)
+        else:
+            del self._keyed[key]
+        return result
+
+
+class EsmeTransceiver(Protocol):
+    BIND_PDU = BindTransceiver
+    CONNECTED_STATE = 'BOUND_TRX'
+
+    callLater = reactor.callLater
+
+    def __init__(self, config, redis, esme_callbacks):
+        self.config = config
+        self.esme_callbacks = esme_callbacks
+        self.defaults = config.to_dict()
+        self.state = 'CLOSED'
+        log.msg('STATE: %s' % (self.state,))
+        self.smpp_bind_timeout = self.config.smpp_bind_timeout
+        self.smpp_enquire_link_interval = \
+                self.config.smpp_enquire_link_interval
+        self.pdu_buffer = PduBuffer()
+        self.redis = redis
+        self.sequence_allocator = SequenceAllocator(
+            redis, self.config.sequence_block_size)
+        self._lose_conn = None
+        # Sequence numbers of submitted messages waiting for a response.
+        self._unacked = set()
+        # The dispatcher makes sure we don't handle too many PDUs at once
+        # and that PDUs which need to be handled in order are.
+        self._pdu_dispatcher = PduDispatcher(self.config.pdu_concurrency)
 
-        # We reset the counter by deleting the key. The next INCR will recreate
-        # it for us.
-        yield self.redis.delete('smpp_last_sequence_number')
+    def get_next_seq(self):
+        """Get the next available SMPP sequence number.
+
+        Sequence numbers come from blocks leased from Redis by
+        :class:`SequenceAllocator`, so most calls don't touch Redis at all.
+        """
+        return self.sequence_allocator.next_seq()
 
     def pop_data(self):
-        data = None
-        if(len(self.datastream) >= 16):
-            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
-            if(len(self.datastream) >= command_length):
-                data = self.datastream[0:command_length]
-                self.datastream = self.datastream[command_length:]
-        return data
+        return self.pdu_buffer.pop()
 
-    @inlineCallbacks
     def handle_data(self, data):
-        pdu = unpack_pdu(data)
+        return self.handle_pdu(unpack_pdu(data), data)
+
+    @inlineCallbacks
+    def handle_pdu(self, pdu, data=None):
         command_id = pdu['header']['command_id']
         if command_id not in ('enquire_link', 'enquire_link_resp'):
-            log.debug('INCOMING <<<< %s' % binascii.b2a_hex(data))
-            log.debug('INCOMING <<<< %s' % pdu)
+            # These are only turned into strings if someone wants them.
+            if data is not None:
+                log.debug('INCOMING <<<<', HexDump(data))
+            log.debug('INCOMING <<<<', pdu)
         handler = getattr(self, 'handle_%s' % (command_id,),
                           self._command_handler_not_found)
         yield handler(pdu)
 
-    @inlineCallbacks
-    def _process_pdu_queue(self):
-        data = yield self._pdu_queue.get()
-        while data is not None:
-            yield self.handle_data(data)
-            data = yield self._pdu_queue.get()
+    def pdu_ordering_key(self, pdu):
+        """Return a key for PDUs that must be handled one after the other
+        in the order they arrived, or `None` if `pdu` can be handled
+        alongside anything else.
+
+        Messages from the same address are kept in order, which covers
+        both multipart reassembly and USSD sessions.
+        """
+        if pdu['header']['command_id'] == 'deliver_sm':
+            return pdu['body']['mandatory_parameters']['source_addr']
+        return None
+
+    def dispatch_pdu(self, data):
+        """Unpack a PDU and hand it to the dispatcher to be handled."""
+        try:
+            pdu = unpack_pdu(data)
+        except Exception:
+            log.err(None, "Unable to unpack PDU: %r" % (data,))
+            return
+        d = self._pdu_dispatcher.dispatch(
+            self.pdu_ordering_key(pdu), self.handle_pdu, pdu, data)
+        d.addErrback(log.err)
 
     def _command_handler_not_found(self, pdu):
         log.err('No command handler available for %s' % (pdu,))
@@ -184,18 +345,19 @@ class EsmeTransceiver(Protocol):
         log.msg('STATE: %s' % (self.state))
 
     def dataReceived(self, data):
-        self.datastream += data
-        data = self.pop_data()
-        while data is not None:
-            self._pdu_queue.put(data)
-            data = self.pop_data()
+        self.pdu_buffer.feed(data)
+        try:
+            for pdu_data in self.pdu_buffer:
+                self.dispatch_pdu(pdu_data)
+        except PduFramingError:
+            log.err(None, "Unable to read PDU, dropping connection.")
+            self.transport.loseConnection()
 
     def send_pdu(self, pdu):
         data = pdu.get_bin()
-        unpacked = unpack_pdu(data)
-        command_id = unpacked['header']['command_id']
+        command_id = pdu.obj['header']['command_id']
         if command_id not in ('enquire_link', 'enquire_link_resp'):
-            log.debug('OUTGOING >>>> %s' % unpacked)
+            log.debug('OUTGOING >>>>', pdu.obj)
         self.transport.write(data)
 
     @inlineCallbacks
@@ -227,7 +389,7 @@ class EsmeTransceiver(Protocol):
 
     @inlineCallbacks
     def handle_submit_sm_resp(self, pdu):
-        yield self.pop_unacked()
+        self.pop_unacked(pdu['header']['sequence_number'])
         message_id = pdu.get('body', {}).get(
                 'mandatory_parameters', {}).get('message_id')
         yield self.esme_callbacks.submit_sm_resp(
@@ -425,17 +587,17 @@ class EsmeTransceiver(Protocol):
             log.msg("enquire_link_resp NOT OK: %r" % (pdu,))
 
     def get_unacked_count(self):
-        return self.redis.llen("unacked").addCallback(int)
+        return len(self._unacked)
 
-    @inlineCallbacks
-    def push_unacked(self, sequence_number=-1):
-        yield self.redis.lpush("unacked", sequence_number)
-        log.msg("unacked pushed to: %s" % ((yield self.get_unacked_count())))
+    def get_unacked(self):
+        """Return the sequence numbers of submits waiting for a response."""
+        return sorted(self._unacked)
 
-    @inlineCallbacks
-    def pop_unacked(self):
-        yield self.redis.lpop("unacked")
-        log.msg("unacked popped to: %s" % ((yield self.get_unacked_count())))
+    def push_unacked(self, sequence_number):
+        self._unacked.add(sequence_number)
+
+    def pop_unacked(self, sequence_number):
+        self._unacked.discard(sequence_number)
 
     @inlineCallbacks
     def submit_sm(self, **kwargs):
@@ -458,7 +620,7 @@ class EsmeTransceiver(Protocol):
             pdu.add_message_payload(''.join('%02x' % ord(c) for c in message))
 
         self.send_pdu(pdu)
-        yield self.push_unacked(sequence_number)
+        self.push_unacked(sequence_number)
         returnValue(sequence_number)
 
     @inlineCallbacks
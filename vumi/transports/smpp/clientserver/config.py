@@ -27,6 +27,8 @@ class ClientConfig(object):
                  delivery_report_regex=None,
                  data_coding_overrides=None,
                  send_long_messages=False,
+                 sequence_block_size=1000,
+                 pdu_concurrency=1,
                  ):
         # in SMPP system_id is the username
         self.host = host
@@ -50,6 +52,8 @@ class ClientConfig(object):
         self.data_coding_overrides = dict(
             (int(k), v) for k, v in (data_coding_overrides or {}).items())
         self.send_long_messages = send_long_messages
+        self.sequence_block_size = int(sequence_block_size)
+        self.pdu_concurrency = int(pdu_concurrency)
 
     def __eq__(self, other):
         if not isinstance(other, ClientConfig):
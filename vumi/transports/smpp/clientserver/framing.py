@@ -0,0 +1,48 @@
+# -*- test-case-name: vumi.transports.smpp.clientserver.tests.test_framing -*-
+
+"""Splitting a stream of bytes into SMPP PDUs."""
+
+import struct
+import binascii
+
+from vumi.utils import OffsetBuffer
+
+
+class PduFramingError(Exception):
+    """Raised when the stream contains an impossible PDU header."""
+
+
+class PduBuffer(OffsetBuffer):
+    """Buffer of received bytes that PDUs can be popped off."""
+
+    # Every PDU starts with a 16 byte header, the first four bytes of which
+    # are the length of the whole PDU.
+    HEADER_LENGTH = 16
+    COMMAND_LENGTH = struct.Struct('!L')
+
+    def pop(self):
+        """Return the next complete PDU, or `None` if there isn't one."""
+        if len(self) < self.HEADER_LENGTH:
+            return None
+        [command_length] = self.COMMAND_LENGTH.unpack_from(
+            self._buffer, self._offset)
+        if command_length < self.HEADER_LENGTH:
+            raise PduFramingError(
+                "Invalid command_length: %d" % (command_length,))
+        if len(self) < command_length:
+            return None
+        return self._take(self._offset, self._offset + command_length)
+
+
+class HexDump(object):
+    """Hex representation of `data` that is only built if it's needed,
+    for passing to log functions.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.b2a_hex(self.data)
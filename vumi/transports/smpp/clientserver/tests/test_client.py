@@ -1,14 +1,15 @@
 from twisted.trial import unittest
 from twisted.internet.task import Clock
-from twisted.internet.defer import inlineCallbacks, returnValue
-from smpp.pdu_builder import DeliverSM, BindTransceiverResp
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from smpp.pdu_builder import DeliverSM, BindTransceiverResp, EnquireLink
 from smpp.pdu import unpack_pdu
 
 from vumi.tests.utils import LogCatcher, PersistenceMixin
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiver, EsmeReceiver, EsmeTransmitter, EsmeCallbacks, ESME,
-    unpacked_pdu_opts)
+    SequenceAllocator, PduDispatcher, unpacked_pdu_opts)
 from vumi.transports.smpp.clientserver.config import ClientConfig
+from vumi.transports.smpp.clientserver.framing import PduFramingError
 
 
 class FakeTransport(object):
@@ -150,11 +151,106 @@ class EsmeGenericMixin(object):
     @inlineCallbacks
     def test_sequence_rollover(self):
         esme = yield self.get_unbound_esme()
-        self.assertEqual(1, (yield esme.get_next_seq()))
-        self.assertEqual(2, (yield esme.get_next_seq()))
+        seqs = SequenceAllocator(esme.redis, block_size=1)
+        self.assertEqual(1, (yield seqs.next_seq()))
+        self.assertEqual(2, (yield seqs.next_seq()))
         yield esme.redis.set('smpp_last_sequence_number', 0xFFFF0000)
-        self.assertEqual(0xFFFF0001, (yield esme.get_next_seq()))
+        self.assertEqual(0xFFFF0001, (yield seqs.next_seq()))
+        self.assertEqual(1, (yield seqs.next_seq()))
+
+    @inlineCallbacks
+    def test_sequence_block_leasing(self):
+        esme = yield self.get_unbound_esme()
         self.assertEqual(1, (yield esme.get_next_seq()))
+        self.assertEqual(2, (yield esme.get_next_seq()))
+        # The whole block is reserved in Redis by the first lease.
+        self.assertEqual(1000, int((yield esme.redis.get(
+            'smpp_last_sequence_number'))))
+        other = SequenceAllocator(esme.redis, block_size=1000)
+        self.assertEqual(1001, (yield other.next_seq()))
+        self.assertEqual(3, (yield esme.get_next_seq()))
+
+    @inlineCallbacks
+    def test_sequence_block_prefetch(self):
+        esme = yield self.get_unbound_esme()
+        seqs = SequenceAllocator(esme.redis, block_size=10)
+        for i in range(1, 10):
+            self.assertEqual(i, (yield seqs.next_seq()))
+        self.assertEqual(10, int((yield esme.redis.get(
+            'smpp_last_sequence_number'))))
+        # The next block is leased as soon as the first one runs low.
+        self.assertEqual(10, (yield seqs.next_seq()))
+        self.assertEqual(20, int((yield esme.redis.get(
+            'smpp_last_sequence_number'))))
+        self.assertEqual(11, (yield seqs.next_seq()))
+
+    @inlineCallbacks
+    def test_sequence_block_rollover(self):
+        esme = yield self.get_unbound_esme()
+        seqs = SequenceAllocator(esme.redis, block_size=10)
+        yield esme.redis.set('smpp_last_sequence_number', 0xFFFFFFFA)
+        # Only the part of the block that fits below 0xFFFFFFFF is used.
+        for seq in range(0xFFFFFFFB, 0xFFFFFFFF + 1):
+            self.assertEqual(seq, (yield seqs.next_seq()))
+        self.assertEqual(1, (yield seqs.next_seq()))
+
+    @inlineCallbacks
+    def test_sequence_rollover_waits_for_wrap(self):
+        esme = yield self.get_unbound_esme()
+        clock = Clock()
+        seqs = SequenceAllocator(esme.redis, block_size=10, clock=clock)
+        yield esme.redis.set('smpp_last_sequence_number', 0xFFFFFFFF)
+        # Someone else is in the middle of resetting the counter.
+        yield esme.redis.set('smpp_last_sequence_number_wrap', 1)
+        d = seqs.next_seq()
+        self.assertFalse(d.called)
+        # We only lease once while we wait for them.
+        self.assertEqual(0xFFFFFFFF + 10, int((yield esme.redis.get(
+            'smpp_last_sequence_number'))))
+        yield esme.redis.delete('smpp_last_sequence_number')
+        clock.advance(seqs.WRAP_RETRY_DELAY)
+        self.assertEqual(1, (yield d))
+
+    @inlineCallbacks
+    def test_data_received(self):
+        esme = yield self.get_unbound_esme()
+        queued = []
+        esme.dispatch_pdu = queued.append
+        pdus = [EnquireLink(seq).get_bin() for seq in [1, 2, 3]]
+        data = ''.join(pdus)
+        esme.dataReceived(data[:20])
+        self.assertEqual(pdus[:1], queued)
+        esme.dataReceived(data[20:])
+        self.assertEqual(pdus, queued)
+
+    @inlineCallbacks
+    def test_data_received_invalid_length(self):
+        esme = yield self.get_unbound_esme()
+        esme.dataReceived('\x00\x00\x00\x04' + '\x00' * 12)
+        self.assertEqual(False, esme.transport.connected)
+        [failure] = self.flushLoggedErrors(PduFramingError)
+
+    @inlineCallbacks
+    def test_dispatch_pdu_ordering(self):
+        esme = yield self.get_unbound_esme()
+        esme._pdu_dispatcher = PduDispatcher(2)
+        blocked = Deferred()
+        handled = []
+
+        def handle_pdu(pdu, data=None):
+            handled.append(pdu['header']['sequence_number'])
+            if len(handled) == 1:
+                return blocked
+
+        esme.handle_pdu = handle_pdu
+        esme.dispatch_pdu(DeliverSM(1, source_addr='123').get_bin())
+        esme.dispatch_pdu(DeliverSM(2, source_addr='123').get_bin())
+        esme.dispatch_pdu(EnquireLink(3).get_bin())
+        # A slow deliver_sm holds up later ones from the same address, but
+        # not unrelated PDUs.
+        self.assertEqual([1, 3], handled)
+        blocked.callback(None)
+        self.assertEqual([1, 3, 2], handled)
 
 
 class EsmeTransmitterMixin(EsmeGenericMixin):
@@ -359,6 +455,66 @@ class EsmeReceiverTestCase(EsmeTestCaseBase, EsmeReceiverMixin):
                              error['message'][0]))
 
 
+class PduDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.running = {}
+        self.handled = []
+
+    def handle(self, name):
+        self.handled.append(name)
+        d = Deferred()
+        self.running[name] = d
+        return d
+
+    def finish(self, name):
+        self.running.pop(name).callback(name)
+
+    def test_concurrency_limit(self):
+        dispatcher = PduDispatcher(2)
+        for name in 'abc':
+            dispatcher.dispatch(None, self.handle, name)
+        self.assertEqual(['a', 'b'], self.handled)
+        self.finish('b')
+        self.assertEqual(['a', 'b', 'c'], self.handled)
+
+    def test_strict_order(self):
+        dispatcher = PduDispatcher()
+        results = []
+        for name in 'ab':
+            dispatcher.dispatch(None, self.handle, name).addCallback(
+                results.append)
+        self.assertEqual(['a'], self.handled)
+        self.finish('a')
+        self.assertEqual(['a', 'b'], self.handled)
+        self.finish('b')
+        self.assertEqual(['a', 'b'], results)
+
+    def test_keyed_order(self):
+        dispatcher = PduDispatcher(3)
+        results = []
+        for key, name in [(1, 'a'), (1, 'b'), (2, 'c'), (None, 'd')]:
+            dispatcher.dispatch(key, self.handle, name).addCallback(
+                results.append)
+        self.assertEqual(['a', 'c', 'd'], self.handled)
+        self.finish('a')
+        self.assertEqual(['a', 'c', 'd', 'b'], self.handled)
+        self.finish('b')
+        self.assertEqual(['a', 'b'], results)
+        self.assertEqual({2: dispatcher._keyed[2]}, dispatcher._keyed)
+
+    def test_keyed_failure(self):
+        dispatcher = PduDispatcher(2)
+        failures = []
+        dispatcher.dispatch(1, self.handle, 'a').addErrback(failures.append)
+        dispatcher.dispatch(1, self.handle, 'b')
+        self.running.pop('a').errback(ValueError("boom"))
+        # A failed handler doesn't hold up the rest of its key.
+        self.assertEqual(['a', 'b'], self.handled)
+        [failure] = failures
+        failure.trap(ValueError)
+
+
 class ESMETestCase(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,58 @@
+"""Tests for vumi.transports.smpp.clientserver.framing."""
+
+from twisted.trial import unittest
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.transports.smpp.clientserver.framing import (
+    PduBuffer, PduFramingError, HexDump)
+
+
+class PduBufferTestCase(unittest.TestCase):
+
+    def test_pop_empty(self):
+        self.assertEqual(None, PduBuffer().pop())
+
+    def test_pop_whole_pdus(self):
+        pdu1 = EnquireLink(1).get_bin()
+        pdu2 = DeliverSM(2, short_message="hello").get_bin()
+        buf = PduBuffer()
+        buf.feed(pdu1 + pdu2)
+        self.assertEqual(pdu1, buf.pop())
+        self.assertEqual(pdu2, buf.pop())
+        self.assertEqual(None, buf.pop())
+        self.assertEqual(0, len(buf))
+
+    def test_partial_pdus(self):
+        pdu = DeliverSM(1, short_message="hello").get_bin()
+        buf = PduBuffer()
+        # Less than a header.
+        buf.feed(pdu[:10])
+        self.assertEqual(None, buf.pop())
+        # Header, but not the whole PDU.
+        buf.feed(pdu[10:20])
+        self.assertEqual(None, buf.pop())
+        buf.feed(pdu[20:] + pdu[:5])
+        self.assertEqual(pdu, buf.pop())
+        self.assertEqual(None, buf.pop())
+        buf.feed(pdu[5:])
+        self.assertEqual([pdu], list(buf))
+
+    def test_compaction(self):
+        pdu = EnquireLink(1).get_bin()
+        buf = PduBuffer()
+        for i in range(100):
+            buf.feed(pdu)
+            buf.feed(pdu[:4])
+            self.assertEqual(pdu, buf.pop())
+            buf.feed(pdu[4:])
+            self.assertEqual(pdu, buf.pop())
+        # Consumed data doesn't pile up.
+        self.assertTrue(len(buf._buffer) <= 2 * len(pdu))
+
+    def test_invalid_command_length(self):
+        buf = PduBuffer()
+        buf.feed('\x00\x00\x00\x04' + '\x00' * 12)
+        self.assertRaises(PduFramingError, buf.pop)
+
+    def test_hex_dump(self):
+        self.assertEqual('00ff41', str(HexDump('\x00\xffA')))
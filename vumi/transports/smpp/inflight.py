@@ -0,0 +1,179 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_inflight -*-
+
+"""In-memory tracking of submitted SMPP messages with Redis write-behind."""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi import log
+from vumi.message import Message
+from vumi.persist.write_behind import WriteBehind
+
+
+class InFlightTable(object):
+    """Messages submitted to the SMSC that haven't had a `submit_sm_resp` yet.
+
+    The table lives in memory and is keyed by sequence number, so looking up
+    the message for a response doesn't touch Redis. Changes are written to
+    Redis in the background in batches (a single pipelined round trip every
+    `flush_interval` seconds, or sooner once `flush_size` changes have
+    built up). Messages that are added and removed between two flushes
+    never reach Redis at all.
+
+    Mappings from third party message ids to our message ids are written
+    to Redis straight away, since delivery reports may arrive on another
+    bind (or another worker) sharing the same Redis prefix.
+
+    If `persist` is set and the process dies, whatever was last flushed can
+    be recovered with :meth:`load` when it starts up again. Each table is
+    stored under a key of its own, named by `table_id`, so workers sharing
+    a Redis prefix must use different ids and a restarted worker must use
+    the same one as before.
+
+    :param redis:
+        Redis manager to persist to.
+    :param str table_id:
+        Identifies this worker's table among others on the same prefix.
+    :param bool persist:
+        Whether to write in-flight messages to Redis at all.
+    :param float flush_interval:
+        Maximum number of seconds a change is held in memory before it is
+        written to Redis.
+    :param int flush_size:
+        Number of buffered changes that triggers an immediate flush.
+    :param int third_party_id_expiry:
+        Expiry time (in seconds) for third party id mappings.
+    :param clock:
+        Something providing `callLater`. Defaults to the reactor.
+    """
+
+    INFLIGHT_KEY = "inflight_messages"
+    THIRD_PARTY_ID_PREFIX = "3rd_party_id"
+
+    def __init__(self, redis, table_id, persist=True, flush_interval=1.0,
+                 flush_size=100, third_party_id_expiry=60 * 60 * 24 * 7,
+                 clock=None):
+        self.redis = redis
+        self.inflight_key = "%s:%s" % (self.INFLIGHT_KEY, table_id)
+        self.persist = persist
+        self.third_party_id_expiry = third_party_id_expiry
+        self._writer = WriteBehind(
+            self._write, self.pending_count, flush_interval=flush_interval,
+            flush_size=flush_size, clock=clock)
+        self._messages = {}
+        # Sequence number -> message to write, or None to delete.
+        self._dirty = {}
+        # Sequence numbers we've sent (or are sending) to Redis.
+        self._persisted = set()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __contains__(self, sequence_number):
+        return sequence_number in self._messages
+
+    def third_party_id_key(self, third_party_id):
+        return "%s#%s" % (self.THIRD_PARTY_ID_PREFIX, third_party_id)
+
+    def add(self, sequence_number, message):
+        """Track `message` as in flight under `sequence_number`."""
+        self._messages[sequence_number] = message
+        if self.persist:
+            self._dirty[sequence_number] = message
+            self._writer.changed()
+
+    def get(self, sequence_number):
+        return self._messages.get(sequence_number)
+
+    def pop(self, sequence_number):
+        """Stop tracking `sequence_number` and return its message.
+
+        Returns `None` if there is no message for `sequence_number`.
+        """
+        message = self._messages.pop(sequence_number, None)
+        if sequence_number in self._persisted:
+            self._dirty[sequence_number] = None
+            self._writer.changed()
+        else:
+            self._dirty.pop(sequence_number, None)
+        return message
+
+    def set_third_party_id(self, third_party_id, message_id):
+        """Map a third party id to our message id.
+
+        Returns a deferred that fires once the mapping has been written to
+        Redis.
+        """
+        rkey = self.third_party_id_key(third_party_id)
+        pipe = self.redis.pipeline()
+        pipe.set(rkey, message_id)
+        pipe.expire(rkey, self.third_party_id_expiry)
+        return pipe.execute()
+
+    def get_third_party_id(self, third_party_id):
+        """Return a deferred that fires with our message id for
+        `third_party_id`, or `None` if there isn't one.
+        """
+        return self.redis.get(self.third_party_id_key(third_party_id))
+
+    def pending_count(self):
+        return len(self._dirty)
+
+    def flush(self):
+        """Write all buffered changes to Redis in a single round trip.
+
+        Returns a deferred that fires once the changes have been written.
+        Only one write is ever in progress, changes made while it is running
+        are written by the next one.
+        """
+        return self._writer.flush()
+
+    def _write(self):
+        dirty, self._dirty = self._dirty, {}
+        pipe = self.redis.pipeline()
+        mapping = {}
+        deleted = []
+        for sequence_number, message in dirty.iteritems():
+            if message is None:
+                deleted.append(str(sequence_number))
+                self._persisted.discard(sequence_number)
+            else:
+                mapping[str(sequence_number)] = message.to_json()
+                self._persisted.add(sequence_number)
+        if mapping:
+            pipe.hmset(self.inflight_key, mapping)
+        if deleted:
+            pipe.hdel(self.inflight_key, *deleted)
+
+        d = pipe.execute()
+        d.addErrback(self._flush_failed, dirty)
+        return d
+
+    def _flush_failed(self, failure, dirty):
+        log.err(failure, "Failed to write in-flight messages to Redis.")
+        # Put back anything that hasn't been superseded since, so that the
+        # next flush retries it.
+        for sequence_number, message in dirty.iteritems():
+            if message is None:
+                self._persisted.add(sequence_number)
+            self._dirty.setdefault(sequence_number, message)
+
+    @inlineCallbacks
+    def load(self):
+        """Claim messages left in flight by a previous run with the same
+        `table_id`.
+
+        The messages are removed from Redis and returned (ordered by
+        sequence number) so that they can be resubmitted. They are not added
+        to the table, since they'll get new sequence numbers when they're
+        sent again.
+        """
+        stored = yield self.redis.hgetall(self.inflight_key)
+        if not stored:
+            returnValue([])
+        yield self.redis.hdel(self.inflight_key, *stored.keys())
+        returnValue([Message.from_json(stored[k])
+                     for k in sorted(stored, key=int)])
+
+    def stop(self):
+        """Cancel any scheduled flush and write out what is left."""
+        return self._writer.stop()
@@ -0,0 +1,289 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_scheduler -*-
+
+"""Rate and window limited scheduling of outbound SMPP submits."""
+
+import time
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from vumi import log
+from vumi.blinkenlights.metrics import Metric, MAX, AVG
+
+
+class SampledMetric(Metric):
+    """A metric whose value is read from `func` whenever it is polled."""
+
+    def __init__(self, suffix, func, aggregators=None):
+        super(SampledMetric, self).__init__(suffix, aggregators)
+        self.func = func
+
+    def poll(self):
+        return [(int(time.time()), self.func())]
+
+
+class TokenBucket(object):
+    """Token bucket allowing `rate` events per second on average with bursts
+    of up to `burst` events.
+    """
+
+    def __init__(self, rate, burst, clock):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self._last = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self):
+        """Take a token if one is available.
+
+        Returns `0` if a token was taken, otherwise the number of seconds
+        until one will be.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class SubmitScheduler(object):
+    """Schedules outbound messages for submission to the SMSC.
+
+    Messages are sent with `send_func` subject to three limits:
+
+    * at most `window_size` submits may be waiting for a `submit_sm_resp`,
+    * submits are spaced out by a token bucket allowing `tps` submits per
+      second on average (and `burst` at once),
+    * after the SMSC throttles us, nothing is sent until a backoff delay has
+      passed.
+
+    The backoff delay starts at `backoff_delay` and doubles for each throttle
+    response that arrives after the previous backoff has finished, up to
+    `max_backoff_delay`. Each throttle also halves the current send rate
+    (never below `min_tps`), which then climbs back towards `tps` by
+    `recovery_rate * tps` with each successful response.
+
+    Messages queued with `priority=True` (USSD session replies, for example)
+    are always sent before other queued messages.
+
+    :param send_func:
+        Called with each message to send it. Should return (possibly via a
+        deferred) the sequence number of the submit, or something false if
+        nothing was submitted.
+    :param int window_size:
+        Maximum number of outstanding submits. `None` means no limit.
+    :param float tps:
+        Target number of submits per second. `None` means no limit.
+    :param int burst:
+        Size of the token bucket.
+    :param float backoff_delay:
+        Initial delay after a throttle response.
+    :param float max_backoff_delay:
+        Maximum delay after a throttle response.
+    :param clock:
+        Something providing `callLater` and `seconds`. Defaults to the
+        reactor.
+    """
+
+    recovery_rate = 0.05
+
+    def __init__(self, send_func, window_size=None, tps=None, burst=1,
+                 backoff_delay=0.1, max_backoff_delay=30.0, min_tps=1.0,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.send_func = send_func
+        self.window_size = window_size
+        self.tps = tps
+        self.min_tps = min(min_tps, tps) if tps else min_tps
+        self.backoff_delay = backoff_delay
+        self.max_backoff_delay = max_backoff_delay
+        self.clock = clock
+        self.bucket = None
+        if tps:
+            self.bucket = TokenBucket(tps, burst, clock)
+        self.outstanding = 0
+        self._priority = deque()
+        self._bulk = deque()
+        self._throttle_count = 0
+        self._backoff_call = None
+        self._pump_call = None
+        self._pumping = False
+        self.paused = False
+
+    def queue_depth(self):
+        return len(self._priority) + len(self._bulk)
+
+    def window_full(self):
+        return (self.window_size is not None
+                and self.outstanding >= self.window_size)
+
+    def is_backing_off(self):
+        return self._backoff_call is not None
+
+    def current_tps(self):
+        return self.bucket.rate if self.bucket is not None else None
+
+    def submit(self, message, priority=False):
+        """Queue `message` for sending.
+
+        Returns a deferred that fires with the result of `send_func` once
+        the message has been sent.
+        """
+        d = Deferred()
+        lane = self._priority if priority else self._bulk
+        lane.append((message, d))
+        self._pump()
+        return d
+
+    def requeue(self, message, priority=False):
+        """Put `message` at the front of its lane to be sent again."""
+        lane = self._priority if priority else self._bulk
+        lane.appendleft((message, None))
+        self._pump()
+
+    def response(self, throttled=False):
+        """Tell the scheduler a `submit_sm_resp` has arrived."""
+        self.outstanding = max(0, self.outstanding - 1)
+        if throttled:
+            self._throttled()
+        else:
+            self._throttle_count = 0
+            if self.bucket is not None:
+                self.bucket.rate = min(
+                    self.tps, self.bucket.rate + self.tps * self.recovery_rate)
+        self._pump()
+
+    def reset_window(self):
+        """Forget about outstanding submits, for example because the
+        connection they were sent over has gone away.
+        """
+        self.outstanding = 0
+        self._pump()
+
+    def forget(self, count=1):
+        """Free `count` window slots for submits that will never get a
+        response, without treating them as successful.
+        """
+        self.outstanding = max(0, self.outstanding - count)
+        self._pump()
+
+    def pause(self):
+        """Stop sending until :meth:`unpause` is called. Messages are still
+        accepted and queued.
+        """
+        self.paused = True
+
+    def unpause(self):
+        self.paused = False
+        self._pump()
+
+    def _throttled(self):
+        if self.is_backing_off():
+            # Everything we sent before backing off is likely to come back
+            # throttled too, we don't want that to make things worse.
+            return
+        self._throttle_count += 1
+        delay = min(self.max_backoff_delay,
+                    self.backoff_delay * 2 ** (self._throttle_count - 1))
+        if self.bucket is not None:
+            self.bucket.rate = max(self.min_tps, self.bucket.rate / 2)
+        self._cancel_pump_call()
+        self._backoff_call = self.clock.callLater(delay, self._backoff_done)
+
+    def _backoff_done(self):
+        self._backoff_call = None
+        self._pump()
+
+    def _cancel_pump_call(self):
+        if self._pump_call is not None:
+            if self._pump_call.active():
+                self._pump_call.cancel()
+            self._pump_call = None
+
+    def _scheduled_pump(self):
+        self._pump_call = None
+        self._pump()
+
+    def _pump(self):
+        if self._pumping:
+            # We're already in the loop below and it will pick up whatever
+            # changed.
+            return
+        self._pumping = True
+        try:
+            while self.queue_depth() and self._pump_call is None:
+                if (self.paused or self.is_backing_off()
+                        or self.window_full()):
+                    return
+                if self.bucket is not None:
+                    wait = self.bucket.take()
+                    if wait:
+                        self._pump_call = self.clock.callLater(
+                            wait, self._scheduled_pump)
+                        return
+                lane = self._priority or self._bulk
+                message, d = lane.popleft()
+                self._send(message, d)
+        finally:
+            self._pumping = False
+
+    def _send(self, message, d):
+        self.outstanding += 1
+        sd = maybeDeferred(self.send_func, message)
+        sd.addCallbacks(self._sent, self._send_failed)
+        if d is None:
+            sd.addErrback(log.err)
+        else:
+            sd.chainDeferred(d)
+
+    def _release(self):
+        self.outstanding = max(0, self.outstanding - 1)
+        self._pump()
+
+    def _sent(self, sequence_number):
+        if not sequence_number:
+            # Nothing was submitted, so there's no response to wait for.
+            self._release()
+        return sequence_number
+
+    def _send_failed(self, failure):
+        self._release()
+        return failure
+
+    def get_metrics(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'priority_queue_depth': len(self._priority),
+            'bulk_queue_depth': len(self._bulk),
+            'window_occupancy': self.outstanding,
+            'window_size': self.window_size,
+            'tps': self.current_tps(),
+            'backing_off': self.is_backing_off(),
+            'paused': self.paused,
+        }
+
+    def register_metrics(self, metric_manager):
+        """Register queue depth and window occupancy metrics with
+        `metric_manager`.
+        """
+        metric_manager.register(SampledMetric(
+            'submit_queue_depth', self.queue_depth, [MAX, AVG]))
+        metric_manager.register(SampledMetric(
+            'submit_window_occupancy', lambda: self.outstanding, [MAX, AVG]))
+
+    def stop(self):
+        """Cancel any pending timers. Queued messages are left queued."""
+        self._cancel_pump_call()
+        if self._backoff_call is not None:
+            if self._backoff_call.active():
+                self._backoff_call.cancel()
+            self._backoff_call = None
@@ -0,0 +1,131 @@
+"""Tests for vumi.transports.smpp.inflight."""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.message import TransportUserMessage
+from vumi.tests.utils import PersistenceMixin
+from vumi.transports.smpp.inflight import InFlightTable
+
+
+class InFlightTableTestCase(unittest.TestCase, PersistenceMixin):
+    timeout = 5
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.clock = Clock()
+        self.table = self.mk_table()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_table(self, table_id='worker1', **kw):
+        kw.setdefault('clock', self.clock)
+        return InFlightTable(self.redis, table_id, **kw)
+
+    def mkmsg(self, message_id):
+        return TransportUserMessage(
+            message_id=message_id, to_addr='+27831234567',
+            from_addr='12345', transport_name='sphex',
+            transport_type='sms', content='hello')
+
+    def get_stored(self, table_id='worker1'):
+        return self.redis.hgetall(
+            "%s:%s" % (InFlightTable.INFLIGHT_KEY, table_id))
+
+    @inlineCallbacks
+    def test_add_and_pop(self):
+        msg = self.mkmsg('1')
+        self.table.add(5, msg)
+        self.assertTrue(5 in self.table)
+        self.assertEqual(1, len(self.table))
+        self.assertEqual(msg, self.table.pop(5))
+        self.assertEqual(None, self.table.pop(5))
+        self.assertEqual(0, len(self.table))
+        # Nothing needs to be written for a message that came and went.
+        self.assertEqual(0, self.table.pending_count())
+        self.clock.advance(1)
+        self.assertEqual({}, (yield self.get_stored()))
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        msg = self.mkmsg('1')
+        self.table.add(5, msg)
+        self.assertEqual({}, (yield self.get_stored()))
+        self.clock.advance(1)
+        stored = yield self.get_stored()
+        self.assertEqual([msg.to_json()], stored.values())
+
+        self.table.pop(5)
+        self.assertEqual(1, self.table.pending_count())
+        self.clock.advance(1)
+        self.assertEqual({}, (yield self.get_stored()))
+
+    @inlineCallbacks
+    def test_flush_size(self):
+        table = self.mk_table(flush_size=2)
+        table.add(1, self.mkmsg('1'))
+        self.assertEqual({}, (yield self.get_stored()))
+        table.add(2, self.mkmsg('2'))
+        self.assertEqual(2, len((yield self.get_stored())))
+        self.assertEqual(0, table.pending_count())
+        yield table.stop()
+
+    @inlineCallbacks
+    def test_third_party_ids(self):
+        # Mappings are written through, not buffered.
+        yield self.table.set_third_party_id('their-1', 'our-1')
+        self.assertEqual(0, self.table.pending_count())
+        self.assertEqual(
+            'our-1', (yield self.table.get_third_party_id('their-1')))
+        self.assertEqual(
+            None, (yield self.table.get_third_party_id('their-2')))
+        rkey = self.table.third_party_id_key('their-1')
+        self.assertEqual('our-1', (yield self.redis.get(rkey)))
+        self.assertTrue((yield self.redis.ttl(rkey)) > 0)
+
+    @inlineCallbacks
+    def test_load(self):
+        msg1, msg2 = self.mkmsg('1'), self.mkmsg('2')
+        self.table.add(10, msg2)
+        self.table.add(9, msg1)
+        self.table.add(11, self.mkmsg('3'))
+        self.table.pop(11)
+        yield self.table.stop()
+
+        table = self.mk_table()
+        self.assertEqual([msg1, msg2], (yield table.load()))
+        self.assertEqual(0, len(table))
+        # The messages have been claimed.
+        self.assertEqual({}, (yield self.get_stored()))
+        self.assertEqual([], (yield table.load()))
+
+    @inlineCallbacks
+    def test_load_own_table_only(self):
+        other = self.mk_table('worker2')
+        msg1, msg2 = self.mkmsg('1'), self.mkmsg('2')
+        self.table.add(1, msg1)
+        other.add(1, msg2)
+        yield self.table.stop()
+        yield other.stop()
+
+        # A restarted worker1 doesn't take worker2's messages.
+        self.assertEqual([msg1], (yield self.mk_table().load()))
+        self.assertEqual({}, (yield self.get_stored()))
+        self.assertEqual([msg2.to_json()],
+                         (yield self.get_stored('worker2')).values())
+
+    @inlineCallbacks
+    def test_not_persisted(self):
+        table = self.mk_table(persist=False)
+        msg = self.mkmsg('1')
+        table.add(5, msg)
+        self.assertEqual(msg, table.get(5))
+        self.assertEqual(0, table.pending_count())
+        yield table.stop()
+        self.assertEqual({}, (yield self.get_stored()))
+        self.assertEqual(msg, table.pop(5))
+        self.assertEqual(0, table.pending_count())
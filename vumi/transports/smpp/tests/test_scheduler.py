@@ -0,0 +1,201 @@
+"""Tests for vumi.transports.smpp.scheduler."""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.transports.smpp.scheduler import SubmitScheduler, TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_take(self):
+        clock = Clock()
+        bucket = TokenBucket(4, 2, clock)
+        self.assertEqual(0, bucket.take())
+        self.assertEqual(0, bucket.take())
+        self.assertEqual(0.25, bucket.take())
+        clock.advance(0.125)
+        self.assertEqual(0.125, bucket.take())
+        clock.advance(0.125)
+        self.assertEqual(0, bucket.take())
+
+
+class SubmitSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sent = []
+        self.seq = 0
+
+    def send(self, message):
+        self.sent.append(message)
+        self.seq += 1
+        return self.seq
+
+    def mk_scheduler(self, **kw):
+        kw.setdefault('clock', self.clock)
+        return SubmitScheduler(self.send, **kw)
+
+    def test_unlimited(self):
+        scheduler = self.mk_scheduler()
+        results = []
+        scheduler.submit('a').addCallback(results.append)
+        scheduler.submit('b').addCallback(results.append)
+        self.assertEqual(['a', 'b'], self.sent)
+        self.assertEqual([1, 2], results)
+        self.assertEqual(2, scheduler.outstanding)
+
+    def test_window(self):
+        scheduler = self.mk_scheduler(window_size=2)
+        for msg in 'abc':
+            scheduler.submit(msg)
+        self.assertEqual(['a', 'b'], self.sent)
+        self.assertEqual(1, scheduler.queue_depth())
+        scheduler.response()
+        self.assertEqual(['a', 'b', 'c'], self.sent)
+        self.assertEqual(0, scheduler.queue_depth())
+
+    def test_window_not_held_by_dropped_submits(self):
+        self.send = lambda message: self.sent.append(message)
+        scheduler = self.mk_scheduler(window_size=1)
+        scheduler.submit('a')
+        scheduler.submit('b')
+        self.assertEqual(['a', 'b'], self.sent)
+        self.assertEqual(0, scheduler.outstanding)
+
+    def test_reset_window(self):
+        scheduler = self.mk_scheduler(window_size=1)
+        scheduler.submit('a')
+        scheduler.submit('b')
+        self.assertEqual(['a'], self.sent)
+        scheduler.reset_window()
+        self.assertEqual(['a', 'b'], self.sent)
+
+    def test_forget(self):
+        scheduler = self.mk_scheduler(window_size=2, tps=4, burst=4)
+        for msg in 'abc':
+            scheduler.submit(msg)
+        scheduler.forget(2)
+        self.assertEqual(['a', 'b', 'c'], self.sent)
+        self.assertEqual(1, scheduler.outstanding)
+        # Forgotten submits don't count as successes.
+        self.assertEqual(4, scheduler.current_tps())
+
+    def test_pause(self):
+        scheduler = self.mk_scheduler()
+        scheduler.pause()
+        scheduler.submit('a')
+        self.assertEqual([], self.sent)
+        scheduler.unpause()
+        self.assertEqual(['a'], self.sent)
+
+    def test_tps(self):
+        scheduler = self.mk_scheduler(tps=4)
+        for msg in 'abc':
+            scheduler.submit(msg)
+        self.assertEqual(['a'], self.sent)
+        self.clock.advance(0.25)
+        self.assertEqual(['a', 'b'], self.sent)
+        self.clock.advance(0.25)
+        self.assertEqual(['a', 'b', 'c'], self.sent)
+
+    def test_priority_lane(self):
+        scheduler = self.mk_scheduler(window_size=1)
+        scheduler.submit('bulk1')
+        scheduler.submit('bulk2')
+        scheduler.submit('ussd', priority=True)
+        scheduler.response()
+        scheduler.response()
+        self.assertEqual(['bulk1', 'ussd', 'bulk2'], self.sent)
+
+    def test_throttle_backoff(self):
+        scheduler = self.mk_scheduler(backoff_delay=1, max_backoff_delay=3)
+        scheduler.submit('a')
+        scheduler.response(throttled=True)
+        scheduler.requeue('a')
+        self.assertTrue(scheduler.is_backing_off())
+        self.assertEqual(['a'], self.sent)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'a'], self.sent)
+
+        # The delay doubles with each further throttle.
+        scheduler.response(throttled=True)
+        scheduler.requeue('a')
+        self.clock.advance(1)
+        self.assertEqual(['a', 'a'], self.sent)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'a', 'a'], self.sent)
+
+        # Up to the maximum.
+        scheduler.response(throttled=True)
+        scheduler.requeue('a')
+        self.clock.advance(3)
+        self.assertEqual(['a'] * 4, self.sent)
+
+        # And back to the start once things succeed.
+        scheduler.response()
+        scheduler.submit('b')
+        scheduler.response(throttled=True)
+        scheduler.requeue('b')
+        self.clock.advance(1)
+        self.assertEqual(['a'] * 4 + ['b', 'b'], self.sent)
+
+    def test_throttle_while_backing_off(self):
+        scheduler = self.mk_scheduler(backoff_delay=1)
+        scheduler.submit('a')
+        scheduler.submit('b')
+        scheduler.response(throttled=True)
+        scheduler.response(throttled=True)
+        self.assertEqual(1, scheduler._throttle_count)
+
+    def test_throttle_rate(self):
+        scheduler = self.mk_scheduler(tps=20, burst=20, backoff_delay=1)
+        scheduler.submit('a')
+        scheduler.response(throttled=True)
+        self.assertEqual(10, scheduler.current_tps())
+        self.clock.advance(1)
+        scheduler.response()
+        self.assertEqual(11, scheduler.current_tps())
+        for i in range(20):
+            scheduler.response()
+        self.assertEqual(20, scheduler.current_tps())
+
+    def test_send_failure(self):
+        d = Deferred()
+        self.send = lambda message: d
+        scheduler = self.mk_scheduler(window_size=1)
+        failures = []
+        scheduler.submit('a').addErrback(failures.append)
+        self.assertEqual(1, scheduler.outstanding)
+        d.errback(ValueError("boom"))
+        self.assertEqual(0, scheduler.outstanding)
+        [failure] = failures
+        failure.trap(ValueError)
+
+    def test_metrics(self):
+        scheduler = self.mk_scheduler(window_size=1, tps=10)
+        scheduler.submit('a')
+        scheduler.submit('b', priority=True)
+        self.assertEqual({
+            'queue_depth': 1,
+            'priority_queue_depth': 1,
+            'bulk_queue_depth': 0,
+            'window_occupancy': 1,
+            'window_size': 1,
+            'tps': 10,
+            'backing_off': False,
+            'paused': False,
+        }, scheduler.get_metrics())
+        scheduler.stop()
+
+    def test_register_metrics(self):
+        scheduler = self.mk_scheduler(window_size=1)
+        scheduler.submit('a')
+        scheduler.submit('b')
+        mm = MetricManager("vumi.test.")
+        scheduler.register_metrics(mm)
+        [(_, depth)] = mm['submit_queue_depth'].poll()
+        [(_, occupancy)] = mm['submit_window_occupancy'].poll()
+        self.assertEqual((1, 1), (depth, occupancy))
@@ -1,10 +1,12 @@
 import binascii
 
+from twisted.internet import reactor
 from twisted.internet.defer import Deferred, inlineCallbacks, succeed
-from twisted.internet.task import Clock
+from twisted.internet.task import Clock, deferLater
 from smpp.pdu_builder import SubmitSMResp, DeliverSM
 
 from vumi.message import TransportUserMessage
+from vumi.errors import ConfigError
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiver, EsmeCallbacks)
 from vumi.transports.smpp.transport import (SmppTransport,
@@ -46,16 +48,20 @@ class SmppTransportTestCase(TransportTestCase):
         self.transport.esme_connected(self.esme)
 
     def _make_esme(self):
+        self.esme = self.mk_esme()
+
+    def mk_esme(self):
         self.esme_callbacks = EsmeCallbacks(
             connect=lambda: None, disconnect=lambda: None,
             submit_sm_resp=self.transport.submit_sm_resp,
             delivery_report=self.transport.delivery_report,
             deliver_sm=lambda: None)
-        self.esme = EsmeTransceiver(
+        esme = EsmeTransceiver(
             self.clientConfig, self.transport.redis, self.esme_callbacks)
-        self.esme.sent_pdus = []
-        self.esme.send_pdu = self.esme.sent_pdus.append
-        self.esme.state = 'BOUND_TRX'
+        esme.sent_pdus = []
+        esme.send_pdu = esme.sent_pdus.append
+        esme.state = 'BOUND_TRX'
+        return esme
 
     def assert_sent_contents(self, expected):
         pdu_contents = [p.obj['body']['mandatory_parameters']['short_message']
@@ -71,33 +77,28 @@ class SmppTransportTestCase(TransportTestCase):
 
     @inlineCallbacks
     def test_message_persistence(self):
-        # A simple test of set -> get -> delete for redis message persistence
+        # A simple test of add -> flush -> load for in-flight messages
+        self.transport.inflight.persist = True
         message1 = self.mkmsg_out(
             message_id='1234567890abcdefg',
             content="hello world",
             to_addr="far-far-away")
-        original_json = message1.to_json()
-        yield self.transport.r_set_message(message1)
-        retrieved_json = yield self.transport.r_get_message_json(
-            message1['message_id'])
-        self.assertEqual(original_json, retrieved_json)
-        retrieved_message = yield self.transport.r_get_message(
-            message1['message_id'])
-        self.assertEqual(retrieved_message, message1)
-        self.assertTrue((yield self.transport.r_delete_message(
-                    message1['message_id'])))
-        self.assertEqual((yield self.transport.r_get_message_json(
-                    message1['message_id'])), None)
-        self.assertEqual((yield self.transport.r_get_message(
-                    message1['message_id'])), None)
+        self.transport.inflight.add(7, message1)
+        self.assertEqual(message1, self.transport.inflight.get(7))
+        yield self.transport.inflight.flush()
+        self.assertEqual(
+            [message1], (yield self.transport.inflight.load()))
+        self.assertEqual(message1, self.transport.inflight.pop(7))
+        self.assertEqual(None, self.transport.inflight.get(7))
 
     @inlineCallbacks
     def test_redis_third_party_id_persistence(self):
         # Testing: set -> get -> delete, for redis third party id mapping
         self.assertEqual(self.transport.third_party_id_expiry, 3600)
+        self.assertEqual(self.transport.inflight.third_party_id_expiry, 3600)
         our_id = "blergh34534545433454354"
         their_id = "omghesvomitingnumbers"
-        yield self.transport.r_set_id_for_third_party_id(their_id, our_id)
+        yield self.transport.inflight.set_third_party_id(their_id, our_id)
         retrieved_our_id = (
             yield self.transport.r_get_id_for_third_party_id(their_id))
         self.assertEqual(our_id, retrieved_our_id)
@@ -185,10 +186,11 @@ class SmppTransportTestCase(TransportTestCase):
     @inlineCallbacks
     def test_throttled_submit(self):
         clock = Clock()
-        self.transport.callLater = clock.callLater
+        self.transport.scheduler.clock = clock
 
         def assert_throttled_status(throttled, messages, acks):
-            self.assertEqual(self.transport.throttled, throttled)
+            self.assertEqual(
+                throttled, self.transport.scheduler.is_backing_off())
             self.assert_sent_contents(messages)
             self.assertEqual(acks, self.get_dispatched_events())
             self.assertEqual([], self.get_dispatched_failures())
@@ -206,19 +208,48 @@ class SmppTransportTestCase(TransportTestCase):
         clock.advance(0.05)
         assert_throttled_status(True, ["Heimlich"], [])
         message2 = self.mkmsg_out("Other", message_id="448")
-        yield self.dispatch(message2)
+        # This only finishes once the message has been submitted.
+        d = self.dispatch(message2)
+        yield self.wait_for_queue_depth(1)
         assert_throttled_status(True, ["Heimlich"], [])
-        # Resent
+        # Resent, followed by the queued message
         clock.advance(0.05)
-        assert_throttled_status(True, ["Heimlich", "Heimlich"], [])
+        yield d
+        self.assert_sent_contents(["Heimlich", "Heimlich", "Other"])
         # And acknowledged by the other side
         yield self.esme.handle_data(SubmitSMResp(2, "3rd_party_5").get_bin())
-        yield self._amqp.kick_delivery()
         yield self.esme.handle_data(SubmitSMResp(3, "3rd_party_6").get_bin())
         assert_throttled_status(False, ["Heimlich", "Heimlich", "Other"],
                                 [self.mkmsg_ack('447', '3rd_party_5'),
                                  self.mkmsg_ack('448', '3rd_party_6')])
 
+    @inlineCallbacks
+    def wait_for_queue_depth(self, depth):
+        while self.transport.scheduler.queue_depth() < depth:
+            yield deferLater(reactor, 0, lambda: None)
+
+    @inlineCallbacks
+    def test_priority_overtakes_queued_bulk(self):
+        self.transport.scheduler.window_size = 1
+        for i in range(1, 4):
+            self.dispatch(self.mkmsg_out("bulk %d" % (i,), message_id=str(i)))
+        yield self.wait_for_queue_depth(2)
+        d = self.dispatch(self.mkmsg_out(
+            "ussd", message_id='4', transport_type='ussd'))
+        yield self.wait_for_queue_depth(3)
+        self.assert_sent_contents(["bulk 1"])
+        for seq in range(1, 4):
+            yield self.esme.handle_data(
+                SubmitSMResp(seq, "3rd_party_%d" % (seq,)).get_bin())
+        yield d
+        self.assert_sent_contents(["bulk 1", "ussd", "bulk 2", "bulk 3"])
+
+    @inlineCallbacks
+    def test_consumer_concurrency_required(self):
+        transport = yield self.get_transport(
+            dict(self.config, amqp_consumer_concurrency=1), start=False)
+        self.assertRaises(ConfigError, transport.validate_config)
+
     @inlineCallbacks
     def test_reconnect(self):
         connector = self.transport.connectors[self.transport.transport_name]
@@ -233,6 +264,110 @@ class SmppTransportTestCase(TransportTestCase):
         yield self.transport.esme_connected(self.esme)
         self.assertFalse(connector._consumers['outbound'].paused)
 
+    def test_bind_configs(self):
+        self.assertEqual([(self.clientConfig, 'trx')],
+                         self.transport.bind_configs)
+        self.transport.config = dict(self.config, binds=[
+            {'host': 'smsc2'},
+            {'host': 'smsc3', 'bind_type': 'tx'},
+        ])
+        [(config1, type1), (config2, type2)] = (
+            self.transport.get_bind_configs())
+        self.assertEqual(('smsc2', 'trx'), (config1.host, type1))
+        self.assertEqual(('smsc3', 'tx'), (config2.host, type2))
+        self.assertEqual('vumitest-vumitest-vumitest', config2.system_id)
+
+        self.transport.config = dict(self.config, bind_count=3)
+        self.assertEqual([(self.clientConfig, 'trx')] * 3,
+                         self.transport.get_bind_configs())
+
+        self.transport.config = dict(self.config, binds=[{'bind_type': 'x'}])
+        self.assertRaises(ConfigError, self.transport.get_bind_configs)
+
+    @inlineCallbacks
+    def test_multiple_binds(self):
+        esme2 = self.mk_esme()
+        self.transport.esme_connected(esme2)
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='451'))
+        yield self.dispatch(self.mkmsg_out("message 2", message_id='452'))
+        yield self.dispatch(self.mkmsg_out("message 3", message_id='453'))
+        # Submits go to the bind with the fewest outstanding.
+        self.assert_sent_contents(["message 1", "message 3"])
+        self.assertEqual(["message 2"], [
+            p.obj['body']['mandatory_parameters']['short_message']
+            for p in esme2.sent_pdus])
+
+        [seq] = esme2.get_unacked()
+        yield esme2.handle_data(SubmitSMResp(seq, "3rd_party_8").get_bin())
+        # Delivery reports are handled whichever bind they arrive on.
+        dr = ("id:3rd_party_8 sub:... dlvrd:... submit date:200101010030"
+              " done date:200101020030 stat:DELIVRD err:... text:Meep")
+        yield self.esme.handle_data(DeliverSM(1, short_message=dr).get_bin())
+        [ack, dr_event] = self.get_dispatched_events()
+        self.assertEqual(self.mkmsg_ack('452', '3rd_party_8'), ack)
+        self.assertEqual('452', dr_event['user_message_id'])
+        self.assertEqual('delivered', dr_event['delivery_status'])
+
+    @inlineCallbacks
+    def test_bind_failover(self):
+        esme2 = self.mk_esme()
+        self.transport.esme_connected(esme2)
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='454'))
+        self.assert_sent_contents(["message 1"])
+
+        connector = self.transport.connectors[self.transport.transport_name]
+        self.transport.esme_disconnected(self.esme)
+        # The message is resent on the remaining bind.
+        self.assertEqual(["message 1"], [
+            p.obj['body']['mandatory_parameters']['short_message']
+            for p in esme2.sent_pdus])
+        self.assertFalse(connector._consumers['outbound'].paused)
+
+        self.transport.esme_disconnected(esme2)
+        self.assertTrue(connector._consumers['outbound'].paused)
+        self.assertTrue(self.transport.scheduler.paused)
+
+    @inlineCallbacks
+    def test_window_reset_when_binds_lost(self):
+        self.transport.scheduler.window_size = 1
+        yield self.dispatch(self.mkmsg_out("message 1", message_id='455'))
+        # A submit the client has no record of, so fail over can't free it.
+        self.transport.scheduler.outstanding += 1
+        self.transport.esme_disconnected(self.esme)
+        self.assertEqual(0, self.transport.scheduler.outstanding)
+        self.transport.esme_connected(self.esme)
+        # The failed over message is resent once the bind is back.
+        self.assert_sent_contents(["message 1", "message 1"])
+
+    @inlineCallbacks
+    def test_inflight_tracking(self):
+        message = self.mkmsg_out("hello", message_id='449')
+        yield self.dispatch(message)
+        self.assertEqual(message, self.transport.inflight.get(1))
+        yield self.esme.handle_data(SubmitSMResp(1, "3rd_party_7").get_bin())
+        self.assertEqual(0, len(self.transport.inflight))
+        self.assertEqual('449', (yield self.transport.
+                                 r_get_id_for_third_party_id("3rd_party_7")))
+
+    def test_inflight_replay_disabled(self):
+        self.assertFalse(self.transport.inflight.persist)
+        self.assertEqual(
+            "inflight_messages:%s" % (self.transport.transport_name,),
+            self.transport.inflight.inflight_key)
+
+    @inlineCallbacks
+    def test_inflight_replay(self):
+        # As if `inflight_replay` were set.
+        self.transport.inflight.persist = True
+        message = self.mkmsg_out("resend me", message_id='450')
+        yield self.dispatch(message)
+        yield self.transport.inflight.flush()
+        # Pretend we've been restarted without seeing a response.
+        self.transport._inflight_replay = (
+            yield self.transport.inflight.load())
+        yield self.transport.esme_connected(self.esme)
+        self.assert_sent_contents(["resend me", "resend me"])
+
 
 class MockSmppTransport(SmppTransport):
     @inlineCallbacks
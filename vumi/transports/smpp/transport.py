@@ -7,14 +7,28 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
 from vumi.utils import get_operator_number
+from vumi.config import ConfigInt
 from vumi.transports.base import Transport
 from vumi.transports.smpp.clientserver.client import (
     EsmeTransceiverFactory, EsmeTransmitterFactory, EsmeReceiverFactory,
     EsmeCallbacks)
 from vumi.transports.smpp.clientserver.config import ClientConfig
+from vumi.transports.smpp.inflight import InFlightTable
+from vumi.transports.smpp.scheduler import SubmitScheduler
 from vumi.transports.failures import FailureMessage
-from vumi.message import Message, TransportUserMessage
+from vumi.errors import ConfigError
+from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.blinkenlights.metrics import MetricManager
+
+
+class SmppTransportConfig(Transport.CONFIG_CLASS):
+
+    amqp_consumer_concurrency = ConfigInt(
+        "The number of outbound messages that may be waiting to be submitted"
+        " at once. Each message is acknowledged to AMQP once it has been"
+        " submitted. Must be at least 2, so that USSD messages can be sent"
+        " ahead of queued messages.", default=20, static=True)
 
 
 class SmppTransport(Transport):
@@ -42,6 +56,19 @@ class SmppTransport(Transport):
     :type port: int
     :param port:
         Port the SMPP server is listening on.
+    :type binds: list of dict, optional
+    :param binds:
+        Connections to open to the SMPP server(s). Each entry may override
+        any of the SMPP server account and protocol options for its bind and
+        may set `bind_type` to `trx`, `tx` or `rx` (the default depends on
+        the transport class, `trx` for this one). Submits are spread over
+        the bound transmitters with the fewest outstanding submits and are
+        moved to another bind if a connection is lost. Delivery reports are
+        handled no matter which bind they arrive on. Defaults to a single
+        bind using the top-level options.
+    :type bind_count: int, optional
+    :param bind_count:
+        If `binds` isn't given, open this many identical binds. Default 1.
     :type initial_reconnect_delay: int, optional
     :param initial_reconnect_delay:
         Number of seconds to delay before reconnecting to the server after
@@ -59,10 +86,74 @@ class SmppTransport(Transport):
         This _only_ needs to be done for TX & RX since messages sent via the TX
         bind are handled by the RX bind and they need to share the same prefix
         for the lookup for message ids in delivery reports to work.
+
+    Outbound submit scheduling options:
+
     :type throttle_delay: float, optional
     :param throttle_delay:
         Delay (in seconds) before retrying a message after receiving
-        `ESME_RTHROTTLED`. Default 0.1
+        `ESME_RTHROTTLED`. Default 0.1. The delay doubles for each further
+        throttle response, up to `max_throttle_delay`, and is reset by the
+        first successful response.
+    :type max_throttle_delay: float, optional
+    :param max_throttle_delay:
+        Maximum delay (in seconds) after receiving `ESME_RTHROTTLED`.
+        Default 30.
+    :type submit_window_size: int, optional
+    :param submit_window_size:
+        Maximum number of submits waiting for a `submit_sm_resp` on each
+        bind. Further messages are held until responses arrive. Default is
+        no limit.
+    :type submit_tps: float, optional
+    :param submit_tps:
+        Maximum number of submits per second. The rate is halved whenever
+        the SMSC throttles us and climbs back with successful responses.
+        Default is no limit.
+    :type submit_burst: int, optional
+    :param submit_burst:
+        Number of submits that may be sent at once before `submit_tps`
+        applies. Default 1.
+    :type metrics_prefix: str, optional
+    :param metrics_prefix:
+        If set, submit queue depth and window occupancy metrics are
+        published with this prefix.
+
+    USSD messages are sent ahead of any other queued messages. Up to
+    `amqp_consumer_concurrency` (default 20, at least 2) outbound messages
+    are consumed and queued in the transport at once, so that there is
+    something to overtake.
+
+    :type sequence_block_size: int, optional
+    :param sequence_block_size:
+        Number of SMPP sequence numbers to lease from Redis at a time. Each
+        lease costs one Redis call and the numbers in it are handed out
+        locally. Unused numbers are discarded when the transport reconnects.
+        Default 1000.
+    :type pdu_concurrency: int, optional
+    :param pdu_concurrency:
+        Number of incoming PDUs that may be handled at once on each bind.
+        Messages from the same address are always handled in the order
+        they arrived. Default 1 (handle everything strictly in order).
+    :type inflight_replay: bool, optional
+    :param inflight_replay:
+        If `True`, messages waiting for a `submit_sm_resp` are written to
+        Redis in the background and resubmitted when the transport starts
+        up again after dying. Default `False`.
+    :type inflight_table_id: str, optional
+    :param inflight_table_id:
+        Name for this worker's in-flight messages in Redis, used with
+        `inflight_replay`. Every worker sharing a Redis prefix must have a
+        different one, and a restarted worker must keep its old one.
+        Defaults to the transport name.
+    :type inflight_flush_interval: float, optional
+    :param inflight_flush_interval:
+        Messages waiting for a `submit_sm_resp` are tracked in memory. This
+        is the longest (in seconds) a change is held in memory before being
+        written to Redis. Default 1.0.
+    :type inflight_flush_size: int, optional
+    :param inflight_flush_size:
+        Number of buffered in-flight changes that triggers an immediate
+        write to Redis. Default 100.
 
     SMPP protocol configuration options:
 
@@ -122,14 +213,55 @@ class SmppTransport(Transport):
         '27761234567'}.
     """
 
+    CONFIG_CLASS = SmppTransportConfig
+
     # We only want to start this after we finish connecting to SMPP.
     start_message_consumer = False
 
-    callLater = reactor.callLater
+    bind_type = 'trx'
+
+    FACTORY_CLASSES = {
+        'trx': EsmeTransceiverFactory,
+        'tx': EsmeTransmitterFactory,
+        'rx': EsmeReceiverFactory,
+    }
 
     def validate_config(self):
         self.client_config = ClientConfig.from_config(self.config)
+        self.bind_configs = self.get_bind_configs()
         self.throttle_delay = float(self.config.get('throttle_delay', 0.1))
+        self.max_throttle_delay = float(
+            self.config.get('max_throttle_delay', 30.0))
+        self.submit_window_size = self.config.get('submit_window_size')
+        if self.submit_window_size is not None:
+            self.submit_window_size = int(self.submit_window_size)
+        self.submit_tps = self.config.get('submit_tps')
+        if self.submit_tps is not None:
+            self.submit_tps = float(self.submit_tps)
+        self.submit_burst = int(self.config.get('submit_burst', 1))
+        self.metrics_prefix = self.config.get('metrics_prefix')
+        if self.get_static_config().amqp_consumer_concurrency < 2:
+            raise ConfigError(
+                "amqp_consumer_concurrency must be at least 2, otherwise"
+                " only one outbound message is queued at a time.")
+
+    def get_bind_configs(self):
+        """Return a list of `(client_config, bind_type)` pairs, one for each
+        bind we should open.
+        """
+        binds = self.config.get('binds')
+        if binds is None:
+            binds = [{}] * int(self.config.get('bind_count', 1))
+        bind_configs = []
+        for bind in binds:
+            bind = dict(bind)
+            bind_type = bind.pop('bind_type', self.bind_type)
+            if bind_type not in self.FACTORY_CLASSES:
+                raise ConfigError("Invalid bind_type: %r" % (bind_type,))
+            client_config = ClientConfig.from_config(
+                dict(self.config, **bind))
+            bind_configs.append((client_config, bind_type))
+        return bind_configs
 
     @inlineCallbacks
     def setup_transport(self):
@@ -150,155 +282,196 @@ class SmppTransport(Transport):
         redis = yield TxRedisManager.from_config(r_config)
         self.redis = redis.sub_manager(r_prefix)
 
-        self.r_message_prefix = "message_json"
-        self.throttled = False
-
-        self.esme_callbacks = EsmeCallbacks(
-            connect=self.esme_connected,
-            disconnect=self.esme_disconnected,
-            submit_sm_resp=self.submit_sm_resp,
-            delivery_report=self.delivery_report,
-            deliver_sm=self.deliver_sm)
+        inflight_replay = self.config.get('inflight_replay', False)
+        self.inflight = InFlightTable(
+            self.redis,
+            self.config.get('inflight_table_id', self.transport_name),
+            persist=inflight_replay,
+            flush_interval=float(
+                self.config.get('inflight_flush_interval', 1.0)),
+            flush_size=int(self.config.get('inflight_flush_size', 100)),
+            third_party_id_expiry=self.third_party_id_expiry)
+        self._inflight_replay = []
+        if inflight_replay:
+            # Messages a previous run submitted but never got a response
+            # for.
+            self._inflight_replay = yield self.inflight.load()
+
+        self.scheduler = SubmitScheduler(
+            self._submit_outbound_message,
+            window_size=self.submit_window_size,
+            tps=self.submit_tps,
+            burst=self.submit_burst,
+            backoff_delay=self.throttle_delay,
+            max_backoff_delay=self.max_throttle_delay)
+        # Nothing can be sent until we have a bind.
+        self.scheduler.pause()
+        self.esme_clients = []
+        if self.metrics_prefix is not None:
+            self.metrics = yield self.start_publisher(
+                MetricManager, self.metrics_prefix)
+            self.scheduler.register_metrics(self.metrics)
 
         if not hasattr(self, 'esme_client'):
             # start the Smpp transport (if we don't have one)
-            self.factory = self.make_factory()
-            reactor.connectTCP(
-                self.client_config.host,
-                self.client_config.port,
-                self.factory)
+            self.factories = []
+            for client_config, bind_type in self.bind_configs:
+                factory = self.make_factory(client_config, bind_type)
+                self.factories.append(factory)
+                reactor.connectTCP(
+                    client_config.host, client_config.port, factory)
+            self.factory = self.factories[0]
 
     @inlineCallbacks
     def teardown_transport(self):
-        if hasattr(self, 'factory'):
-            self.factory.stopTrying()
-            self.factory.esme.transport.loseConnection()
+        for factory in getattr(self, 'factories', []):
+            factory.stopTrying()
+            if factory.esme is not None:
+                factory.esme.transport.loseConnection()
+        self.scheduler.stop()
+        if getattr(self, 'metrics', None) is not None:
+            self.metrics.stop()
+        yield self.inflight.stop()
         yield self.redis._close()
 
-    def make_factory(self):
-        return EsmeTransceiverFactory(
-            self.client_config, self.redis, self.esme_callbacks)
+    def make_factory(self, client_config=None, bind_type=None):
+        if client_config is None:
+            client_config = self.client_config
+        factory_class = self.FACTORY_CLASSES[bind_type or self.bind_type]
+        factory = factory_class(client_config, self.redis, EsmeCallbacks(
+            connect=self.esme_connected,
+            # The factory doesn't tell us which connection was lost.
+            disconnect=lambda: self.esme_disconnected(factory.esme),
+            submit_sm_resp=self.submit_sm_resp,
+            delivery_report=self.delivery_report,
+            deliver_sm=self.deliver_sm))
+        return factory
+
+    def can_submit(self, client):
+        return client.CONNECTED_STATE in ('BOUND_TX', 'BOUND_TRX')
+
+    def get_submit_clients(self):
+        """Return the bound clients we can send messages over."""
+        if not any(bind_type != 'rx' for _, bind_type in self.bind_configs):
+            # We have no transmitters, so don't pretend otherwise.
+            return self.esme_clients
+        return [c for c in self.esme_clients if self.can_submit(c)]
+
+    def select_client(self):
+        """Return the client to send the next message over."""
+        clients = self.get_submit_clients()
+        if not clients:
+            return self.esme_client
+        return min(clients, key=lambda c: c.get_unacked_count())
+
+    def _update_binds(self):
+        clients = self.get_submit_clients()
+        if self.submit_window_size is not None:
+            self.scheduler.window_size = (
+                self.submit_window_size * max(1, len(clients)))
+        if clients:
+            self.scheduler.unpause()
+            self.unpause_connectors()
+        else:
+            self.scheduler.pause()
+            self.pause_connectors()
 
     def esme_connected(self, client):
         log.msg("ESME Connected, adding handlers")
         self.esme_client = client
+        if client not in self.esme_clients:
+            self.esme_clients.append(client)
+        self._replay_inflight()
         # Start the consumer
-        self.unpause_connectors()
+        self._update_binds()
+
+    def _replay_inflight(self):
+        replay, self._inflight_replay = self._inflight_replay, []
+        if replay:
+            log.msg("Resubmitting %d message(s) left in flight by a previous"
+                    " run." % (len(replay),))
+        for message in replay:
+            self.scheduler.submit(
+                message, self.is_priority(message)).addErrback(log.err)
+
+    def is_priority(self, message):
+        """Return `True` if `message` should be sent ahead of others."""
+        return message['transport_type'] == 'ussd'
 
-    @inlineCallbacks
     def handle_outbound_message(self, message):
         log.debug("Consumed outgoing message %r" % (message,))
         log.debug("Unacknowledged message count: %s" % (
-                (yield self.esme_client.get_unacked_count()),))
-        yield self.r_set_message(message)
-        yield self._submit_outbound_message(message)
+                self.esme_client.get_unacked_count(),))
+        return self.scheduler.submit(message, self.is_priority(message))
 
     @inlineCallbacks
     def _submit_outbound_message(self, message):
         sequence_number = yield self.send_smpp(message)
-        yield self.r_set_id_for_sequence(
-            sequence_number, message.payload.get("message_id"))
+        if sequence_number:
+            self.inflight.add(sequence_number, message)
+        returnValue(sequence_number)
 
-    def esme_disconnected(self):
+    def esme_disconnected(self, client=None):
         log.msg("ESME Disconnected")
-        self.pause_connectors()
-
-    # Redis message storing methods
-
-    def r_message_key(self, message_id):
-        return "%s#%s" % (self.r_message_prefix, message_id)
-
-    def r_set_message(self, message):
-        message_id = message.payload['message_id']
-        return self.redis.set(
-            self.r_message_key(message_id), message.to_json())
-
-    def r_get_message_json(self, message_id):
-        return self.redis.get(self.r_message_key(message_id))
-
-    @inlineCallbacks
-    def r_get_message(self, message_id):
-        json_string = yield self.r_get_message_json(message_id)
-        if json_string:
-            returnValue(Message.from_json(json_string))
-        else:
-            returnValue(None)
-
-    def r_delete_message(self, message_id):
-        return self.redis.delete(self.r_message_key(message_id))
-
-    # Redis sequence number storing methods
-
-    def r_get_id_for_sequence(self, sequence_number):
-        return self.redis.get(str(sequence_number))
-
-    def r_delete_for_sequence(self, sequence_number):
-        return self.redis.delete(str(sequence_number))
-
-    def r_set_id_for_sequence(self, sequence_number, id):
-        return self.redis.set(str(sequence_number), id)
+        if client is None:
+            client = self.esme_client
+        if client in self.esme_clients:
+            self.esme_clients.remove(client)
+        if client is not None:
+            self._fail_over(client)
+        self._update_binds()
+        if not self.get_submit_clients():
+            # No response can arrive without a bind, so nothing still
+            # counted against the window will ever be freed.
+            self.scheduler.reset_window()
+
+    def _fail_over(self, client):
+        """Resubmit messages that were waiting for a response on a
+        connection that has gone away.
+        """
+        for sequence_number in client.get_unacked():
+            client.pop_unacked(sequence_number)
+            self.scheduler.forget()
+            message = self.inflight.pop(sequence_number)
+            if message is not None:
+                self.scheduler.requeue(message, self.is_priority(message))
 
     # Redis 3rd party id to vumi id mapping
 
     def r_third_party_id_key(self, third_party_id):
-        return "3rd_party_id#%s" % (third_party_id,)
+        return self.inflight.third_party_id_key(third_party_id)
 
     def r_get_id_for_third_party_id(self, third_party_id):
-        return self.redis.get(self.r_third_party_id_key(third_party_id))
+        return self.inflight.get_third_party_id(third_party_id)
 
     def r_delete_for_third_party_id(self, third_party_id):
         return self.redis.delete(
                 self.r_third_party_id_key(third_party_id))
 
-    @inlineCallbacks
-    def r_set_id_for_third_party_id(self, third_party_id, id):
-        rkey = self.r_third_party_id_key(third_party_id)
-        yield self.redis.set(rkey, id)
-        yield self.redis.expire(rkey, self.third_party_id_expiry)
-
-    def _start_throttling(self):
-        if self.throttled:
-            return
-        log.err("Throttling outbound messages.")
-        self.throttled = True
-        self.pause_connectors()
-
-    def _stop_throttling(self):
-        if not self.throttled:
-            return
-        log.err("No longer throttling outbound messages.")
-        self.throttled = False
-        self.unpause_connectors()
-
     @inlineCallbacks
     def submit_sm_resp(self, *args, **kwargs):
         transport_msg_id = kwargs['message_id']
-        sent_sms_id = (
-            yield self.r_get_id_for_sequence(kwargs['sequence_number']))
-        if sent_sms_id is None:
+        message = self.inflight.pop(kwargs['sequence_number'])
+        status = kwargs['command_status']
+        self.scheduler.response(throttled=(status == 'ESME_RTHROTTLED'))
+        if message is None:
             log.err("Sequence number lookup failed for:%s" % (
                 kwargs['sequence_number'],))
         else:
-            yield self.r_set_id_for_third_party_id(
+            sent_sms_id = message['message_id']
+            yield self.inflight.set_third_party_id(
                 transport_msg_id, sent_sms_id)
-            yield self.r_delete_for_sequence(kwargs['sequence_number'])
-            status = kwargs['command_status']
             if status == 'ESME_ROK':
                 # The sms was submitted ok
                 yield self.submit_sm_success(sent_sms_id, transport_msg_id)
-                yield self._stop_throttling()
             elif status == 'ESME_RTHROTTLED':
-                yield self._start_throttling()
-                yield self.submit_sm_throttled(sent_sms_id)
+                yield self.submit_sm_throttled(message)
             else:
                 # We have an error
-                yield self.submit_sm_failure(sent_sms_id,
+                yield self.submit_sm_failure(message,
                                              status or 'Unspecified')
-                yield self._stop_throttling()
 
-    @inlineCallbacks
     def submit_sm_success(self, sent_sms_id, transport_msg_id):
-        yield self.r_delete_message(sent_sms_id)
         log.debug("Mapping transport_msg_id=%s to sent_sms_id=%s" % (
             transport_msg_id, sent_sms_id))
         log.debug("PUBLISHING ACK: (%s -> %s)" % (
@@ -308,28 +481,16 @@ class SmppTransport(Transport):
             sent_message_id=transport_msg_id)
 
     @inlineCallbacks
-    def submit_sm_failure(self, sent_sms_id, reason, failure_code=None):
-        error_message = yield self.r_get_message(sent_sms_id)
-        if error_message is None:
-            log.err("Could not retrieve failed message:%s" % (
-                sent_sms_id))
-        else:
-            yield self.r_delete_message(sent_sms_id)
-            yield self.publish_nack(sent_sms_id, reason)
-            yield self.failure_publisher.publish_message(FailureMessage(
-                    message=error_message.payload,
-                    failure_code=None,
-                    reason=reason))
+    def submit_sm_failure(self, message, reason, failure_code=None):
+        yield self.publish_nack(message['message_id'], reason)
+        yield self.failure_publisher.publish_message(FailureMessage(
+                message=message.payload,
+                failure_code=None,
+                reason=reason))
 
-    @inlineCallbacks
-    def submit_sm_throttled(self, sent_sms_id):
-        message = yield self.r_get_message(sent_sms_id)
-        if message is None:
-            log.err("Could not retrieve throttled message:%s" % (
-                sent_sms_id))
-        else:
-            self.callLater(self.throttle_delay,
-                           self._submit_outbound_message, message)
+    def submit_sm_throttled(self, message):
+        # The scheduler holds off until the throttle backoff has passed.
+        self.scheduler.requeue(message, self.is_priority(message))
 
     def delivery_status(self, state):
         if state in [
@@ -409,7 +570,7 @@ class SmppTransport(Transport):
                 self.config.get('COUNTRY_CODE', ''),
                 self.config.get('OPERATOR_PREFIX', {}),
                 self.config.get('OPERATOR_NUMBER', {})) or from_addr
-        return self.esme_client.submit_sm(
+        return self.select_client().submit_sm(
                 short_message=text.encode('utf-8'),
                 destination_addr=str(to_addr),
                 source_addr=route,
@@ -430,12 +591,8 @@ class SmppTransport(Transport):
 
 
 class SmppTxTransport(SmppTransport):
-    def make_factory(self):
-        return EsmeTransmitterFactory(
-            self.client_config, self.redis, self.esme_callbacks)
+    bind_type = 'tx'
 
 
 class SmppRxTransport(SmppTransport):
-    def make_factory(self):
-        return EsmeReceiverFactory(
-            self.client_config, self.redis, self.esme_callbacks)
+    bind_type = 'rx'
@@ -379,6 +379,59 @@ def safe_routing_key(routing_key):
                     [('*', 's'), ('#', 'h')], routing_key)
 
 
+class OffsetBuffer(object):
+    """Buffer of received bytes that frames can be popped off.
+
+    Data is appended to a single `bytearray` and frames are consumed by
+    moving a read offset along, so a large read containing many frames
+    costs time proportional to its length rather than to the square of
+    the number of frames in it. Consumed bytes are discarded once they make
+    up at least half of the buffer.
+
+    Subclasses implement :meth:`pop` to find the end of the next frame in
+    `_buffer` (starting at `_offset`) and consume it with :meth:`_take`.
+    """
+
+    def __init__(self, data=''):
+        self._buffer = bytearray(data)
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        if self._offset and self._offset * 2 >= len(self._buffer):
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer.extend(data)
+
+    def pop(self):
+        """Return the next complete frame, or `None` if there isn't one."""
+        raise NotImplementedError()
+
+    def _take(self, start, end, skip=0):
+        """Consume the buffer up to `end + skip` and return the bytes from
+        `start` to `end`.
+        """
+        data = bytes(self._buffer[start:end])
+        self._offset = end + skip
+        return data
+
+    def remainder(self):
+        """Return (and discard) whatever is left in the buffer."""
+        data = bytes(self._buffer[self._offset:])
+        del self._buffer[:]
+        self._offset = 0
+        return data
+
+    def __iter__(self):
+        """Pop complete frames until there are none left."""
+        data = self.pop()
+        while data is not None:
+            yield data
+            data = self.pop()
+
+
 ### SAMPLE CONFIG PARAMETERS - REPLACE 'x's IN OPERATOR_NUMBER
 
 """
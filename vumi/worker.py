@@ -32,6 +32,24 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_consumer_concurrency = ConfigInt(
+        "The number of messages from each AMQP queue that each worker"
+        " instance processes concurrently. The default of 1 processes"
+        " messages one at a time.",
+        default=1, static=True)
+    amqp_ack_batch_size = ConfigInt(
+        "When processing messages concurrently, acknowledge them to AMQP"
+        " in batches of this many.",
+        default=1, static=True)
+    amqp_publish_batch_size = ConfigInt(
+        "The number of outbound AMQP messages to coalesce into a single"
+        " publishing batch. The default of 1 publishes each message"
+        " immediately.",
+        default=1, static=True)
+    amqp_max_outstanding_publishes = ConfigInt(
+        "The maximum number of AMQP messages each connector publishes"
+        " before waiting for earlier ones to complete. Unlimited if unset.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -163,12 +181,18 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            consumer_concurrency=static_config.amqp_consumer_concurrency,
+            ack_batch_size=static_config.amqp_ack_batch_size,
+            publish_batch_size=static_config.amqp_publish_batch_size,
+            max_outstanding_publishes=(
+                static_config.amqp_max_outstanding_publishes),
+            middlewares=middlewares)
         self.connectors[connector_name] = connector
 
         d = connector.setup()